@@ -1,5 +1,15 @@
-from rc.provider import gcloud, azure, digitalocean, aws
+import importlib
 from rc.machine import Machine
 from rc.util import run, RunException, RunResult, running, run_stream, handle_stream, \
-    STDERR, STDOUT, EXIT, go, pmap, as_completed, print_stream, save_stream_to_file, \
+    STDERR, STDOUT, EXIT, go, pmap, pimap, as_completed, set_limit, print_stream, save_stream_to_file, \
     p, ep, bash, python, python2, python3, sudo, kill, ok
+
+
+_providers = ['gcloud', 'azure', 'digitalocean', 'aws']
+
+
+def __getattr__(name):
+    # Provider modules are imported on first use, so `import rc` stays cheap
+    if name in _providers:
+        return importlib.import_module('rc.provider.' + name)
+    raise AttributeError(f"module 'rc' has no attribute '{name}'")
@@ -0,0 +1,210 @@
+import base64
+import hashlib
+import json
+import subprocess
+from collections import deque
+from threading import Event, Lock, Thread
+from rc import agent_server
+from rc.util import RunResult, convert_list_command_to_str
+from rc.exception import AgentException, RunException
+
+with open(agent_server.__file__, 'rb') as f:
+    AGENT_SOURCE = f.read()
+AGENT_DIGEST = hashlib.sha256(AGENT_SOURCE).hexdigest()[:16]
+# Exit code of the start command when the agent is not installed on the machine yet
+NOT_INSTALLED = 42
+
+
+class _Pending:
+    def __init__(self):
+        self.event = Event()
+        self.response = None
+
+
+class AgentClient:
+    """
+    Client of one rc.agent_server process, started by cmd (a list of arguments, e.g. ssh
+    to a machine then python3 agent.py) and kept running. Requests go over its stdin and
+    responses come back over its stdout tagged with the request id, so each costs a round
+    trip on an already open channel instead of a new ssh session and a new remote shell or
+    python, and concurrent requests run at the same time on the machine. Raise
+    AgentException when the agent cannot be started or the channel breaks, its message
+    starts with 'agent is not running' if the request was not sent at all.
+
+    A request waits at most timeout seconds for its response, a run with a timeout of its
+    own that much longer, then the agent is considered hung and closed. Runs and python
+    scripts without a timeout wait for as long as they take, like over plain ssh.
+    """
+
+    def __init__(self, cmd, *, timeout=300):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.process = None
+        # Guards writes to the agent, request ids and _waiting
+        self._lock = Lock()
+        self._id = 0
+        self._waiting = {}
+        self._broken = None
+        self._stderr = deque(maxlen=50)
+
+    def _drain_stderr(self, stream):
+        for line in stream:
+            self._stderr.append(line.decode(errors='replace'))
+
+    def start(self):
+        """Start agent process and wait for its hello, return returncode if it exited instead"""
+        self.process = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE, start_new_session=True)
+        drain = Thread(target=self._drain_stderr, args=(
+            self.process.stderr,), daemon=True)
+        drain.start()
+        hello = self._read()
+        if hello is None:
+            returncode = self.process.wait()
+            drain.join(timeout=1)
+            return returncode
+        self.version = hello['version']
+        Thread(target=self._read_responses, name='rc-agent-reader', daemon=True).start()
+        return None
+
+    def _read(self):
+        header = self.process.stdout.read(4)
+        if len(header) < 4:
+            return None
+        return json.loads(self.process.stdout.read(int.from_bytes(header, 'big')).decode())
+
+    def _write(self, obj):
+        data = json.dumps(obj).encode()
+        self.process.stdin.write(len(data).to_bytes(4, 'big') + data)
+        self.process.stdin.flush()
+
+    def _read_responses(self):
+        # Hand every response to the request waiting for its id, until the channel closes
+        try:
+            while True:
+                resp = self._read()
+                if resp is None:
+                    broken = 'agent exited: '
+                    break
+                with self._lock:
+                    pending = self._waiting.pop(resp.get('id'), None)
+                if pending is not None:
+                    pending.response = resp
+                    pending.event.set()
+        except (OSError, ValueError) as e:
+            broken = f'agent channel broken: {e} '
+        with self._lock:
+            self._broken = broken
+            waiting, self._waiting = self._waiting, {}
+        for pending in waiting.values():
+            pending.event.set()
+
+    @property
+    def alive(self):
+        return self.process is not None and self._broken is None and self.process.poll() is None
+
+    @property
+    def stderr(self):
+        return ''.join(self._stderr)
+
+    def request(self, op, *, wait=None, **kwargs):
+        """Send request op and return its response, waiting at most wait seconds for it (None: forever)"""
+        pending = _Pending()
+        with self._lock:
+            if not self.alive:
+                error = 'agent is not running: ' + self.stderr
+            else:
+                self._id += 1
+                self._waiting[self._id] = pending
+                try:
+                    self._write({'op': op, 'id': self._id, **kwargs})
+                    error = None
+                except OSError as e:
+                    del self._waiting[self._id]
+                    error = f'agent is not running: {e}'
+        if error is not None:
+            self.close()
+            raise AgentException(error)
+        if not pending.event.wait(wait):
+            self.close()
+            raise AgentException(f'agent did not respond to {op} in {wait} seconds')
+        if pending.response is None:
+            self.close()
+            raise AgentException(self._broken + self.stderr)
+        return pending.response
+
+    def _ok(self, resp):
+        if 'error' in resp:
+            if resp['error'] == 'timeout':
+                raise RunException(resp['message'])
+            raise AgentException(f"{resp['error']}: {resp['message']}")
+        return resp
+
+    def run(self, cmd, *, input=None, timeout=None):
+        if type(cmd) is list:
+            cmd = convert_list_command_to_str(cmd)
+        if isinstance(input, str):
+            input = input.encode()
+        resp = self._ok(self.request('run', wait=None if timeout is None else timeout + self.timeout,
+                                     cmd=cmd, timeout=timeout,
+                                     input=base64.b64encode(input).decode() if input else None))
+        return RunResult(stdout=resp['stdout'], stderr=resp['stderr'], returncode=resp['returncode'])
+
+    def python(self, script):
+        """Exec script in the agent's interpreter, with a fresh namespace, return RunResult of its output"""
+        resp = self._ok(self.request('python', script=script))
+        return RunResult(stdout=resp['stdout'], stderr=resp['stderr'], returncode=resp['returncode'])
+
+    def read(self, path):
+        return base64.b64decode(self._ok(self.request('read', wait=self.timeout, path=path))['data'])
+
+    def write(self, path, data, *, mode=None, append=False):
+        if isinstance(data, str):
+            data = data.encode()
+        self._ok(self.request('write', wait=self.timeout, path=path, data=base64.b64encode(data).decode(),
+                              mode=mode, append=append))
+
+    def stat(self, path):
+        return self._ok(self.request('stat', wait=self.timeout, path=path))
+
+    def close(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+def agent_path(directory='~/.python-rc'):
+    return f'{directory}/agent-{AGENT_DIGEST}.py'
+
+
+def start_cmd(directory='~/.python-rc', python_path='python3'):
+    """Remote command that runs the installed agent, or exits with NOT_INSTALLED"""
+    path = agent_path(directory)
+    return f'[ -f {path} ] || exit {NOT_INSTALLED}; exec {python_path} {path}'
+
+
+def connect(machine, *, directory='~/.python-rc', python_path='python3'):
+    """
+    Start the agent on machine over ssh, pushing it first if this version is not installed
+    there. Return a started AgentClient, raise AgentException if agent cannot be started.
+    """
+    cmd = [*machine._ssh_shell(), start_cmd(directory, python_path)]
+    client = AgentClient(cmd)
+    returncode = client.start()
+    if returncode == NOT_INSTALLED:
+        p = machine.ensure_dir(directory, allow_write=False)
+        if p.returncode == 0:
+            p = machine.write_file(agent_path(directory), AGENT_SOURCE)
+        if p.returncode != 0:
+            raise AgentException(f'cannot install agent on {machine}: {p.stderr}')
+        client = AgentClient(cmd)
+        returncode = client.start()
+    if returncode is not None:
+        raise AgentException(f'cannot start agent on {machine}: {client.stderr}')
+    return client
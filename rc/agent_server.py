@@ -0,0 +1,137 @@
+"""
+Remote side of rc.agent. Runs on the machine with its own python3, standard library only
+and no f-strings, so it works with old system pythons. Reads requests and writes responses
+as frames of a 4 byte big endian length followed by a json object, until stdin is closed.
+Requests run concurrently, each response carries the id of its request.
+"""
+import base64
+import contextlib
+import io
+import json
+import os
+import struct
+import subprocess
+import sys
+import threading
+import traceback
+
+VERSION = 2
+# op_python redirects the process' stdout and stderr, one python request runs at a time
+_python_lock = threading.Lock()
+
+
+def read_frame(f):
+    header = f.read(4)
+    if len(header) < 4:
+        return None
+    size = struct.unpack('>I', header)[0]
+    return json.loads(f.read(size).decode())
+
+
+def write_frame(f, obj):
+    data = json.dumps(obj).encode()
+    f.write(struct.pack('>I', len(data)) + data)
+    f.flush()
+
+
+def op_run(req):
+    input = base64.b64decode(req['input']) if req.get('input') else None
+    shell = os.environ.get('SHELL') or '/bin/sh'
+    p = subprocess.Popen([shell, '-c', req['cmd']], stdin=subprocess.PIPE if input else subprocess.DEVNULL,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+    try:
+        stdout, stderr = p.communicate(input, timeout=req.get('timeout'))
+    except subprocess.TimeoutExpired:
+        os.killpg(p.pid, 9)
+        p.communicate()
+        return {'error': 'timeout', 'message': 'Command timed out after %s seconds' % req.get('timeout')}
+    return {'stdout': stdout.decode(errors='replace'), 'stderr': stderr.decode(errors='replace'),
+            'returncode': p.returncode}
+
+
+def op_read(req):
+    with open(os.path.expanduser(req['path']), 'rb') as f:
+        return {'data': base64.b64encode(f.read()).decode()}
+
+
+def op_write(req):
+    path = os.path.expanduser(req['path'])
+    data = base64.b64decode(req['data'])
+    if req.get('append'):
+        with open(path, 'ab') as f:
+            f.write(data)
+    else:
+        tmp = '%s.rc-tmp.%d.%d' % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        if os.path.exists(path):
+            os.chmod(tmp, os.stat(path).st_mode & 0o7777)
+        os.replace(tmp, path)
+    if req.get('mode'):
+        os.chmod(path, int(str(req['mode']), 8))
+    return {}
+
+
+def op_stat(req):
+    path = os.path.expanduser(req['path'])
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return {'exists': False}
+    return {'exists': True, 'size': st.st_size, 'mtime': st.st_mtime, 'mode': st.st_mode & 0o7777,
+            'inode': st.st_ino, 'isdir': os.path.isdir(path)}
+
+
+def op_python(req):
+    stdout, stderr = io.StringIO(), io.StringIO()
+    returncode = 0
+    with _python_lock, contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            exec(compile(req['script'], '<rc>', 'exec'), {'__name__': '__main__'})
+        except SystemExit as e:
+            returncode = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except BaseException:
+            traceback.print_exc()
+            returncode = 1
+    return {'stdout': stdout.getvalue(), 'stderr': stderr.getvalue(), 'returncode': returncode}
+
+
+OPS = {'run': op_run, 'read': op_read, 'write': op_write, 'stat': op_stat, 'python': op_python,
+       'ping': lambda req: {}}
+
+
+def handle(req, out, out_lock):
+    try:
+        resp = OPS[req['op']](req)
+    except Exception as e:
+        resp = {'error': type(e).__name__, 'message': str(e)}
+    resp['id'] = req.get('id')
+    with out_lock:
+        write_frame(out, resp)
+
+
+def main():
+    # Keep the protocol on private descriptors, so nothing a request runs can write into it
+    inp = os.fdopen(os.dup(0), 'rb')
+    out = os.fdopen(os.dup(1), 'wb')
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(2, 1)
+    write_frame(out, {'version': VERSION, 'pid': os.getpid()})
+    # Every request runs in its own thread and is answered with its id, in any order
+    out_lock = threading.Lock()
+    threads = []
+    while True:
+        req = read_frame(inp)
+        if req is None:
+            break
+        thread = threading.Thread(target=handle, args=(req, out, out_lock))
+        thread.daemon = True
+        thread.start()
+        threads = [t for t in threads if t.is_alive()] + [thread]
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == '__main__':
+    main()
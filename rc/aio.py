@@ -0,0 +1,125 @@
+import asyncio
+import os
+import signal
+from typing import Union, List
+from rc.util import RunResult, convert_list_command_to_str, STDOUT, STDERR, EXIT, _command_label
+from rc import trace
+from rc.exception import RunException, PmapException
+
+# Longest line arun_stream can yield
+STREAM_LIMIT = 16 * 1024 * 1024
+
+
+def _decode(data, text):
+    if not text or data is None:
+        return data
+    # Same translation as subprocess universal_newlines
+    return data.decode().replace('\r\n', '\n').replace('\r', '\n')
+
+
+def _encode(input):
+    if isinstance(input, str):
+        return input.encode()
+    return input
+
+
+async def _create_process(cmd, shell, input, stdout, stderr):
+    if type(cmd) is list:
+        cmd = convert_list_command_to_str(cmd)
+    if not shell:
+        shell = []
+    try:
+        return await asyncio.create_subprocess_exec(*shell, cmd,
+                                                    stdin=asyncio.subprocess.PIPE if input else None,
+                                                    stdout=stdout, stderr=stderr, start_new_session=True,
+                                                    limit=STREAM_LIMIT)
+    except Exception as e:
+        raise RunException(e) from None
+
+
+def _kill(proc):
+    try:
+        os.killpg(os.getpgid(proc.pid), signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+
+@trace.traced('arun', _command_label)
+async def arun(cmd: Union[str, List[str]], *, shell=['/bin/sh', '-c'], input=None, timeout=None, text=True,
+               stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE):
+    """asyncio counterpart of rc.util.run, returns the same RunResult"""
+    proc = await _create_process(cmd, shell, input, stdout, stderr)
+    try:
+        out, err = await asyncio.wait_for(proc.communicate(_encode(input)), timeout)
+    except asyncio.TimeoutError as e:
+        _kill(proc)
+        await proc.wait()
+        raise RunException(e) from None
+    except asyncio.CancelledError:
+        _kill(proc)
+        raise
+    return RunResult(returncode=proc.returncode, stdout=_decode(out, text), stderr=_decode(err, text))
+
+
+async def arun_stream(cmd: Union[str, List[str]], *, shell=['/bin/sh', '-c'], input=None, text=True):
+    """
+    asyncio counterpart of rc.util.run_stream. Async iterator of the same (STDOUT, line),
+    (STDERR, line) and finally (EXIT, returncode) events.
+    """
+    proc = await _create_process(cmd, shell, input,
+                                 asyncio.subprocess.PIPE, asyncio.subprocess.PIPE)
+    if input:
+        proc.stdin.write(_encode(input))
+        proc.stdin.close()
+    q = asyncio.Queue()
+
+    async def read(stream, event):
+        # Always end with None, or with the error, e.g. a line longer than STREAM_LIMIT
+        end = None
+        try:
+            async for line in stream:
+                await q.put((event, _decode(line, text)))
+        except Exception as e:
+            end = e
+        finally:
+            q.put_nowait(end)
+
+    readers = [asyncio.ensure_future(read(proc.stdout, STDOUT)),
+               asyncio.ensure_future(read(proc.stderr, STDERR))]
+    try:
+        open_streams = len(readers)
+        while open_streams:
+            item = await q.get()
+            if item is None:
+                open_streams -= 1
+            elif isinstance(item, Exception):
+                raise RunException(item)
+            else:
+                yield item
+        yield (EXIT, await proc.wait())
+    finally:
+        for r in readers:
+            r.cancel()
+        if proc.returncode is None:
+            _kill(proc)
+            await proc.wait()
+
+
+async def agather(func, *iterables, concurrency=None, on_exception='raise'):
+    """
+    asyncio counterpart of rc.util.pmap: await func(*args) for every item of iterables with
+    at most concurrency coroutines in flight, return results in order.
+    """
+    semaphore = asyncio.Semaphore(concurrency) if concurrency else None
+
+    async def call(args):
+        try:
+            if semaphore:
+                async with semaphore:
+                    return await func(*args)
+            return await func(*args)
+        except Exception as e:
+            if on_exception == 'raise':
+                raise
+            return PmapException(e, *args)
+    return await asyncio.gather(*(call(args) for args in zip(*iterables)))
@@ -0,0 +1,147 @@
+import base64
+import uuid
+from concurrent.futures import Future
+from rc.util import run_chunks, bash_cmd, sudo_cmd, python_cmd, RunResult
+from rc.ssh import pool
+from rc.machine import iter_chunks, gzip_chunks, write_file_cmd, ensure_dir_script, ensure_user_script
+
+
+class Batch:
+    """
+    Queue operations on a machine and run them as one script in one ssh session, instead of
+    one ssh session per operation:
+
+        with machine.batch() as b:
+            b.ensure_dir('/opt/app')
+            b.write_file('/opt/app/config', config)
+            r = b.sudo('systemctl restart app')
+        r.result().returncode
+
+    Every operation returns a Future of its own RunResult, set when the batch runs. Every
+    operation runs even if an earlier one failed, unless stop_on_error. Output of each
+    operation is framed by a random sentinel line with exit code and byte lengths of its
+    stdout and stderr, so it is parsed exactly whatever the commands print.
+    """
+
+    def __init__(self, machine, *, stop_on_error=False, timeout=None):
+        self.machine = machine
+        self.stop_on_error = stop_on_error
+        self.timeout = timeout
+        self.ops = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        else:
+            for _, _, future in self.ops:
+                future.cancel()
+            self.ops = []
+
+    def _queue(self, cmd, input=None):
+        future = Future()
+        if isinstance(input, str):
+            input = input.encode()
+        self.ops.append((cmd, input, future))
+        return future
+
+    def run(self, cmd, *, input=None):
+        return self._queue(cmd, input)
+
+    def bash(self, script, *, flag='set -euo pipefail', login=False, interactive=False):
+        return self._queue(*bash_cmd(script, flag=flag, login=login, interactive=interactive))
+
+    def sudo(self, script, *, shell=None, user='root', flag='set -euo pipefail'):
+        return self._queue(*sudo_cmd(script, shell=shell, user=user, flag=flag))
+
+    def python(self, script, *, python_path='python', user=None):
+        return self._queue(*python_cmd(script, python_path=python_path, user=user))
+
+    def write_file(self, path, data, *, user=None, compress=False, atomic=True, append=False, mode=None):
+        chunks = iter_chunks(data)
+        if compress:
+            chunks = gzip_chunks(chunks)
+        cmd = write_file_cmd(path, compressed=compress, atomic=atomic, append=append,
+                             mode=mode, user=user)
+        return self._queue(cmd, b''.join(chunks))
+
+    def edit(self, path, content, append=False, user=None):
+        # Written in place like a shell redirect, keeps symlinks, owner and group of path
+        return self.write_file(path, content + '\n', append=append, user=user, atomic=False)
+
+    def ensure_dir(self, path, user=None, allow_write=True):
+        script = ensure_dir_script(path, allow_write=allow_write)
+        if user:
+            return self.sudo(script, user=user)
+        return self.bash(script)
+
+    def ensure_user(self, username, *, sudo=True, pubkey=True):
+        if pubkey is True:
+            pubkey = self.machine._pubkey()
+        return self.sudo(ensure_user_script(username, sudo=sudo, pubkey=pubkey))
+
+    def run_bg(self, script, *, cmd='bash', stdout=None, stderr=None, exitcode=None, pid=None, user=None):
+        """Return a rc.job.Job, its started attribute is a Future of RunResult of starting it"""
+        from rc.job import Job, new_id
+        job = Job(self.machine, new_id(), user=user, stdout=stdout,
+                  stderr=stderr, pid=pid, exitcode=exitcode)
+        job.started = self.run(job.start_cmd(cmd), input=script + '\n')
+        return job
+
+    def script(self, sentinel):
+        """bash script that runs queued operations and prints their framed output"""
+        lines = ['d=$(mktemp -d) || exit 255', "trap 'rm -rf \"$d\"' EXIT"]
+        for i, (cmd, input, _) in enumerate(self.ops):
+            if input:
+                lines.append(
+                    f"printf %s '{base64.b64encode(input).decode()}' | base64 -d > \"$d/in\"")
+                stdin = '"$d/in"'
+            else:
+                stdin = '/dev/null'
+            lines += [f'(\n{cmd}\n) < {stdin} > "$d/out" 2> "$d/err"', 'rc=$?',
+                      f'printf \'%s %d %d %d %d\\n\' {sentinel} {i} $rc '
+                      f'$(($(wc -c < "$d/out"))) $(($(wc -c < "$d/err")))',
+                      'cat "$d/out" "$d/err"']
+            if self.stop_on_error:
+                lines.append('[ $rc -eq 0 ] || exit $rc')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def parse(stdout, sentinel):
+        """{index: RunResult} of operations from framed output of script"""
+        results = {}
+        marker = sentinel.encode() + b' '
+        pos = 0
+        while True:
+            pos = stdout.find(marker, pos)
+            if pos < 0:
+                return results
+            end = stdout.index(b'\n', pos)
+            i, rc, out_len, err_len = map(int, stdout[pos + len(marker):end].split())
+            out = stdout[end + 1:end + 1 + out_len]
+            err = stdout[end + 1 + out_len:end + 1 + out_len + err_len]
+            results[i] = RunResult(stdout=out.decode(errors='replace'), stderr=err.decode(errors='replace'),
+                                   returncode=rc)
+            pos = end + 1 + out_len + err_len
+
+    def flush(self):
+        """Run queued operations now and set their results"""
+        if not self.ops:
+            return
+        sentinel = 'python-rc-' + uuid.uuid4().hex
+        script = self.script(sentinel)
+        ops, self.ops = self.ops, []
+        p = run_chunks('bash', [script.encode()], shell=self.machine._ssh_shell(), timeout=self.timeout,
+                       text=False)
+        if p.returncode == 255:
+            pool.check(self.machine)
+        results = self.parse(p.stdout, sentinel)
+        stderr = p.stderr.decode(errors='replace')
+        for i, (_, _, future) in enumerate(ops):
+            if i in results:
+                future.set_result(results[i])
+            else:
+                # Not run, because ssh failed or an earlier operation failed with stop_on_error
+                future.set_result(RunResult(stdout='', stderr=stderr, returncode=p.returncode or 255))
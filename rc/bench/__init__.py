@@ -0,0 +1,5 @@
+"""
+Benchmarks of rc that run on one linux box: fake gcloud, aws, doctl and az clis with a
+configurable latency, and local sshd hosts when sshd is installed. Run with
+python -m rc.bench, see --help.
+"""
@@ -0,0 +1,42 @@
+import argparse
+import json
+import sys
+from rc.bench.suite import run_suite, compare, format_results, format_compare
+
+
+def ints(value):
+    return [int(v) for v in value.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        'python -m rc.bench', description='benchmark rc against fake clouds and local sshd, and write a json report')
+    parser.add_argument('--n', type=ints, default=[1, 10, 100, 1000],
+                        help='group sizes for resolve and pmap, comma separated')
+    parser.add_argument('--ssh-n', type=ints, default=[1, 10, 100],
+                        help='numbers of local ssh hosts for execute, comma separated')
+    parser.add_argument('--latency', type=float, default=0.5, help='seconds every fake cloud cli call takes')
+    parser.add_argument('--sizes', type=ints, default=[1, 16, 64], help='MB to upload and download')
+    parser.add_argument('--lines', type=ints, default=[1000, 100000], help='lines to stream')
+    parser.add_argument('--port', type=int, default=2222, help='port of local sshd')
+    parser.add_argument('--bench', action='append', choices=['resolve', 'pmap', 'execute', 'transfer', 'stream'],
+                        help='only run these benches, all by default')
+    parser.add_argument('-o', '--output', help='write the json report to this file')
+    parser.add_argument('--compare', help='json report of an earlier run to compare with')
+    args = parser.parse_args(argv)
+    report = run_suite(ns=args.n, ssh_ns=args.ssh_n, latency=args.latency, sizes_mb=args.sizes,
+                       stream_lines=args.lines, port=args.port,
+                       benches=args.bench or ('resolve', 'pmap', 'execute', 'transfer', 'stream'),
+                       log=lambda line: print(line, file=sys.stderr))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(format_results(report))
+    if args.compare:
+        with open(args.compare) as f:
+            print()
+            print(format_compare(compare(json.load(f), report)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Fake gcloud, aws, doctl and az, run as `python fake_cli.py <cli> args...` by the wrappers
+rc.bench.fakecloud puts on PATH. It answers the listing and status commands of rc providers
+from the instances in $RC_FAKE_CLOUD/state.json, after sleeping $RC_FAKE_LATENCY seconds
+to stand for the start up time of the real cli, and logs every call to
+$RC_FAKE_CLOUD/calls.log. Anything else succeeds with no output. Imports nothing of rc, so
+it starts as fast as python does.
+"""
+import json
+import os
+import re
+import sys
+import time
+
+
+def option(args, name, default=None):
+    if name in args and args.index(name) + 1 < len(args):
+        return args[args.index(name) + 1]
+    return default
+
+
+def gcloud(args, state):
+    instances = state['gcloud']
+    if args[:2] == ['config', 'get-value']:
+        return 'bench\n'
+    if args[:3] == ['compute', 'instances', 'list']:
+        names = re.search(r'name=\((.*)\)', option(args, '--filter', ''))
+        if names:
+            names = set(names.group(1).split())
+            instances = [i for i in instances if i['name'] in names]
+        if 'status' in option(args, '--format', ''):
+            return ''.join(f'{i["name"]}\tRUNNING\t{i["ip"]}\n' for i in instances)
+        return ''.join(f'{i["zone"]}\t{i["name"]}\t{i["ip"]}\n' for i in instances)
+    return ''
+
+
+def aws(args, state):
+    if args[:2] == ['ec2', 'describe-regions']:
+        return json.dumps({'Regions': [{'RegionName': r} for r in state['aws_regions']]})
+    if args[:2] == ['ec2', 'describe-instances']:
+        region = option(args, '--region')
+        instances = [i for i in state['aws'] if i['region'] == region]
+        ids = None
+        if '--instance-ids' in args:
+            ids = set(args[args.index('--instance-ids') + 1:])
+        for f in args[args.index('--filters') + 1:] if '--filters' in args else []:
+            key, _, values = f.partition(',Values=')
+            if key == 'Name=tag:Name':
+                instances = [i for i in instances if i['name'] in values.split(',')]
+            elif key == 'Name=instance-id':
+                ids = set(values.split(','))
+        if ids is not None:
+            instances = [i for i in instances if i['id'] in ids]
+        return json.dumps({'Reservations': [{'Instances': [
+            {'InstanceId': i['id'], 'Tags': [{'Key': 'Name', 'Value': i['name']}], 'State': {'Name': 'running'},
+             'Placement': {'AvailabilityZone': i['region'] + 'a'}, 'PublicIpAddress': i['ip']}
+            for i in instances]}]})
+    return ''
+
+
+def doctl(args, state):
+    if args[:3] == ['compute', 'droplet', 'list']:
+        columns = {'Region': 'region', 'Name': 'name', 'PublicIPv4': 'ip', 'ID': 'id', 'Status': 'status'}
+        fields = [columns[c] for c in option(args, '--format', 'ID,Name').split(',')]
+        return ''.join(' '.join(str(d[f]) for f in fields) + '\n' for d in state['doctl'])
+    return ''
+
+
+def az(args, state):
+    if args[:2] == ['vm', 'list']:
+        return json.dumps([{'name': vm['name'], 'location': vm['location'], 'publicIps': vm['ip']}
+                           for vm in state['az']])
+    return ''
+
+
+def main():
+    cli, args = sys.argv[1], sys.argv[2:]
+    time.sleep(float(os.environ.get('RC_FAKE_LATENCY') or 0))
+    directory = os.environ['RC_FAKE_CLOUD']
+    with open(os.path.join(directory, 'calls.log'), 'a') as f:
+        f.write(' '.join([cli, *args[:3]]) + '\n')
+    with open(os.path.join(directory, 'state.json')) as f:
+        state = json.load(f)
+    sys.stdout.write({'gcloud': gcloud, 'aws': aws, 'doctl': doctl, 'az': az}[cli](args, state))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+from rc.inventory import inventory
+
+CLIS = ['gcloud', 'aws', 'doctl', 'az']
+
+
+def fake_state(n, *, regions=17, used_regions=2):
+    """n instances in every fake cloud, aws ones spread over used_regions of regions"""
+    aws_regions = [f'bench-region-{i}' for i in range(regions)]
+    return {
+        'gcloud': [{'name': f'gcloud-{i}', 'zone': 'bench-zone-a', 'ip': f'10.1.{i // 250}.{i % 250 + 1}'}
+                   for i in range(n)],
+        'aws_regions': aws_regions,
+        'aws': [{'name': f'aws-{i}', 'id': f'i-{i:08x}', 'region': aws_regions[i % used_regions],
+                 'ip': f'10.2.{i // 250}.{i % 250 + 1}'} for i in range(n)],
+        'doctl': [{'name': f'doctl-{i}', 'id': 1000 + i, 'region': 'bench1', 'status': 'active',
+                   'ip': f'10.3.{i // 250}.{i % 250 + 1}'} for i in range(n)],
+        'az': [{'name': f'az-{i}', 'location': 'bench', 'ip': f'10.4.{i // 250}.{i % 250 + 1}'}
+               for i in range(n)],
+    }
+
+
+class FakeCloud:
+    """
+    Fake gcloud, aws, doctl and az executables with n instances each, put first on PATH
+    while in the with block, so rc providers run against them unchanged. Every fake call
+    sleeps latency seconds, like the start up of the real clis. The rc inventory, the aws
+    region index and the gcloud ssh key are pointed to a temporary directory meanwhile, so
+    nothing of the real clouds is read or overwritten.
+    """
+
+    def __init__(self, n, *, latency=0.0, regions=17, used_regions=2):
+        self.n = n
+        self.latency = latency
+        self.state = fake_state(n, regions=regions, used_regions=used_regions)
+        self.directory = None
+        self._saved = None
+
+    def _write_clis(self):
+        bin_dir = os.path.join(self.directory, 'bin')
+        os.makedirs(bin_dir)
+        fake_cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_cli.py')
+        for cli in CLIS:
+            path = os.path.join(bin_dir, cli)
+            with open(path, 'w') as f:
+                f.write(f'#!/bin/sh\nexec {sys.executable} -S {fake_cli} {cli} "$@"\n')
+            os.chmod(path, 0o755)
+        return bin_dir
+
+    def __enter__(self):
+        from rc.provider import aws, gcloud, digitalocean
+        self.directory = tempfile.mkdtemp(prefix='rc-bench-')
+        with open(os.path.join(self.directory, 'state.json'), 'w') as f:
+            json.dump(self.state, f)
+        bin_dir = self._write_clis()
+        ssh_key = os.path.join(self.directory, 'id_rsa')
+        open(ssh_key, 'w').close()
+        self._saved = ({k: os.environ.get(k) for k in ['PATH', 'RC_FAKE_CLOUD', 'RC_FAKE_LATENCY']},
+                       inventory.directory, aws.region_index, gcloud.SSH_KEY_PATH,
+                       gcloud.transport, digitalocean.transport)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+        os.environ['RC_FAKE_CLOUD'] = self.directory
+        os.environ['RC_FAKE_LATENCY'] = str(self.latency)
+        inventory.directory = os.path.join(self.directory, 'inventory')
+        aws.region_index = aws.RegionIndex(os.path.join(self.directory, 'aws-regions.json'))
+        gcloud.SSH_KEY_PATH = ssh_key
+        gcloud.transport = digitalocean.transport = 'cli'
+        self.reset()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        from rc.provider import aws, gcloud, digitalocean
+        # Drop what was cached from the fakes while still pointed to the temporary directory
+        self.reset()
+        environ, inventory.directory, aws.region_index, gcloud.SSH_KEY_PATH, \
+            gcloud.transport, digitalocean.transport = self._saved
+        for k, v in environ.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def reset(self, *, index=True):
+        """Forget every cached listing, and the aws region index unless index is False"""
+        from rc.provider import aws, gcloud
+        inventory.invalidate()
+        gcloud.get_project.cache_clear()
+        aws._get_regions.cache_clear()
+        if index:
+            try:
+                os.remove(aws.region_index.path)
+            except FileNotFoundError:
+                pass
+            aws.region_index = aws.RegionIndex(aws.region_index.path)
+
+    def names(self, cli, n=None):
+        return [i['name'] for i in self.state[cli][:n]]
+
+    def calls(self):
+        """Number of fake cli calls so far"""
+        try:
+            with open(os.path.join(self.directory, 'calls.log')) as f:
+                return sum(1 for _ in f)
+        except FileNotFoundError:
+            return 0
@@ -0,0 +1,136 @@
+import getpass
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from rc.machine import Machine
+from rc.exception import RcException
+
+sshd_provider = sys.modules[__name__]
+
+# sshd listens on at most 16 addresses
+ADDRESSES_PER_SSHD = 16
+
+
+def find_sshd():
+    """Path of the sshd executable, None if it is not installed"""
+    for path in [shutil.which('sshd'), '/usr/sbin/sshd', '/usr/local/sbin/sshd']:
+        if path and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def host_ip(i):
+    # Every 127.x.y.z is local on linux, one address per host gives each its own ssh master
+    return f'127.0.{i // 250 + 1}.{i % 250 + 1}'
+
+
+def _listening(ip, port):
+    try:
+        with socket.create_connection((ip, port), timeout=0.5) as s:
+            return s.recv(4).startswith(b'SSH-')
+    except OSError:
+        return False
+
+
+class LocalSshd:
+    """
+    sshd processes run as the current user for n local hosts, host i listening on
+    host_ip(i):port, so each looks like a separate machine to rc. The keys, config and
+    logs live in a temporary directory, login is only with its own generated key.
+    machines are the Machine of every host.
+    """
+
+    def __init__(self, n, *, port=2222, sshd=None, start_timeout=10):
+        self.n = n
+        self.port = port
+        self.sshd = sshd or find_sshd()
+        self.start_timeout = start_timeout
+        self.directory = None
+        self.machines = []
+        self._processes = []
+
+    def _config(self, ips, k):
+        listen = ''.join(f'ListenAddress {ip}:{self.port}\n' for ip in ips)
+        return f'''{listen}HostKey {self.directory}/host_key
+PidFile {self.directory}/sshd-{k}.pid
+AuthorizedKeysFile {self.directory}/authorized_keys
+PasswordAuthentication no
+PubkeyAuthentication yes
+UsePAM no
+StrictModes no
+MaxStartups 1000:30:2000
+MaxSessions 1000
+LogLevel ERROR
+Subsystem sftp internal-sftp
+'''
+
+    def _keygen(self, path):
+        p = subprocess.run(['ssh-keygen', '-q', '-t', 'ed25519', '-N', '', '-f', path],
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if p.returncode != 0:
+            raise RcException(p.stderr)
+
+    def __enter__(self):
+        if self.sshd is None:
+            raise RcException('sshd is not installed')
+        self.directory = tempfile.mkdtemp(prefix='rc-bench-sshd-')
+        try:
+            self._start()
+        except BaseException:
+            self.__exit__(None, None, None)
+            raise
+        return self
+
+    def _start(self):
+        self._keygen(os.path.join(self.directory, 'host_key'))
+        client_key = os.path.join(self.directory, 'client_key')
+        self._keygen(client_key)
+        shutil.copy(client_key + '.pub', os.path.join(self.directory, 'authorized_keys'))
+        if os.geteuid() == 0:
+            # sshd started as root wants its privilege separation directory
+            os.makedirs('/run/sshd', mode=0o755, exist_ok=True)
+        ips = [host_ip(i) for i in range(self.n)]
+        for k in range(0, self.n, ADDRESSES_PER_SSHD):
+            config = os.path.join(self.directory, f'sshd-{k}.conf')
+            with open(config, 'w') as f:
+                f.write(self._config(ips[k:k + ADDRESSES_PER_SSHD], k))
+            with open(os.path.join(self.directory, f'sshd-{k}.log'), 'w') as log:
+                self._processes.append(subprocess.Popen([self.sshd, '-D', '-e', '-f', config],
+                                                        stdin=subprocess.DEVNULL, stdout=log, stderr=log))
+        deadline = time.monotonic() + self.start_timeout
+        waiting = set(ips)
+        while waiting:
+            waiting = {ip for ip in waiting if not _listening(ip, self.port)}
+            dead = [p for p in self._processes if p.poll() is not None]
+            if dead or (waiting and time.monotonic() > deadline):
+                raise RcException(f'sshd did not start: {self._logs()}')
+            if waiting:
+                time.sleep(0.1)
+        user = getpass.getuser()
+        self.machines = [Machine(provider=sshd_provider, name=f'host{i}', zone='local', ip=ip, port=self.port,
+                                 username=user, ssh_key_path=client_key) for i, ip in enumerate(ips)]
+
+    def _logs(self):
+        logs = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith('.log'):
+                with open(os.path.join(self.directory, name)) as f:
+                    logs.append(f.read().strip())
+        return '\n'.join(log for log in logs if log)
+
+    def __exit__(self, type, value, traceback):
+        for m in self.machines:
+            m.close()
+        for p in self._processes:
+            p.terminate()
+        for p in self._processes:
+            try:
+                p.wait(5)
+            except subprocess.TimeoutExpired:
+                p.kill()
+        self._processes = []
+        shutil.rmtree(self.directory, ignore_errors=True)
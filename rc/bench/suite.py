@@ -0,0 +1,195 @@
+import datetime
+import os
+import platform
+import shutil
+import tempfile
+import time
+from rc.util import pmap, run, run_stream, handle_stream
+from rc.cli import config
+from rc.bench.fakecloud import FakeCloud
+from rc.bench.sshd import LocalSshd, find_sshd
+
+# provider module, its cli and the get arguments of a group default
+PROVIDERS = [('gcloud', 'gcloud', {'project': 'bench'}), ('aws', 'aws', {}),
+             ('digitalocean', 'doctl', {}), ('azure', 'az', {})]
+
+
+def _timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def bench_resolve(ns, *, latency=0.5):
+    """
+    Resolve a group of n machines of every fake cloud: cold with nothing cached, warm from
+    the inventory, and for aws indexed, with the region index but no inventory
+    """
+    results = []
+    with FakeCloud(max(ns), latency=latency) as cloud:
+        for provider, cli, scope in PROVIDERS:
+            for n in ns:
+                default = {'provider': provider, 'username': 'bench', **scope}
+                names = cloud.names(cli, n)
+                cases = [('cold', lambda: cloud.reset()), ('warm', lambda: None)]
+                if provider == 'aws':
+                    cases.append(('indexed', lambda: cloud.reset(index=False)))
+                for case, prepare in cases:
+                    prepare()
+                    calls = cloud.calls()
+                    seconds, machines = _timed(lambda: config.resolve_specs(names, default))
+                    assert [m.name for m in machines] == names
+                    results.append({'bench': 'resolve', 'case': f'{provider} {case}', 'n': n,
+                                    'seconds': seconds, 'cli_calls': cloud.calls() - calls})
+    return results
+
+
+def bench_pmap(ns):
+    """pmap over n items, of a no-op and of a local process each"""
+    results = []
+    for n in ns:
+        seconds, _ = _timed(lambda: pmap(lambda i: i, range(n)))
+        results.append({'bench': 'pmap', 'case': 'noop', 'n': n, 'seconds': seconds})
+        seconds, _ = _timed(lambda: pmap(lambda i: run('true'), range(n)))
+        results.append({'bench': 'pmap', 'case': 'process', 'n': n, 'seconds': seconds})
+    return results
+
+
+def bench_execute(machines, ns):
+    """Run a command on n hosts at once: cold opens the ssh connections, warm reuses them"""
+    results = []
+    for n in ns:
+        group = machines[:n]
+        for m in group:
+            m.close()
+        for case in ['cold', 'warm']:
+            seconds, ps = _timed(lambda: pmap(lambda m: m.run('true'), group))
+            results.append({'bench': 'execute', 'case': case, 'n': n, 'seconds': seconds,
+                            'failed': sum(p.returncode != 0 for p in ps)})
+    return results
+
+
+def bench_transfer(machine, sizes_mb):
+    """Upload and download throughput of write_file, read, and rsync if it is installed"""
+    results = []
+    directory = tempfile.mkdtemp(prefix='rc-bench-transfer-')
+    try:
+        for size in sizes_mb:
+            data = os.urandom(size * 1024 * 1024)
+            remote = os.path.join(directory, f'remote-{size}')
+            cases = [('write_file', lambda: machine.write_file(remote, data)),
+                     ('read', lambda: machine.read(remote, binary=True))]
+            if shutil.which('rsync'):
+                local = os.path.join(directory, f'local-{size}')
+                with open(local, 'wb') as f:
+                    f.write(data)
+                cases += [('rsync up', lambda: machine.upload(local, remote + '-rsync')),
+                          ('rsync down', lambda: machine.download(remote + '-rsync', local + '-down', sudo=False))]
+            for case, func in cases:
+                seconds, _ = _timed(func)
+                results.append({'bench': 'transfer', 'case': case, 'n': size, 'seconds': seconds,
+                                'mb_per_s': size / seconds})
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def bench_stream(lines, machine=None):
+    """Lines per second read from run_stream of a local command, and over ssh if machine"""
+    results = []
+    shells = [('local', ['/bin/sh', '-c'])]
+    if machine is not None:
+        shells.append(('ssh', machine._ssh_shell()))
+    for case, shell in shells:
+        for n in lines:
+            count = []
+
+            def stream():
+                q, _ = run_stream(f'seq {n}', shell=shell)
+                handle_stream(q, stdout_handler=count.append)
+            seconds, _ = _timed(stream)
+            results.append({'bench': 'stream', 'case': case, 'n': n, 'seconds': seconds,
+                            'lines_per_s': len(count) / seconds})
+    return results
+
+
+def run_suite(*, ns=(1, 10, 100, 1000), ssh_ns=(1, 10, 100), latency=0.5, sizes_mb=(1, 16, 64),
+              stream_lines=(1000, 100000), port=2222, benches=('resolve', 'pmap', 'execute', 'transfer', 'stream'),
+              log=print):
+    """Run benches and return the report, benches that need sshd are skipped without it"""
+    results = []
+    skipped = []
+
+    def step(name, func, *args):
+        log(f'{name}...')
+        results.extend(func(*args))
+
+    if 'resolve' in benches:
+        step('resolve', lambda: bench_resolve(ns, latency=latency))
+    if 'pmap' in benches:
+        step('pmap', bench_pmap, ns)
+    ssh_benches = [b for b in ['execute', 'transfer', 'stream'] if b in benches]
+    if ssh_benches and not find_sshd():
+        skipped += [{'bench': b, 'reason': 'sshd is not installed'} for b in ssh_benches if b != 'stream']
+        if 'stream' in benches:
+            step('stream', bench_stream, stream_lines)
+    elif ssh_benches:
+        with LocalSshd(max(ssh_ns), port=port) as sshd:
+            if 'execute' in benches:
+                step('execute', bench_execute, sshd.machines, ssh_ns)
+            if 'transfer' in benches:
+                step('transfer', bench_transfer, sshd.machines[0], sizes_mb)
+            if 'stream' in benches:
+                step('stream', bench_stream, stream_lines, sshd.machines[0])
+    return report(results, skipped, {'ns': list(ns), 'ssh_ns': list(ssh_ns), 'latency': latency,
+                                     'sizes_mb': list(sizes_mb), 'stream_lines': list(stream_lines),
+                                     'benches': list(benches)})
+
+
+def _version():
+    try:
+        from importlib.metadata import version
+        return version('python-rc')
+    except Exception:
+        return None
+
+
+def report(results, skipped, options):
+    return {'rc_version': _version(), 'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'options': options, 'results': results, 'skipped': skipped}
+
+
+def _result_key(r):
+    return (r['bench'], r['case'], r['n'])
+
+
+def compare(old, new):
+    """[(bench, case, n, old seconds, new seconds, new / old)] of results in both reports"""
+    old_results = {_result_key(r): r for r in old['results']}
+    rows = []
+    for r in new['results']:
+        o = old_results.get(_result_key(r))
+        if o is not None:
+            rows.append((*_result_key(r), o['seconds'], r['seconds'],
+                         r['seconds'] / o['seconds'] if o['seconds'] else None))
+    return rows
+
+
+def format_results(report):
+    lines = [f'{"bench":<9} {"case":<20} {"n":>7} {"seconds":>9}  other']
+    for r in report['results']:
+        other = ' '.join(f'{k}={v:.1f}' if isinstance(v, float) else f'{k}={v}' for k, v in r.items()
+                         if k not in ('bench', 'case', 'n', 'seconds'))
+        lines.append(f'{r["bench"]:<9} {r["case"]:<20} {r["n"]:>7} {r["seconds"]:>9.3f}  {other}')
+    for s in report['skipped']:
+        lines.append(f'{s["bench"]:<9} skipped: {s["reason"]}')
+    return '\n'.join(lines)
+
+
+def format_compare(rows):
+    lines = [f'{"bench":<9} {"case":<20} {"n":>7} {"old":>9} {"new":>9} {"new/old":>8}']
+    for bench, case, n, old, new, ratio in rows:
+        ratio = f'{ratio:.2f}' if ratio is not None else '-'
+        lines.append(f'{bench:<9} {case:<20} {n:>7} {old:>9.3f} {new:>9.3f} {ratio:>8}')
+    return '\n'.join(lines)
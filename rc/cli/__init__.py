@@ -1,17 +1,20 @@
 from rc.cli import config
-from rc import run, pmap, p, ep, RunResult, RunException
+from rc import run, pimap, p, ep, RunResult, RunException
 from rc.util import convert_list_command_to_str
 import subprocess
 import os
-import libtmux
 import argparse
-from pytimeparse.timeparse import timeparse
+import time
 from threading import Lock
-import term
-from rc import gcloud, aws, digitalocean, azure
 
 
-def execute(targets, args):
+def execute(targets, args, refresh=None):
+    """
+    Run command in args on targets. refresh returns freshly resolved targets, it is called
+    once if ssh to some cached target fails, to retry on machines whose ip changed.
+    """
+    from pytimeparse.timeparse import timeparse
+    import term
     execute_argparser = argparse.ArgumentParser(
         'execute a command on target of machines')
     execute_argparser.add_argument(
@@ -25,10 +28,21 @@ def execute(targets, args):
     else:
         cmd = args.command
 
-    l = Lock()
     for target in targets:
         print(f'Start executing on {target}')
 
+    refreshed = []
+    refresh_lock = Lock()
+
+    def fresh_target(target):
+        with refresh_lock:
+            if not refreshed:
+                refreshed.append({str(t): t for t in refresh()})
+        fresh = refreshed[0].get(str(target))
+        if fresh is not None and fresh.ip != target.ip:
+            return fresh
+        return None
+
     def exec(i):
         target = targets[i]
         ret = None
@@ -36,6 +50,14 @@ def execute(targets, args):
             log_path = os.path.join(config.logs_dir, str(target))
             log = open(log_path, 'w')
             proc = target.run(cmd, timeout=timeout, stdout=log, stderr=log)
+            if proc.returncode == 255 and refresh:
+                # ssh failed, the cached ip may be outdated
+                fresh = fresh_target(target)
+                if fresh is not None:
+                    log.seek(0)
+                    log.truncate()
+                    proc = fresh.run(cmd, timeout=timeout,
+                                     stdout=log, stderr=log)
             if proc.returncode == 0:
                 output = f'{term.green}SUCCESS{term.off} on {target}'
             else:
@@ -45,22 +67,164 @@ def execute(targets, args):
             output = f'{term.red}FAIL{term.off} on {target}. Timeout'
             ret = e
         output += f'. Log: file://{log_path}'
+        return i, output, ret
+
+    results = []
+    # Report every machine as soon as it finishes, instead of after the slowest one
+    for i, output, ret in pimap(exec, range(len(targets))):
+        term.saveCursor()
+        term.up(len(targets) - i)
+        term.clearLine()
+        term.writeLine(output)
+        term.restoreCursor()
+        results.append(ret)
+    if all(map(lambda r: isinstance(r, RunResult) and r.returncode == 0, results)):
+        term.writeLine('All execution succeeded', term.green)
+        exit(0)
+    else:
+        term.writeLine('Some execution failed', term.red)
+        exit(1)
+
+
+def rsync(args):
+    from rc.sync import sync_progress
+    import term
+    rsync_argparser = argparse.ArgumentParser(
+        'rc rsync', description='upload local src to dst on every machine in group, in parallel')
+    rsync_argparser.add_argument('group')
+    rsync_argparser.add_argument('src')
+    rsync_argparser.add_argument('dst')
+    rsync_argparser.add_argument(
+        '-c', '--concurrency', type=int, default=16, help='max number of transfers at a time')
+    rsync_argparser.add_argument(
+        '--bwlimit', help='bandwidth limit of each transfer, e.g. 10m. See rsync --bwlimit')
+    rsync_argparser.add_argument(
+        '-r', '--retries', type=int, default=2, help='times to retry a failed transfer')
+    rsync_argparser.add_argument(
+        '-z', '--compress', action='store_true', help='compress data during transfer')
+    rsync_argparser.add_argument(
+        '--delete', action='store_true', help='delete extraneous files from dst')
+    rsync_argparser.add_argument(
+        '--exclude', action='append', help='exclude files matching pattern')
+    rsync_argparser.add_argument(
+        '--user', help='write files as this user on machines')
+    args = rsync_argparser.parse_args(args)
+    targets = config.get_targets(args.group)
+    if not targets:
+        ep(f'targets not exist: {args.group}')
+        exit(2)
+
+    for target in targets:
+        print(f'Waiting to rsync to {target}')
+    l = Lock()
+
+    def show(i, output):
         with l:
             term.saveCursor()
             term.up(len(targets) - i)
             term.clearLine()
             term.writeLine(output)
             term.restoreCursor()
-        return ret
-    results = pmap(exec, range(len(targets)))
-    if all(map(lambda r: isinstance(r, RunResult) and r.returncode == 0, results)):
-        term.writeLine('All execution succeeded', term.green)
+
+    def transfer(i):
+        target = targets[i]
+        for attempt in range(args.retries + 1):
+            retry = f' (retry {attempt})' if attempt else ''
+            show(i, f'Rsync to {target}{retry}: starting')
+            report = sync_progress(target, args.src, args.dst, user=args.user, compress=args.compress,
+                                   delete=args.delete, exclude=args.exclude, bwlimit=args.bwlimit,
+                                   on_progress=lambda size, percent, rate, eta: show(
+                                       i, f'Rsync to {target}{retry}: {percent}% {size} bytes {rate} ETA {eta}'))
+            if report.returncode == 0:
+                show(i, f'{term.green}SUCCESS{term.off} on {target}. {len(report.files)} files, '
+                     f'{report.size} bytes in {report.elapsed:.1f}s')
+                return report
+        error = report.result.stderr.strip().split('\n')[-1]
+        show(i, f'{term.red}FAIL{term.off} on {target}. {error}')
+        return report
+
+    reports = list(pimap(transfer, range(len(targets)),
+                         concurrency=args.concurrency))
+    if all(r.returncode == 0 for r in reports):
+        term.writeLine('All rsync succeeded', term.green)
         exit(0)
     else:
-        term.writeLine('Some execution failed', term.red)
+        term.writeLine('Some rsync failed', term.red)
         exit(1)
 
 
+def gather(args):
+    from rc.transfer import gather
+    gather_argparser = argparse.ArgumentParser(
+        'rc gather', description='download remote_path from every machine in group into local_dir/<machine>')
+    gather_argparser.add_argument('group')
+    gather_argparser.add_argument('remote_path')
+    gather_argparser.add_argument('local_dir')
+    gather_argparser.add_argument(
+        '-c', '--concurrency', type=int, default=16, help='max number of downloads at a time')
+    gather_argparser.add_argument(
+        '-z', '--compress', action='store_true', help='compress data during transfer')
+    gather_argparser.add_argument(
+        '--sudo', action='store_true', help='read remote files as root')
+    gather_argparser.add_argument('--no-resume', action='store_true',
+                                  help='download again from machines that completed in previous gather')
+    args = gather_argparser.parse_args(args)
+    targets = config.get_targets(args.group)
+    if not targets:
+        ep(f'targets not exist: {args.group}')
+        exit(2)
+    report = gather(targets, args.remote_path, args.local_dir, concurrency=args.concurrency,
+                    compress=args.compress, sudo=args.sudo, resume=not args.no_resume)
+    p(report.summary())
+    if report.failed:
+        exit(1)
+
+
+def stats(args):
+    from rc import trace
+    stats_argparser = argparse.ArgumentParser(
+        'rc stats', description='show the slowest operations recorded by previous rc runs')
+    stats_argparser.add_argument(
+        '-n', '--top', type=int, default=20, help='number of operations and of single spans to show')
+    stats_argparser.add_argument(
+        '--sort', choices=['total', 'p95', 'max', 'count'], default='total', help='order of operations')
+    stats_argparser.add_argument(
+        '--since', type=float, help='only spans of the last SINCE hours')
+    stats_argparser.add_argument(
+        '--file', default=trace.trace_path, help='json lines file written by rc.trace.export')
+    args = stats_argparser.parse_args(args)
+    spans = trace.read(args.file)
+    if args.since is not None:
+        since = time.time() - args.since * 3600
+        spans = [s for s in spans if s.start >= since]
+    if not spans:
+        p(f'no spans in {args.file}')
+        return
+    p(format_stats(spans, top=args.top, sort=args.sort))
+
+
+def format_stats(spans, *, top=20, sort='total'):
+    from rc import trace
+    histograms = trace.summarize(spans)
+    order = {'total': lambda h: h.total, 'p95': lambda h: h.percentile(95),
+             'max': lambda h: h.max, 'count': lambda h: h.count}[sort]
+    rows = sorted(histograms.items(), key=lambda item: order(item[1]), reverse=True)[:top]
+    width = max(len(key) for key, _ in rows)
+    lines = [f'{"operation":<{width}} {"count":>7} {"errors":>6} {"total":>9} {"mean":>8} {"p50":>8} '
+             f'{"p95":>8} {"max":>8}']
+    for key, h in rows:
+        lines.append(f'{key:<{width}} {h.count:>7} {h.errors:>6} {h.total:>8.2f}s {h.mean:>7.3f}s '
+                     f'{h.percentile(50):>7.3f}s {h.percentile(95):>7.3f}s {h.max:>7.3f}s')
+    lines.append('')
+    lines.append('slowest:')
+    for s in sorted(spans, key=lambda s: s.duration, reverse=True)[:top]:
+        labels = ' '.join(f'{k}={v}' for k, v in s.labels.items() if v is not None)
+        when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(s.start))
+        error = f' {s.error}' if s.error else ''
+        lines.append(f'{s.duration:>8.3f}s {when} {s.name} {labels}{error}')
+    return '\n'.join(lines)
+
+
 def cat(args):
     group_name = args[0]
     group_config_file = config.get(group_name)
@@ -83,10 +247,14 @@ def edit(args):
 
 def rm(args):
     group_name = args[0]
-    os.remove(os.path.join(config.groups_dir, group_name))
+    group_config_file = os.path.join(config.groups_dir, group_name)
+    os.remove(group_config_file)
+    if os.path.exists(config.group_cache_path(group_config_file)):
+        os.remove(config.group_cache_path(group_config_file))
 
 
 def tmux(args):
+    import libtmux
     targets = config.get_targets(args[0])
     if not targets:
         ep(f'targets not exist: {args[0]}')
@@ -1,7 +1,11 @@
 import os
 from rc import run, ok, pmap, p
-import yaml
-import rc
+from rc.exception import RcException
+import importlib
+import json
+import threading
+import time
+from rc.machine import Machine
 
 config_dir = os.path.expanduser('~/.python-rc/')
 groups_dir = os.path.join(config_dir, 'groups')
@@ -28,7 +32,7 @@ def machine_from_spec(spec, default=None):
         default = {}
     provider = get_spec(spec, default, 'provider')
     assert provider
-    provider = getattr(rc.provider, provider)
+    provider = importlib.import_module('rc.provider.' + provider)
     assert provider
     if type(spec) is str:
         machine = provider.get(spec, **default)
@@ -41,7 +45,56 @@ def machine_from_spec(spec, default=None):
         return machine
 
 
-def get_targets(arg):
+def _split_spec(spec, default):
+    if type(spec) is str:
+        name, kwargs = spec, dict(default)
+    else:
+        kwargs = {**default, **spec}
+        name = kwargs.pop('name')
+    kwargs.pop('provider', None)
+    return name, kwargs
+
+
+def resolve_specs(machine_spec, default=None, refresh=False):
+    """
+    Resolve every machine spec of a group with one bulk lookup per provider and distinct
+    provider arguments (e.g. project), instead of one provider.get per machine. With refresh,
+    cached provider listings are dropped first, so machines are looked up again.
+    Raise RcException naming all machines that are not found.
+    """
+    if default is None:
+        default = {}
+    batches = {}
+    for i, spec in enumerate(machine_spec):
+        provider = get_spec(spec, default, 'provider')
+        assert provider
+        name, kwargs = _split_spec(spec, default)
+        key = (provider, json.dumps(kwargs, sort_keys=True, default=str))
+        batches.setdefault(key, (provider, kwargs, []))[2].append((i, name))
+    if refresh:
+        from rc.inventory import inventory
+        for provider in {provider for provider, _ in batches}:
+            inventory.invalidate(provider)
+
+    def resolve(batch):
+        provider, kwargs, items = batch
+        provider_module = importlib.import_module('rc.provider.' + provider)
+        return provider_module.get_many([name for _, name in items], **kwargs)
+
+    batches = list(batches.values())
+    machines = [None] * len(machine_spec)
+    missing = []
+    for (provider, _, items), found in zip(batches, pmap(resolve, batches)):
+        for (i, name), machine in zip(items, found):
+            if machine is None:
+                missing.append(f'{provider}.{name}')
+            machines[i] = machine
+    if missing:
+        raise RcException('Machines not found: ' + ', '.join(missing))
+    return machines
+
+
+def get_targets(arg, refresh=False):
     group_ = arg.split('/')
     group_config_file = get(group_[0])
     if group_config_file:
@@ -50,7 +103,7 @@ def get_targets(arg):
                 sub_machines = group_[1].split(',')
             else:
                 sub_machines = None
-            return parse_config(group_config_file, sub_machines)
+            return parse_config(group_config_file, sub_machines, refresh=refresh)
         except Exception as e:
             print(f'targets: {arg} invalid')
             print(e)
@@ -59,13 +112,69 @@ def get_targets(arg):
         return None
 
 
-def parse_config(config_file, sub_machines=None):
+# Resolved groups are reused for this many seconds, unless the group file changes
+group_cache_ttl = 600
+
+
+def group_cache_path(config_file):
+    """Compiled group snapshot, a hidden file next to the group file"""
+    directory, name = os.path.split(config_file)
+    return os.path.join(directory, f'.{name}.json')
+
+
+def _load_group_cache(config_file):
+    try:
+        with open(group_cache_path(config_file)) as f:
+            cache = json.load(f)
+        if cache['mtime'] != os.path.getmtime(config_file) or time.time() - cache['created'] >= group_cache_ttl:
+            return None
+        return [Machine.from_dict(m) for m in cache['machines']]
+    except (OSError, ValueError, KeyError, ImportError):
+        return None
+
+
+def _save_group_cache(config_file, mtime, machines):
+    # The group still resolves if its snapshot can't be serialized or written, it's just not reused
+    try:
+        data = json.dumps({'mtime': mtime, 'created': time.time(),
+                           'machines': [m.to_dict() for m in machines]})
+    except (TypeError, ValueError):
+        return
+    path = group_cache_path(config_file)
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def resolve_group(config_file, refresh=False):
+    """
+    All machines of group config_file. Reuse the compiled snapshot of the group if the
+    file did not change and the snapshot is younger than group_cache_ttl. With refresh, the
+    snapshot and cached provider listings are skipped, e.g. after a machine's ip changed.
+    """
+    if not refresh:
+        machines = _load_group_cache(config_file)
+        if machines is not None:
+            return machines
+    import yaml
+    mtime = os.path.getmtime(config_file)
     config = yaml.safe_load(open(config_file))
     default = config.get('default', {})
     machine_spec = config.get('machines', None)
     if machine_spec is None:
-        raise "Machines cannot be empty"
-    machines = pmap(lambda ms: machine_from_spec(ms, default), machine_spec)
+        raise RcException("Machines cannot be empty")
+    machines = resolve_specs(machine_spec, default, refresh=refresh)
+    _save_group_cache(config_file, mtime, machines)
+    return machines
+
+
+def parse_config(config_file, sub_machines=None, refresh=False):
+    machines = resolve_group(config_file, refresh=refresh)
     group_machines = {}
     for m in machines:
         group_machines[str(m)] = m
@@ -80,3 +80,13 @@ class MachineRemoveDiskException(RcException):
 
 class PmapException(RcException):
     pass
+
+
+class AgentException(RcException):
+    pass
+
+
+class HttpException(RcException):
+    def __init__(self, status, message):
+        super().__init__(f'HTTP {status}: {message}')
+        self.status = status
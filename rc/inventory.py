@@ -0,0 +1,175 @@
+import json
+import os
+import time
+import threading
+from threading import Lock
+from rc.machine import Machine
+
+inventory_dir = os.path.expanduser('~/.python-rc/inventory')
+
+
+def _provider_name(provider):
+    if isinstance(provider, str):
+        return provider
+    return provider.__name__.split('.')[-1]
+
+
+class _Snapshot:
+    def __init__(self, machines, fetched_at):
+        self.machines = machines
+        self.fetched_at = fetched_at
+        self.index = {}
+        for m in machines:
+            for key in {m.name, getattr(m, 'id', None), m.ip}:
+                if key:
+                    self.index.setdefault(key, []).append(m)
+
+    def find(self, key):
+        found = self.index.get(key, [])
+        if len(found) == 1:
+            return found[0]
+        return None
+
+
+class Inventory:
+    """
+    Cache of provider.list results, one snapshot per (provider, scope), where scope is
+    e.g. a gcloud project. Machines are indexed by name, id and ip, so resolving a group
+    of machines costs one listing per provider and scope instead of one call per machine.
+
+    Snapshots expire after ttl seconds and are persisted under ~/.python-rc/inventory so
+    subsequent processes can reuse them. A lookup miss refetches the snapshot if it is
+    older than miss_refresh seconds, so machines created elsewhere are still found.
+    Providers invalidate their snapshots when they create, delete or restart machines.
+    """
+
+    def __init__(self, *, ttl=300, miss_refresh=5, persist=True, directory=inventory_dir):
+        self.ttl = ttl
+        self.miss_refresh = miss_refresh
+        self.persist = persist
+        self.directory = directory
+        self._snapshots = {}
+        self._lock = Lock()
+        self._fetch_locks = {}
+        # Bumped by invalidate, a fetch started before is not cached
+        self._generation = 0
+
+    def _path(self, provider, scope):
+        return os.path.join(self.directory, f'{provider}-{scope}.json')
+
+    def _fetch_lock(self, key):
+        with self._lock:
+            if key not in self._fetch_locks:
+                self._fetch_locks[key] = Lock()
+            return self._fetch_locks[key]
+
+    def _load(self, provider, scope):
+        if not self.persist:
+            return None
+        try:
+            with open(self._path(provider, scope)) as f:
+                data = json.load(f)
+            return _Snapshot([Machine.from_dict(m) for m in data['machines']], data['fetched_at'])
+        except (OSError, ValueError, KeyError, ImportError):
+            return None
+
+    def _save(self, provider, scope, snapshot):
+        if not self.persist:
+            return
+        # A snapshot that can't be serialized or written is just not persisted
+        try:
+            data = json.dumps({'fetched_at': snapshot.fetched_at,
+                               'machines': [m.to_dict() for m in snapshot.machines]})
+        except (TypeError, ValueError):
+            return
+        path = self._path(provider, scope)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp, 'w') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _snapshot(self, provider, scope, fetch, max_age):
+        key = (provider, scope)
+        with self._fetch_lock(key):
+            snapshot = self._snapshots.get(key)
+            if snapshot is None:
+                snapshot = self._load(provider, scope)
+            if snapshot is None or time.time() - snapshot.fetched_at >= max_age:
+                generation = self._generation
+                snapshot = _Snapshot(fetch(), time.time())
+                with self._lock:
+                    if generation != self._generation:
+                        # Invalidated while fetching, e.g. by a create, the result may miss the change
+                        return snapshot
+                    self._snapshots[key] = snapshot
+                    self._save(provider, scope, snapshot)
+                return snapshot
+            self._snapshots[key] = snapshot
+            return snapshot
+
+    def machines(self, provider, scope, fetch, *, refresh=False):
+        """All machines of provider in scope, fetch() returns them when the snapshot is stale"""
+        snapshot = self._snapshot(_provider_name(provider), scope, fetch,
+                                  0 if refresh else self.ttl)
+        return [m.copy() for m in snapshot.machines]
+
+    def lookup(self, provider, scope, key, fetch):
+        """The only machine of provider in scope whose name, id or ip is key, or None"""
+        provider = _provider_name(provider)
+        snapshot = self._snapshot(provider, scope, fetch, self.ttl)
+        machine = snapshot.find(key)
+        if machine is None and time.time() - snapshot.fetched_at >= self.miss_refresh:
+            snapshot = self._snapshot(provider, scope, fetch, self.miss_refresh)
+            machine = snapshot.find(key)
+        return machine and machine.copy()
+
+    def lookup_many(self, provider, scope, keys, fetch):
+        """lookup of every key with at most one refetch, list of machine or None in order of keys"""
+        provider = _provider_name(provider)
+        snapshot = self._snapshot(provider, scope, fetch, self.ttl)
+        machines = [snapshot.find(k) for k in keys]
+        if any(m is None for m in machines) and time.time() - snapshot.fetched_at >= self.miss_refresh:
+            snapshot = self._snapshot(provider, scope, fetch, self.miss_refresh)
+            machines = [snapshot.find(k) for k in keys]
+        return [m and m.copy() for m in machines]
+
+    def peek(self, provider, scope, keys):
+        """lookup of every key in a snapshot that is not expired, never fetching, None when not there"""
+        provider = _provider_name(provider)
+        key = (provider, scope)
+        with self._fetch_lock(key):
+            snapshot = self._snapshots.get(key) or self._load(provider, scope)
+            if snapshot is None or time.time() - snapshot.fetched_at >= self.ttl:
+                return [None] * len(keys)
+            self._snapshots[key] = snapshot
+        return [m and m.copy() for m in map(snapshot.find, keys)]
+
+    def invalidate(self, provider=None, scope=None):
+        """Drop cached snapshots of provider (all providers if None) and scope (all scopes if None)"""
+        provider = provider and _provider_name(provider)
+        with self._lock:
+            self._generation += 1
+            keys = [k for k in self._snapshots
+                    if (provider is None or k[0] == provider) and (scope is None or k[1] == scope)]
+            for k in keys:
+                del self._snapshots[k]
+        if self.persist and os.path.isdir(self.directory):
+            for f in os.listdir(self.directory):
+                p, _, s = f[:-len('.json')].partition('-')
+                if f.endswith('.json') and (provider is None or p == provider) and (scope is None or s == str(scope)):
+                    try:
+                        os.remove(os.path.join(self.directory, f))
+                    except FileNotFoundError:
+                        pass
+
+
+inventory = Inventory()
+
+
+def invalidate(provider=None, scope=None):
+    inventory.invalidate(provider, scope)
@@ -0,0 +1,140 @@
+import datetime
+import uuid
+from collections import namedtuple
+from rc.util import pmap
+from rc.exception import RunException
+from rc.machine import as_user, write_file_cmd
+
+jobs_dir = '/tmp/python-rc/jobs'
+# Points to the pid file of the latest job started with its own pid file, killed by default by Machine.kill_bg
+latest_pid = '/tmp/python-rc.pid'
+
+# state is running, exited, or lost when the process is gone without writing an exit code
+JobStatus = namedtuple('JobStatus', ['id', 'state', 'pid', 'exitcode'])
+
+
+def new_id():
+    return datetime.datetime.strftime(datetime.datetime.utcnow(), '%Y%m%d_%H%M%S') + '-' + uuid.uuid4().hex[:6]
+
+
+def status_cmd(ids=None):
+    """Remote command printing id, state, pid and exit code of jobs ids, or of all jobs"""
+    names = ' '.join(ids) if ids else '*'
+    return f'''cd {jobs_dir} 2>/dev/null || exit 0
+for d in {names}; do
+    [ -d "$d" ] || continue
+    pid=$(cat "$d/pid" 2>/dev/null); ec=$(cat "$d/exitcode" 2>/dev/null)
+    if [ -n "$ec" ]; then s=exited; elif [ -n "$pid" ] && [ -d /proc/$pid ]; then s=running; else s=lost; fi
+    echo "$d $s ${{pid:--}} ${{ec:--}}"
+done'''
+
+
+def parse_status(stdout):
+    statuses = {}
+    for line in stdout.split('\n'):
+        if not line:
+            continue
+        id, state, pid, exitcode = line.split(' ')
+        statuses[id] = JobStatus(id, state, None if pid == '-' else int(pid),
+                                 None if exitcode == '-' else int(exitcode))
+    return statuses
+
+
+class Job:
+    """
+    A background job on a machine, started by Machine.run_bg. Every job has its own
+    directory {jobs_dir}/<id> on the machine holding its script, stdout, stderr, pid and
+    exit code, and a lock file held for as long as the job runs, so waiting for a job
+    blocks on the lock on the machine instead of polling.
+    """
+
+    def __init__(self, machine, id, *, user=None, stdout=None, stderr=None, pid=None, exitcode=None):
+        self.machine = machine
+        self.id = id
+        self.user = user
+        self.dir = f'{jobs_dir}/{id}'
+        self.stdout = stdout or f'{self.dir}/stdout'
+        self.stderr = stderr or f'{self.dir}/stderr'
+        self.pid_file = pid or f'{self.dir}/pid'
+        self.exitcode_file = exitcode or f'{self.dir}/exitcode'
+        self.started = None
+
+    def __repr__(self):
+        return f'Job(machine={self.machine}, id={self.id})'
+
+    def start_cmd(self, cmd='bash'):
+        """Remote command that saves its stdin as the job script and starts it in background"""
+        script = f'{self.dir}/script'
+        links = ''
+        if self.pid_file != f'{self.dir}/pid':
+            # Custom pid and exit code files, keep the job table in sync through symlinks
+            links += f'ln -sf {self.pid_file} {self.dir}/pid && '
+        else:
+            # Best effort, the pointer may belong to another user
+            links += f'{{ ln -sfn {self.pid_file} {latest_pid} 2>/dev/null || true; }} && '
+        if self.exitcode_file != f'{self.dir}/exitcode':
+            # A shared exit code file may still hold the exit code of an earlier job
+            links += f'rm -f {self.exitcode_file} && ln -sf {self.exitcode_file} {self.dir}/exitcode && '
+        # The lock is taken before returning, and inherited by the background subshell until the
+        # exit code is written. setsid makes pid a process group, so kill reaches its children.
+        start = f'mkdir {self.dir} && {write_file_cmd(script)} && {links}exec 9>{self.dir}/lock && flock 9 && ' \
+            f'{{ ( setsid {cmd} {script} >>{self.stdout} 2>>{self.stderr} 9>&- & echo $! > {self.pid_file}; ' \
+            f'wait $!; echo $? > {self.exitcode_file} ) </dev/null >/dev/null 2>&1 & }}'
+        return f'mkdir -p {jobs_dir} 2>/dev/null; chmod 1777 /tmp/python-rc {jobs_dir} 2>/dev/null; ' \
+            + as_user(start, self.user)
+
+    def status(self):
+        p = self.machine.run(status_cmd([self.id]))
+        if p.returncode != 0:
+            raise RunException(p.stderr)
+        return parse_status(p.stdout).get(self.id, JobStatus(self.id, 'lost', None, None))
+
+    def wait(self, timeout=None):
+        """Wait for job to finish on the machine and return its exit code, None if it was lost"""
+        wait = f'-w {timeout} ' if timeout is not None else ''
+        p = self.machine.run(f'flock {wait}-s {self.dir}/lock true && cat {self.exitcode_file}')
+        if p.returncode != 0:
+            if timeout is not None and p.returncode == 1 and not p.stderr:
+                raise RunException(f'{self} did not finish in {timeout} seconds')
+            if 'No such file' in p.stderr and self.status().state == 'lost':
+                return None
+            raise RunException(p.stderr)
+        return int(p.stdout)
+
+    def tail(self, n=10, *, stderr=False):
+        """Last n lines of stdout, or stderr, of job"""
+        p = self.machine.run(
+            f'tail -n {n} {self.stderr if stderr else self.stdout}')
+        if p.returncode != 0:
+            raise RunException(p.stderr)
+        return p.stdout
+
+    def kill(self, signal='TERM', timeout=None):
+        """Signal the job's process group and wait until it exits, return its exit code"""
+        wait = f'-w {timeout} ' if timeout is not None else ''
+        p = self.machine.run(as_user(f'pid=$(cat {self.pid_file}) && {{ kill -{signal} -- -$pid 2>/dev/null || '
+                                     f'kill -{signal} $pid; }}; flock {wait}-s {self.dir}/lock true; '
+                                     f'cat {self.exitcode_file} 2>/dev/null', self.user))
+        if p.returncode != 0:
+            raise RunException(p.stderr)
+        return int(p.stdout) if p.stdout.strip() else None
+
+
+def jobs(machine):
+    """{Job: JobStatus} of every job on machine, oldest first, in one command"""
+    p = machine.run(status_cmd())
+    if p.returncode != 0:
+        raise RunException(p.stderr)
+    return {Job(machine, id): status for id, status in sorted(parse_status(p.stdout).items())}
+
+
+def statuses(jobs):
+    """{job: JobStatus} of jobs on any machines, one command per machine run in parallel"""
+    by_machine = {}
+    for job in jobs:
+        by_machine.setdefault(id(job.machine), []).append(job)
+    groups = list(by_machine.values())
+    results = pmap(lambda group: parse_status(group[0].machine.run(status_cmd([j.id for j in group])).stdout),
+                   groups)
+    return {job: result.get(job.id, JobStatus(job.id, 'lost', None, None))
+            for group, result in zip(groups, results) for job in group}
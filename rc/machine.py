@@ -1,11 +1,132 @@
-from rc.exception import UploadException, DownloadException, MachineNotReadyException
+from rc.exception import UploadException, DownloadException, AgentException
 from io import StringIO
-from rc.util import run, run_stream, convert_list_command_to_str, \
+from rc.util import RunResult, run, run_stream, run_chunks, convert_list_command_to_str, \
     bash, sudo, python, python2, python3, running, kill, ok
-from retry import retry
-import datetime
+from rc.ssh import pool
+from rc import trace
+import hashlib
+import importlib
 import os
+import shlex
 import subprocess
+import time
+import zlib
+from threading import Lock
+
+WRITE_CHUNK_SIZE = 64 * 1024
+# Returned by Machine._agent_call when the call must be done without the agent
+NO_AGENT = object()
+
+# Identifies a version of a remote file: inode, size and mtime in nanoseconds
+STAT_CMD = "stat -c '%i %s %y'"
+
+
+def iter_chunks(data, chunk_size=WRITE_CHUNK_SIZE):
+    """Bytes chunks of data, which is bytes, str (encoded as utf-8) or a file-like object"""
+    if isinstance(data, str):
+        data = data.encode()
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        view = memoryview(data)
+        for i in range(0, len(view), chunk_size):
+            yield view[i:i + chunk_size]
+        return
+    while True:
+        chunk = data.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk.encode() if isinstance(chunk, str) else chunk
+
+
+def gzip_chunks(chunks):
+    """Compress chunks to a gzip stream, which gunzip can decompress on the machine"""
+    c = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        out = c.compress(chunk)
+        if out:
+            yield out
+    yield c.flush()
+
+
+def as_user(script, user=None):
+    if user:
+        return f'sudo -H -u {user} sh -c {shlex.quote(script)}'
+    return script
+
+
+def write_file_cmd(path, *, compressed=False, atomic=True, append=False, mode=None, user=None):
+    """Remote command that writes its stdin to path, see Machine.write_file"""
+    decode = 'gunzip -c' if compressed else 'cat'
+    chmod = f'chmod {mode} "$tmp" && ' if mode else ''
+    if append:
+        script = f'{decode} >> {path}'
+        if mode:
+            script += f' && chmod {mode} {path}'
+    elif atomic:
+        # Write to a temporary file next to path, keep permission of an existing path, then rename
+        script = f'tmp={path}.rc-tmp.$$; {decode} > "$tmp" && ' \
+            f'{{ [ ! -e {path} ] || chmod --reference={path} "$tmp"; }} && {chmod}' \
+            f'mv -f "$tmp" {path} || {{ rm -f "$tmp"; exit 1; }}'
+    else:
+        script = f'{decode} > {path}'
+        if mode:
+            script += f' && chmod {mode} {path}'
+    return as_user(script, user)
+
+
+def ensure_file_cmd(path, digest, *, compressed=False, mode=None, user=None):
+    """
+    Remote command that replaces path with its stdin unless sha256 of path is already
+    digest, then prints changed or unchanged and the STAT_CMD line of path
+    """
+    write = write_file_cmd(path, compressed=compressed)
+    chmod = f'chmod {mode} {path} && ' if mode else ''
+    script = f"have=$(sha256sum < {path} 2>/dev/null | cut -d' ' -f1); " \
+        f'if [ "$have" = {digest} ]; then cat > /dev/null; echo unchanged; ' \
+        f'else {write} && echo changed; fi && {chmod}{STAT_CMD} {path}'
+    return as_user(script, user)
+
+
+def ensure_lines_cmd(path, lines, *, user=None):
+    """
+    Remote command that appends every line of lines missing from path, then prints
+    changed or unchanged and the STAT_CMD line of path
+    """
+    script = [f'f={path}', 'changed=unchanged',
+              'ensure() { grep -Fxq -e "$1" "$f" 2>/dev/null && return; '
+              'if [ -s "$f" ] && [ -n "$(tail -c1 "$f")" ]; then echo >> "$f"; fi; '
+              'printf "%s\\n" "$1" >> "$f" && changed=changed; }']
+    script += [f'ensure {shlex.quote(line)}' for line in lines]
+    script += ['echo $changed', f'{STAT_CMD} "$f"']
+    return as_user('\n'.join(script), user)
+
+
+def ensure_dir_script(path, allow_write=True):
+    cmd = f'mkdir -p {path}'
+    if allow_write:
+        cmd += f'\nchmod a+w {path}'
+    return cmd
+
+
+def ensure_user_script(username, *, sudo=True, pubkey=None):
+    add_sudo = ''
+    if sudo:
+        add_sudo = f'echo "{username}  ALL=(ALL) NOPASSWD:ALL" > /etc/sudoers.d/{username}'
+    add_pubkey = ''
+    if username == 'root':
+        ssh_path = '/root/.ssh'
+    else:
+        ssh_path = f'/home/{username}/.ssh'
+    if pubkey:
+        add_pubkey = f'''sudo -u {username} mkdir -p {ssh_path}
+        if ! $(grep -Fxq '{pubkey}' {ssh_path}/authorized_keys); then
+            sudo -u {username} echo "{pubkey}" >> {ssh_path}/authorized_keys
+        fi
+        '''
+    return f'''
+    useradd {username} --create-home --shell /bin/bash || true
+    {add_sudo}
+    {add_pubkey}
+    '''
 
 
 class Machine:
@@ -17,6 +138,13 @@ class Machine:
         self.ssh_key_path = os.path.expanduser(ssh_key_path)
         for k, v in kwargs.items():
             setattr(self, k, v)
+        # (user, path) or (user, path, lines digest) -> (STAT_CMD line, sha256) of files known on machine
+        self._file_cache = {}
+        self._agent_options = None
+        self._agent_client = None
+        self._agent_failed = 0
+        # Held while connecting the agent, concurrent calls go over plain ssh meanwhile
+        self._agent_connecting = Lock()
 
     def __eq__(self, other):
         return (self.provider, self.name, self.zone, self.ip, self.username, self.ssh_key_path) == (other.provider, other.name, other.zone, other.ip, other.username, other.ssh_key_path)
@@ -33,6 +161,24 @@ class Machine:
     def __str__(self):
         return f"{self.provider.__name__.split('.')[-1]}." + self.name
 
+    def to_dict(self):
+        """Plain dict of machine fields that can be saved as json, provider saved as its module name"""
+        d = {k: v for k, v in vars(self).items() if not k.startswith('_')}
+        d['provider'] = self.provider.__name__.split('.')[-1]
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        provider = d['provider']
+        if isinstance(provider, str):
+            provider = importlib.import_module('rc.provider.' + provider)
+        return cls(**{**d, 'provider': provider})
+
+    def copy(self, **kwargs):
+        """A new Machine with same fields, except those in kwargs"""
+        fields = {k: v for k, v in vars(self).items() if not k.startswith('_')}
+        return type(self)(**{**fields, **kwargs})
+
     def status(self):
         return self.provider.status(self)
 
@@ -48,86 +194,206 @@ class Machine:
     def change_type(self):
         return self.provider.change_type(self)
 
-    def upload(self, local_path, machine_path, switch_user=None, su=None, user=None):
-        user = user or su or switch_user
-        if user:
-            rsync = f'''--rsync-path='sudo -u {user} rsync' '''
-        else:
-            rsync = ''
-
-        p = run(f'''
-rsync -e 'ssh -o StrictHostKeyChecking=no -i {self.ssh_key_path}' -r \
-    {rsync} --progress {local_path} {self.username}@{self.ip}:{machine_path}
-''')
-        if p.returncode != 0:
-            raise UploadException(p.stderr)
-        return p
+    def upload(self, local_path, machine_path, switch_user=None, su=None, user=None, **options):
+        """
+        rsync local_path to machine_path. options: compress, checksum, delete, partial, include,
+        exclude, bwlimit, archive, see rc.sync.rsync_command. Use sync for a structured report
+        """
+        report = self.sync(local_path, machine_path,
+                           user=user or su or switch_user, **options)
+        if report.returncode != 0:
+            raise UploadException(report.result.stderr)
+        return report.result
+
+    def download(self, machine_path, local_path, sudo=True, **options):
+        report = self.sync(machine_path, local_path, direction='down',
+                           user='root' if sudo else None, **options)
+        if report.returncode != 0:
+            raise DownloadException(report.result.stderr)
+        return report.result
+
+    def sync(self, src, dst, *, direction='up', user=None, **options):
+        """rsync between local and this machine and return a rc.sync.SyncReport of transferred files"""
+        from rc import sync
+        return sync.sync(self, src, dst, direction=direction, user=user, **options)
+
+    def _ssh_command(self, multiplex=True):
+        # port is optional, e.g. Machine(..., port=2222) for sshd on another port
+        return ['ssh', '-o', 'StrictHostKeyChecking=no',
+                *(['-i', self.ssh_key_path] if self.ssh_key_path else []),
+                *(['-p', str(self.port)] if getattr(self, 'port', None) else []),
+                *(pool.options(self) if multiplex else [])]
 
-    def download(self, machine_path, local_path, sudo=True):
-        if sudo:
-            rsync = '''--rsync-path='sudo rsync' '''
-        else:
-            rsync = ''
-        p = run(f'''
-rsync -e 'ssh -o StrictHostKeyChecking=no -i {self.ssh_key_path}' -r \
-    {rsync} --progress {self.username}@{self.ip}:{machine_path} {local_path}
-''')
-        if p.returncode != 0:
-            raise DownloadException(p.stderr)
-        return p
+    def _ssh_command_str(self):
+        return ' '.join(self._ssh_command())
 
     def _ssh_shell(self):
-        return ['ssh', '-o', 'StrictHostKeyChecking=no',
-                *(['-i', self.ssh_key_path] if self.ssh_key_path else []), self.username + '@' + self.ip, '--']
+        return [*self._ssh_command(), self.username + '@' + self.ip, '--']
 
     def ssh_shell_str(self):
-        return ' '.join(self._ssh_shell()[:-1])
+        # Run elsewhere, e.g. in tmux panes, that outlive this process and its ssh masters
+        return ' '.join([*self._ssh_command(multiplex=False), self.username + '@' + self.ip])
+
+    def close(self):
+        """Close the agent and multiplexed ssh connection to this machine, if there are"""
+        self._close_agent()
+        pool.close(self)
+
+    # After the agent fails to start, use plain ssh for this many seconds before trying again
+    agent_retry_after = 60
+
+    def use_agent(self, enabled=True, *, python_path='python3', directory='~/.python-rc'):
+        """
+        Run commands through a persistent rc.agent on the machine instead of a new remote
+        shell per command. run, read, write_file (without user) and python with the agent's
+        python_path then go through the agent, and fall back to plain ssh whenever the agent
+        is unavailable.
+        """
+        if enabled:
+            self._agent_options = {'python_path': python_path, 'directory': directory}
+        else:
+            self._agent_options = None
+            self._close_agent()
+
+    def _close_agent(self):
+        if self._agent_client is not None:
+            self._agent_client.close()
+            self._agent_client = None
+
+    def _agent(self):
+        if not self._agent_options:
+            return None
+        if self._agent_client is not None and self._agent_client.alive:
+            return self._agent_client
+        # Until connected, calls including those that install the agent go over plain ssh
+        if time.time() - self._agent_failed < self.agent_retry_after or \
+                not self._agent_connecting.acquire(blocking=False):
+            return None
+        from rc import agent
+        try:
+            # Connected by another call while this one was getting the lock
+            if self._agent_client is not None and self._agent_client.alive:
+                return self._agent_client
+            self._close_agent()
+            self._agent_client = agent.connect(self, **self._agent_options)
+        except AgentException:
+            self._agent_failed = time.time()
+            return None
+        finally:
+            self._agent_connecting.release()
+        self._agent_failed = 0
+        return self._agent_client
+
+    def _agent_call(self, method, *args, **kwargs):
+        """Result of a call on the agent, or NO_AGENT if it must be done over plain ssh"""
+        client = self._agent()
+        if client is None:
+            return NO_AGENT
+        try:
+            return getattr(client, method)(*args, **kwargs)
+        except AgentException as e:
+            if not e.args[0].startswith('agent is not running'):
+                raise
+            self._close_agent()
+            return NO_AGENT
+
+    def _checked(self, p):
+        if p.returncode == 255:
+            # ssh failed, possibly because the master died. Drop it so the next command reconnects
+            pool.check(self)
+        return p
 
     def running(self, cmd, *, input=None):
         return running(cmd, shell=self._ssh_shell(), input=input)
 
     def run(self, cmd, *, timeout=None, input=None, stdout=subprocess.PIPE, stderr=subprocess.PIPE):
-        return run(cmd, shell=self._ssh_shell(), timeout=timeout, input=input, stdout=stdout, stderr=stderr)
+        if stdout == subprocess.PIPE and stderr == subprocess.PIPE:
+            p = self._agent_call('run', cmd, input=input, timeout=timeout)
+            if p is not NO_AGENT:
+                return p
+        return self._checked(run(cmd, shell=self._ssh_shell(), timeout=timeout,
+                                 input=input, stdout=stdout, stderr=stderr))
 
     def run_stream(self, cmd, input=None):
         return run_stream(cmd, shell=self._ssh_shell(), input=input)
 
+    async def _assh_shell(self):
+        import asyncio
+        # Starting a ssh master blocks, keep it off the event loop
+        return await asyncio.get_event_loop().run_in_executor(None, self._ssh_shell)
+
+    async def arun(self, cmd, *, timeout=None, input=None):
+        from rc import aio
+        return await aio.arun(cmd, shell=await self._assh_shell(), timeout=timeout, input=input)
+
+    async def arun_stream(self, cmd, *, input=None):
+        from rc import aio
+        async for event in aio.arun_stream(cmd, shell=await self._assh_shell(), input=input):
+            yield event
+
     def sudo(self, script, *, shell=None, user='root', timeout=None, flag='set -euo pipefail', stdout=subprocess.PIPE, stderr=subprocess.PIPE):
-        return sudo(script, shell=shell, user=user, timeout=timeout, flag=flag,
-                    run_shell=self._ssh_shell(), stdout=stdout, stderr=stderr)
+        return self._checked(sudo(script, shell=shell, user=user, timeout=timeout, flag=flag,
+                                  run_shell=self._ssh_shell(), stdout=stdout, stderr=stderr))
 
     def bash(self, script, *, timeout=None, flag='set -euo pipefail', login=False, interactive=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE):
-        return bash(script, timeout=timeout, login=login, interactive=interactive, flag=flag,
-                    run_shell=self._ssh_shell(), stdout=stdout, stderr=stderr)
-
-    def run_bg(self, script, *, cmd='bash', stdout='/tmp/python-rc.log', stderr='/tmp/python-rc.log', exitcode='/tmp/python-rc.exitcode', pid='/tmp/python-rc.pid', user=None):
-        ts = datetime.datetime.strftime(
-            datetime.datetime.utcnow(), '%Y%m%d_%H%M%S')
-        ok(self.ensure_dir(f'/tmp/python-rc'))
-        ok(self.edit(f'/tmp/python-rc/script_{ts}', script, user=user))
-        run_cmd = f'( {cmd} /tmp/python-rc/script_{ts} >>{stdout} 2>>{stderr} & echo -n $! > {pid}; wait $!; echo -n $? >{exitcode}) </dev/null >/dev/null 2>/dev/null &'
-        if user:
-            p = ok(self.sudo(run_cmd, user=user))
-        else:
-            p = ok(self.run(run_cmd))
-        print(p.stdout)
-
-    def kill_bg(self, pid='/tmp/python-rc.pid', signal='TERM', timeout=None):
+        return self._checked(bash(script, timeout=timeout, login=login, interactive=interactive, flag=flag,
+                                  run_shell=self._ssh_shell(), stdout=stdout, stderr=stderr))
+
+    def batch(self, **options):
+        """
+        Context that queues operations and runs them all in one ssh session when it exits,
+        see rc.batch.Batch
+        """
+        from rc.batch import Batch
+        return Batch(self, **options)
+
+    def run_bg(self, script, *, cmd='bash', stdout=None, stderr=None, exitcode=None, pid=None, user=None):
+        """
+        Start script with cmd in background, detached from ssh, and return a rc.job.Job.
+        Output, pid and exit code go to the job's own directory on the machine, or to the
+        given paths. Jobs sharing a pid or exit code file only keep the status of the latest one
+        """
+        from rc.job import Job, new_id
+        job = Job(self, new_id(), user=user, stdout=stdout,
+                  stderr=stderr, pid=pid, exitcode=exitcode)
+        job.started = ok(self.run(job.start_cmd(cmd), input=script + '\n'))
+        return job
+
+    def jobs(self):
+        """{rc.job.Job: rc.job.JobStatus} of every background job on machine"""
+        from rc import job
+        return job.jobs(self)
+
+    def kill_bg(self, pid=None, signal='TERM', timeout=None):
+        """
+        Kill a background job, given by its pid file or a rc.job.Job, and wait until it exits.
+        By default the latest job started by run_bg with its own pid file
+        """
+        from rc import job
+        if pid is None:
+            pid = job.latest_pid
+        if not isinstance(pid, str):
+            return pid.kill(signal=signal, timeout=timeout)
         return self.sudo(f'''
         /bin/kill -{signal} -$(cat {pid})
-        while /bin/kill -0 -$(cat {pid}); do
-            sleep 1
-        done
+        tail --pid=$(cat {pid}) -s 0.2 -f /dev/null
         ''', timeout=timeout)
 
     def python(self, script, *, timeout=None, python_path='python', user=None, stdout=subprocess.PIPE, stderr=subprocess.PIPE):
-        return python(script, timeout=timeout, python_path=python_path, user=user, run_shell=self._ssh_shell(), stdout=stdout, stderr=stderr)
+        # Only scripts for the interpreter the agent runs go through it, python may well be python2
+        if not user and not timeout and self._agent_options and python_path == self._agent_options['python_path'] \
+                and stdout == subprocess.PIPE and stderr == subprocess.PIPE:
+            p = self._agent_call('python', script)
+            if p is not NO_AGENT:
+                return p
+        return self._checked(python(script, timeout=timeout, python_path=python_path, user=user,
+                                    run_shell=self._ssh_shell(), stdout=stdout, stderr=stderr))
 
     def python2(self, script, **kwargs):
-        return python2(script, run_shell=self._ssh_shell(), **kwargs)
+        return self._checked(python2(script, run_shell=self._ssh_shell(), **kwargs))
 
     def python3(self, script, **kwargs):
-        return python3(script, run_shell=self._ssh_shell(), **kwargs)
+        return self._checked(python3(script, run_shell=self._ssh_shell(), **kwargs))
 
     def run_detach_tmux(self, cmd: str, *, name='python-rc', log='/tmp/python-rc.log'):
         return self.run(f"tmux new -s {name} -d '{cmd}' \\; pipe-pane 'cat > {log}'")
@@ -138,68 +404,139 @@ rsync -e 'ssh -o StrictHostKeyChecking=no -i {self.ssh_key_path}' -r \
     def save_image(self, image, **kwargs):
         return self.provider.save_image(self, image, **kwargs)
 
-    @retry(MachineNotReadyException)
-    def wait_ssh(self):
-        p = self.run('echo a')
-        if p.returncode != 0:
-            raise MachineNotReadyException(p.stderr)
+    def wait_ssh(self, timeout=300, **options):
+        """
+        Wait until machine accepts ssh, with rc.ready.wait_ready, see rc.ready.await_ready
+        for options. Coroutines should await rc.ready.await_ready instead, this blocks their
+        event loop while waiting
+        """
+        from rc import ready
+        return ready.wait_ready(self, timeout=timeout, **options)
 
     def firewalls(self):
         return self.provider.machine_firewalls(self)
 
+    def _pubkey(self):
+        return run(f'ssh-keygen -y -f {self.ssh_key_path}').stdout.strip()
+
     def ensure_user(self, username, *, sudo=True, pubkey=True):
-        add_sudo = ''
-        if sudo:
-            add_sudo = f'echo "{username}  ALL=(ALL) NOPASSWD:ALL" > /etc/sudoers.d/{username}'
-        add_pubkey = ''
-        if username == 'root':
-            ssh_path = '/root/.ssh'
-        else:
-            ssh_path = f'/home/{username}/.ssh'
         if pubkey is True:
-            pubkey = run(
-                f'ssh-keygen -y -f {self.ssh_key_path}').stdout.strip()
-        if pubkey:
-            add_pubkey = f'''sudo -u {username} mkdir -p {ssh_path}
-            if ! $(grep -Fxq '{pubkey}' {ssh_path}/authorized_keys); then
-                sudo -u {username} echo "{pubkey}" >> {ssh_path}/authorized_keys
-            fi
-            '''
-        cmd = f'''
-        useradd {username} --create-home --shell /bin/bash || true
-        {add_sudo}
-        {add_pubkey}
-        '''
-        p = self.sudo(cmd)
-        return p
+            pubkey = self._pubkey()
+        return self.sudo(ensure_user_script(username, sudo=sudo, pubkey=pubkey))
+
+    def write_file(self, path, data, *, user=None, compress=False, compressed=False, atomic=True, append=False,
+                   mode=None, timeout=None, chunk_size=WRITE_CHUNK_SIZE):
+        """
+        Write data (bytes, str or a file-like object) to path on machine. Data is streamed
+        over ssh stdin in chunks, so it can be binary and of any size. With compress, data is
+        gzipped locally and gunzipped on machine; compressed means data is already gzipped.
+        Unless append, the file is written to a temporary file and renamed over path, so
+        readers never see a partial file. mode is passed to chmod, user writes with sudo -u.
+        """
+        self._forget(path)
+        if not user and not compressed and atomic and isinstance(data, (bytes, str)):
+            try:
+                if self._agent_call('write', path, data, mode=mode, append=append) is not NO_AGENT:
+                    return RunResult(stdout='', stderr='', returncode=0)
+            except AgentException as e:
+                return RunResult(stdout='', stderr=e.args[0], returncode=1)
+        chunks = iter_chunks(data, chunk_size)
+        if compress:
+            chunks = gzip_chunks(chunks)
+        cmd = write_file_cmd(path, compressed=compress or compressed, atomic=atomic, append=append,
+                             mode=mode, user=user)
+        return self._checked(run_chunks(cmd, chunks, shell=self._ssh_shell(), timeout=timeout))
 
     def edit(self, path, content, append=False, user=None):
-        if append:
-            op = '>>'
-        else:
-            op = '>'
-        cmd = f"""cat {op} {path} <<'c7a88caeb23f4ac0f377c59b703fb7f1091d0708'
-{content}
-c7a88caeb23f4ac0f377c59b703fb7f1091d0708"""
-        if user:
-            return self.sudo(cmd, user=user)
-        else:
-            return self.bash(cmd)
+        # Written in place like a shell redirect, keeps symlinks, owner and group of path
+        return self.write_file(path, content + '\n', append=append, user=user, atomic=False)
+
+    def _forget(self, path):
+        for key in [key for key in self._file_cache if key[1] == path]:
+            del self._file_cache[key]
+
+    def _unchanged_since(self, key, user):
+        """Whether file of a cache entry has the same inode, size and mtime as when it was cached"""
+        path = key[1]
+        p = self.run(as_user(f'{STAT_CMD} {path}', user))
+        if p.returncode == 0 and p.stdout.strip() == self._file_cache[key][0]:
+            return True
+        self._forget(path)
+        return False
+
+    def read(self, path, *, user=None, binary=False):
+        """Content of path on machine, as str or as bytes if binary"""
+        if not user:
+            try:
+                data = self._agent_call('read', path)
+            except AgentException as e:
+                raise DownloadException(e.args[0]) from None
+            if data is not NO_AGENT:
+                return data if binary else data.decode()
+        p = run(as_user(f'{STAT_CMD} {path} && cat {path}', user),
+                shell=self._ssh_shell(), text=False)
+        if p.returncode != 0:
+            raise DownloadException(p.stderr.decode(errors='replace'))
+        stat, _, data = p.stdout.partition(b'\n')
+        self._file_cache[(user, path)] = (stat.decode(), hashlib.sha256(data).hexdigest())
+        return data if binary else data.decode()
+
+    def ensure_file(self, path, content, *, user=None, mode=None, compress=False):
+        """
+        Make path on machine have content (bytes, str or a file-like object) and mode. The
+        file is only rewritten when its sha256 differs. Remote file versions are cached per
+        machine, so ensuring a file that did not change since it was last ensured or read
+        only stats it without sending content. Return whether the file was changed.
+        """
+        data = b''.join(iter_chunks(content))
+        digest = hashlib.sha256(data).hexdigest()
+        key = (user, path)
+        cached = self._file_cache.get(key)
+        if not mode and cached and cached[1] == digest and self._unchanged_since(key, user):
+            return False
+        chunks = iter_chunks(data)
+        if compress:
+            chunks = gzip_chunks(chunks)
+        p = run_chunks(ensure_file_cmd(path, digest, compressed=compress, mode=mode, user=user), chunks,
+                       shell=self._ssh_shell())
+        if p.returncode != 0:
+            self._forget(path)
+            raise UploadException(p.stderr)
+        state, stat = p.stdout.split('\n')[:2]
+        self._forget(path)
+        self._file_cache[key] = (stat, digest)
+        return state == 'changed'
 
     def ensure_lines(self, path, lines, user=None):
-        pass
-
-    def read(self, path):
-        pass
-
-    def ensure_file(self):
-        pass
+        """
+        Append every line of lines (a list, or a str of lines) that path on machine does not
+        have yet. Return whether the file was changed.
+        """
+        if isinstance(lines, str):
+            lines = lines.splitlines()
+        key = (user, path, hashlib.sha256('\n'.join(lines).encode()).hexdigest())
+        if key in self._file_cache and self._unchanged_since(key, user):
+            return False
+        p = self.run(ensure_lines_cmd(path, lines, user=user))
+        if p.returncode != 0:
+            self._forget(path)
+            raise UploadException(p.stderr)
+        state, stat = p.stdout.split('\n')[:2]
+        self._forget(path)
+        self._file_cache[key] = (stat, None)
+        return state == 'changed'
 
     def ensure_dir(self, path, user=None, allow_write=True):
-        cmd = f'mkdir -p {path}'
-        if allow_write:
-            cmd += f'\nchmod a+w {path}'
+        cmd = ensure_dir_script(path, allow_write=allow_write)
         if user:
             return self.sudo(cmd, user=user)
         else:
             return self.bash(cmd)
+
+
+def _span_labels(machine, *args, **kwargs):
+    provider = machine.provider
+    return {'provider': provider.__name__.split('.')[-1] if provider else None, 'machine': machine.name}
+
+
+trace.instrument_class(Machine, _span_labels, exclude=('to_dict', 'copy', 'ssh_shell_str'))
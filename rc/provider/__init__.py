@@ -0,0 +1,11 @@
+import importlib
+
+_providers = ['gcloud', 'azure', 'digitalocean', 'aws',
+              'kubernetes', 'openstack', 'vagrant']
+
+
+def __getattr__(name):
+    # Provider modules are imported on first use, e.g. getattr(rc.provider, 'gcloud')
+    if name in _providers:
+        return importlib.import_module('rc.provider.' + name)
+    raise AttributeError(f"module 'rc.provider' has no attribute '{name}'")
@@ -1,5 +1,7 @@
-from rc.util import run, pmap
+from rc.util import run, pmap, limited
 from rc.machine import Machine
+from rc.inventory import inventory
+from rc import trace
 from rc.firewall import Firewall
 import json
 from functools import lru_cache
@@ -7,12 +9,19 @@ import builtins
 from pprint import pprint
 import sys
 import os
-from rc.exception import MachineCreationException, SaveImageException, MachineDeletionException, FirewallRuleCreationException, \
-    MachineShutdownException
 import time
+from threading import Lock, Thread
+from rc.exception import MachineCreationException, SaveImageException, MachineDeletionException, FirewallRuleCreationException, \
+    MachineShutdownException, RcException
 
 aws_provider = sys.modules[__name__]
 
+# At most this many aws cli calls in flight, change with rc.util.set_limit('aws', n)
+run = limited('aws', run, default=32)
+
+# Seconds to wait for machines to reach a state, e.g. running after create, before giving up
+wait_timeout = 600
+
 
 SSH_KEY_PATH = os.path.expanduser('~/.ssh/id_rsa')
 
@@ -35,31 +44,173 @@ def _find_instance_name(instance):
     return None
 
 
-def list(*, username=None, ssh_key_path=None):
-    if username is None:
-        username = 'root'
-    if ssh_key_path is None:
-        ssh_key_path = SSH_KEY_PATH
-    regions = _get_regions()
-
-    def _get_instance_in_region(region):
-        instances = []
-        region_instances = json.loads(run(
-            ['aws', 'ec2', 'describe-instances', '--region', region]).stdout)
-        for reservation in region_instances['Reservations']:
-            for instance in reservation['Instances']:
-                instances.append(instance)
-        return instances
-    instances = sum(pmap(_get_instance_in_region, regions), [])
+class RegionIndex:
+    """
+    Which regions hold our instances and the region of every instance name and id, persisted
+    in path so other processes start with it. It is rebuilt from each full sweep of all
+    regions, and is stale after ttl seconds, then the next use refreshes it in background.
+    """
+
+    def __init__(self, path=os.path.expanduser('~/.python-rc/aws-regions.json'), *, ttl=3600):
+        self.path = path
+        self.ttl = ttl
+        self._lock = Lock()
+        self._data = None
+        self._refreshing = False
+
+    def _load(self):
+        if self._data is None:
+            try:
+                with open(self.path) as f:
+                    self._data = json.load(f)
+                if set(self._data) != {'regions', 'names', 'updated'}:
+                    raise ValueError(self.path)
+            except (OSError, ValueError, TypeError):
+                self._data = {'regions': [], 'names': {}, 'updated': 0}
+        return self._data
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._data, f)
+        os.replace(tmp, self.path)
+
+    def region_of(self, name):
+        with self._lock:
+            return self._load()['names'].get(name)
+
+    def regions(self):
+        """Regions known to hold instances, None if no full sweep was done yet"""
+        with self._lock:
+            data = self._load()
+            return builtins.list(data['regions']) if data['updated'] else None
+
+    @property
+    def stale(self):
+        with self._lock:
+            return time.time() - self._load()['updated'] >= self.ttl
+
+    def update(self, machines):
+        """Rebuild from machines found by a full sweep"""
+        with self._lock:
+            names = {}
+            for m in machines:
+                for key in (m.name, m.id):
+                    if key:
+                        names[key] = m.region
+            self._data = {'regions': sorted(set(names.values())), 'names': names, 'updated': time.time()}
+            self._save()
+
+    def remember(self, machines):
+        with self._lock:
+            data = self._load()
+            for m in machines:
+                for key in (m.name, m.id):
+                    if key:
+                        data['names'][key] = m.region
+                if m.region not in data['regions']:
+                    data['regions'] = sorted(data['regions'] + [m.region])
+            self._save()
+
+    def forget(self, keys):
+        with self._lock:
+            names = self._load()['names']
+            if any([names.pop(key, None) for key in keys]):
+                self._save()
+
+    def refresh_in_background(self):
+        """
+        Start a full sweep in a thread if stale, which refreshes the index and the inventory.
+        An index never built is left to the sweep of the first miss.
+        """
+        with self._lock:
+            updated = self._load()['updated']
+            if self._refreshing or not updated or time.time() - updated < self.ttl:
+                return
+            self._refreshing = True
+
+        def refresh():
+            try:
+                inventory.machines(aws_provider, 'all', _list_instances, refresh=True)
+            except Exception:
+                pass
+            finally:
+                with self._lock:
+                    self._refreshing = False
+        Thread(target=refresh, daemon=True).start()
+
+
+region_index = RegionIndex()
+
+
+def _describe_instances_in_region(region, filters=()):
+    p = run(['aws', 'ec2', 'describe-instances', '--region', region, *filters])
+    if p.returncode != 0:
+        raise RcException(p.stderr)
+    return [i for r in json.loads(p.stdout)['Reservations'] for i in r['Instances']]
+
+
+def _list_instances(regions=None):
+    # One sweep over regions, all regions unless given, cached by rc.inventory. A sweep of
+    # all regions rebuilds the region index
+    full = regions is None
+    if full:
+        regions = _get_regions()
+    instances = sum(pmap(_describe_instances_in_region, regions), [])
     machines = []
 
     for i in instances:
-        m = _instance_to_machine(i, username, ssh_key_path)
+        m = _instance_to_machine(i, None, SSH_KEY_PATH)
         if m:
             machines.append(m)
+    if full:
+        region_index.update(machines)
     return machines
 
 
+def _find_in_regions(keys, regions):
+    """
+    {key: instances} of instance names or ids keys, looked up in regions with one
+    describe-instances per region filtered on the server side
+    """
+    ids = [k for k in keys if k.startswith('i-')]
+    names = [k for k in keys if not k.startswith('i-')]
+    filters = ['--filters', 'Name=instance-state-name,Values=pending,running,stopping,stopped']
+    if names:
+        filters.append(f'Name=tag:Name,Values={",".join(names)}')
+    if ids:
+        filters.append(f'Name=instance-id,Values={",".join(ids)}')
+    found = {k: {} for k in keys}
+    # Name and id filters are and-ed, query names and ids separately when both are given
+    queries = [(region, filters) for region in regions] if not (names and ids) else \
+        [(region, filters[:2] + [f]) for region in regions for f in filters[2:]]
+    for instances in pmap(_describe_instances_in_region, *zip(*queries)):
+        for i in instances:
+            for key in (_find_instance_name(i), i['InstanceId']):
+                if key in found:
+                    found[key][i['InstanceId']] = i
+    return {k: builtins.list(instances.values()) for k, instances in found.items()}
+
+
+def _set_user(machine, username, ssh_key_path):
+    machine.username = username or 'root'
+    if ssh_key_path:
+        machine.ssh_key_path = os.path.expanduser(ssh_key_path)
+    return machine
+
+
+def list(*, username=None, ssh_key_path=None, refresh=False):
+    """
+    All instances. Only regions in the region index are swept, all regions if refresh or if
+    the index is stale.
+    """
+    regions = None if refresh or region_index.stale else region_index.regions()
+    machines = inventory.machines(
+        aws_provider, 'all', lambda: _list_instances(regions), refresh=refresh)
+    return [_set_user(m, username, ssh_key_path) for m in machines]
+
+
 def _instance_to_machine(i, username, ssh_key_path):
     if i['State']['Name'] != 'terminated':
         name = _find_instance_name(i)
@@ -83,35 +234,42 @@ def _ensure_aws_keypair(username, ssh_key_path, region):
 
 
 def get(name, *, username=None, ssh_key_path=None, region=None, **kwargs):
+    """
+    Instance by name or id. Without region it is looked up in the region the region index
+    has for it, and all regions are only swept if it is not there.
+    """
+    return get_many([name], username=username, ssh_key_path=ssh_key_path, region=region)[0]
+
+
+def get_many(names, *, username=None, ssh_key_path=None, region=None, **kwargs):
+    """get of every name with one call per region, list of machine or None in order of names"""
+    names = builtins.list(names)
+    found = {}
     if region:
-        if name.startswith('i-'):
-            cmd = f'aws ec2 describe-instances --region {region} --instance-ids {name}'
-        else:
-            cmd = f'aws ec2 describe-instances --region {region} --filters Name=tag:Name,Values={name}'
-        p = run(cmd)
-        if p.returncode != 0:
-            return None
-        else:
-            reservations = json.loads(p.stdout)
-            instances = []
-            for reservation in reservations['Reservations']:
-                for instance in reservation['Instances']:
-                    if instance['State']['Name'] != 'terminated':
-                        instances.append(instance)
-            if len(instances) > 1:
-                return None
-            return _instance_to_machine(instances[0], username, ssh_key_path)
+        by_region = {region: names}
     else:
-        machines = list(username=username, ssh_key_path=ssh_key_path)
-        if name.startswith('i-'):
-            for machine in machines:
-                if machine.id == name:
-                    return machine
-        else:
-            for machine in machines:
-                if machine.name == name:
-                    return machine
-        return None
+        # A listing still in the inventory costs nothing, the region index one call per region
+        found = {name: m for name, m in zip(names, inventory.peek(aws_provider, 'all', names)) if m}
+        region_index.refresh_in_background()
+        by_region = {}
+        for name in names:
+            r = name not in found and region_index.region_of(name)
+            if r:
+                by_region.setdefault(r, []).append(name)
+    for region_found in pmap(lambda r, keys: _find_in_regions(keys, [r]), by_region.keys(), by_region.values()):
+        for key, instances in region_found.items():
+            if len(instances) == 1:
+                found[key] = _instance_to_machine(instances[0], None, SSH_KEY_PATH)
+    if region:
+        machines = [found.get(name) for name in names]
+    else:
+        missing = [name for name in names if name not in found]
+        if missing:
+            region_index.forget(missing)
+            for name, m in zip(missing, inventory.lookup_many(aws_provider, 'all', missing, _list_instances)):
+                found[name] = m
+        machines = [found[name] for name in names]
+    return [m and _set_user(m, username, ssh_key_path) for m in machines]
 
 
 def create(name, *, machine_type, disk_size_gb, image, init_username, region, reserve_ip=True, disk_type=None, firewall=None, username=None, ssh_key_path=None):
@@ -123,7 +281,52 @@ def create(name, *, machine_type, disk_size_gb, image, init_username, region, re
     p = _ensure_aws_keypair(username, ssh_key_path, region)
     if p.returncode != 0:
         raise MachineCreationException(p.stderr)
-    cmd = f'aws ec2 run-instances --image-id {image} --instance-type {machine_type} --count 1 --key-name {username} --region {region} --tag-specifications "ResourceType=instance,Tags=[{{Key=Name,Value={name}}}]"'
+    cmd = _run_instances_cmd(machine_type=machine_type, disk_size_gb=disk_size_gb, image=image, key_name=username,
+                             region=region, count=1, tags={'Name': name}, disk_type=disk_type, firewall=firewall)
+    p = run(cmd)
+    inventory.invalidate(aws_provider)
+    if p.returncode != 0:
+        raise MachineCreationException(p.stderr)
+    instance_id = json.loads(p.stdout)['Instances'][0]['InstanceId']
+    instance = _watcher(region).wait(instance_id, _has_ip, timeout=wait_timeout)
+    machine = _instance_to_machine(instance, init_username, ssh_key_path)
+    machine.name = name
+    region_index.remember([machine])
+    machine.wait_ssh()
+    return _setup_machine(machine, name, username)
+
+
+def describe_instances(ids, region):
+    """
+    {instance id: instance} of ids in region, with one aws call. Unlike --instance-ids, the
+    filter leaves out ids that are unknown, purged or not visible yet instead of failing
+    """
+    p = run(['aws', 'ec2', 'describe-instances', '--region', region,
+             '--filters', 'Name=instance-id,Values=' + ','.join(ids)])
+    if p.returncode != 0:
+        raise RcException(p.stderr)
+    return {i['InstanceId']: i for r in json.loads(p.stdout)['Reservations'] for i in r['Instances']}
+
+
+@lru_cache()
+def _watcher(region):
+    from rc.watch import StatusWatcher
+    return StatusWatcher(lambda ids: describe_instances(ids, region))
+
+
+def _has_ip(instance):
+    return instance is not None and bool(instance.get('PublicIpAddress'))
+
+
+def _terminated(instance):
+    # Terminated instances are purged after a while, then they are not described at all
+    return instance is None or instance['State']['Name'] == 'terminated'
+
+
+def _run_instances_cmd(*, machine_type, disk_size_gb, image, key_name, region, count, tags, disk_type=None,
+                       firewall=None):
+    tags = ','.join(f'{{Key={k},Value={v}}}' for k, v in tags.items())
+    cmd = f'aws ec2 run-instances --image-id {image} --instance-type {machine_type} --count {count} --key-name {key_name} --region {region} --tag-specifications "ResourceType=instance,Tags=[{tags}]"'
     if firewall:
         cmd += f' --security-groups {firewall}'
     if disk_type is None:
@@ -131,25 +334,79 @@ def create(name, *, machine_type, disk_size_gb, image, init_username, region, re
     ebs = f'{{VolumeType={disk_type},VolumeSize={disk_size_gb}}}'
     block_device_mapping = f'DeviceName=/dev/sda1,Ebs={ebs}'
     cmd += f' --block-device-mapping={block_device_mapping}'
-    p = run(cmd)
+    return cmd
+
+
+def _setup_machine(machine, name, username):
+    # User and hostname in one ssh session
+    with machine.batch() as b:
+        results = []
+        if username != machine.username:
+            results.append(b.ensure_user(username))
+        results.append(b.edit('/etc/hostname', name, user='root'))
+        results.append(b.sudo(f'hostname {name}'))
+    for r in results:
+        if r.result().returncode != 0:
+            raise MachineCreationException(r.result().stderr)
+    machine.username = username
+    return machine
+
+
+def create_many(names, *, machine_type, disk_size_gb, image, init_username, region, disk_type=None, firewall=None,
+                username=None, ssh_key_path=None):
+    """
+    Create machines names with the same options as create, with one run-instances --count
+    call and one keypair check, then wait for all of them together. Return machines in
+    order of names.
+    """
+    names = builtins.list(names)
+    if username is None:
+        username = os.getlogin()
+    if ssh_key_path is None:
+        ssh_key_path = SSH_KEY_PATH
+    p = _ensure_aws_keypair(username, ssh_key_path, region)
     if p.returncode != 0:
         raise MachineCreationException(p.stderr)
-    instance = json.loads(p.stdout)
-    instance_id = instance['Instances'][0]['InstanceId']
-    zone = _zone_region(region)
-    while True:
-        machine = get(instance_id, region=region,
-                      username=init_username, ssh_key_path=ssh_key_path)
-        if machine.ip:
-            break
-        time.sleep(1)
-    machine.wait_ssh()
-    if username != init_username:
-        machine.ensure_user(username)
-        machine.username = username
-    machine.edit('/etc/hostname', name, user='root')
-    machine.sudo(f'hostname {name}')
-    return machine
+    p = run(_run_instances_cmd(machine_type=machine_type, disk_size_gb=disk_size_gb, image=image,
+                               key_name=username, region=region, count=len(names),
+                               tags={'Name': names[0]}, disk_type=disk_type, firewall=firewall))
+    inventory.invalidate(aws_provider)
+    if p.returncode != 0:
+        raise MachineCreationException(p.stderr)
+    ids = [i['InstanceId'] for i in json.loads(p.stdout)['Instances']]
+    # run-instances tags every instance the same, name the others afterwards
+    for p in pmap(lambda id_, name: run(f'aws ec2 create-tags --resources {id_} --tags Key=Name,Value={name} --region {region}'),
+                  ids[1:], names[1:]):
+        if p.returncode != 0:
+            raise MachineCreationException(p.stderr)
+    instances = _watcher(region).wait_many(ids, _has_ip, timeout=wait_timeout)
+    machines = []
+    for id_, name in zip(ids, names):
+        machine = _instance_to_machine(instances[id_], init_username, ssh_key_path)
+        machine.name = name
+        machines.append(machine)
+    region_index.remember(machines)
+    from rc.ready import wait_all
+    wait_all(machines)
+    return pmap(lambda m, name: _setup_machine(m, name, username), machines, names)
+
+
+def delete_many(machines):
+    """Terminate machines with one call per region, and wait until all are terminated"""
+    by_region = {}
+    for m in machines:
+        by_region.setdefault(m.region, []).append(m.id)
+
+    def delete_region(region, ids):
+        p = run(['aws', 'ec2', 'terminate-instances', '--region', region, '--instance-ids', *ids])
+        if p.returncode != 0:
+            raise MachineDeletionException(p.stderr)
+        _watcher(region).wait_many(ids, _terminated, timeout=wait_timeout)
+    try:
+        pmap(delete_region, by_region.keys(), by_region.values())
+    finally:
+        inventory.invalidate(aws_provider)
+        region_index.forget([k for m in machines for k in (m.name, m.id) if k])
 
 
 def create_firewall(name, *, region, inbound_rules=None, outbound_rules=None):
@@ -184,24 +441,33 @@ def save_image(machine, image):
 def delete(machine):
     p = run(
         f'aws ec2 terminate-instances --instance-ids {machine.id} --region {machine.region}')
+    inventory.invalidate(aws_provider)
     if p.returncode != 0:
         raise MachineDeletionException(p.stderr)
-    while True:
-        s = status(machine)
-        if s == 'terminated':
-            return
-        time.sleep(2)
+    region_index.forget([k for k in (machine.name, machine.id) if k])
+    _watcher(machine.region).wait(machine.id, _terminated, timeout=wait_timeout)
 
 
 def shutdown(machine):
     p = run(
         f'aws ec2 stop-instances --instance-ids {machine.id} --region {machine.region}')
+    inventory.invalidate(aws_provider)
     if p.returncode != 0:
         raise MachineShutdownException(p.stderr)
 
 
 def status(machine):
+    """State name of machine, e.g. running or stopped, None if it does not exist"""
     p = run(
-        f'aws ec2 describe-instance-status --instance-ids {machine.id} --region {machine.region}')
-    instance_status = json.loads(p.stdout)
-    return instance_status['InstanceStatuses'][0]['InstanceState']['Name']
+        f'aws ec2 describe-instance-status --include-all-instances --instance-ids {machine.id} --region {machine.region}')
+    if p.returncode != 0:
+        if 'InvalidInstanceID' in p.stderr:
+            return None
+        raise RcException(p.stderr)
+    statuses = json.loads(p.stdout)['InstanceStatuses']
+    if not statuses:
+        return None
+    return statuses[0]['InstanceState']['Name']
+
+
+trace.instrument_module(aws_provider, 'aws')
@@ -1,13 +1,19 @@
-from rc.util import run
+from rc.util import run, limited, pmap
 from rc.exception import MachineCreationException, MachineDeletionException, \
-    MachineShutdownException, MachineBootupException, SaveImageException
+    MachineShutdownException, MachineBootupException, SaveImageException, RcException, PmapException
 from rc.machine import Machine
+from rc.inventory import inventory
+from rc import trace
+import builtins
 import json
 import sys
 import os
 
 azure_provider = sys.modules[__name__]
 
+# At most this many azure cli calls in flight, change with rc.util.set_limit('azure', n)
+run = limited('azure', run, default=8)
+
 SSH_KEY_PATH = os.path.expanduser('~/.ssh/id_rsa')
 
 
@@ -65,6 +71,7 @@ def create(*, name, machine_size, disk_size_gb=None, image, location, username=N
     if p.returncode != 0:
         raise MachineCreationException(p.stderr)
     p = run(['az', 'vm', 'create', *args])
+    inventory.invalidate(azure_provider)
     if p.returncode != 0:
         _delete_group(name)
         raise MachineCreationException(p.stderr)
@@ -76,31 +83,66 @@ def create(*, name, machine_size, disk_size_gb=None, image, location, username=N
     return machine
 
 
+def create_many(names, **kwargs):
+    """
+    Create machines names with the same options as create. Azure cli has no bulk create
+    across resource groups, so machines are created in parallel. Return machines in order
+    of names, or raise MachineCreationException naming the ones that failed.
+    """
+    names = builtins.list(names)
+    machines = pmap(lambda name: create(name=name, **kwargs), names, on_exception='return')
+    failed = [f'{name}: {m.args[0]}' for name, m in zip(names, machines) if isinstance(m, PmapException)]
+    if failed:
+        raise MachineCreationException('\n'.join(failed))
+    return machines
+
+
+def delete_many(machines):
+    """Delete machines in parallel"""
+    pmap(delete, machines)
+
+
 def delete(machine):
     p = _delete_group(machine.name)
+    inventory.invalidate(azure_provider)
     if p.returncode != 0:
         raise MachineDeletionException(p.stderr)
 
 
+def _list_vms():
+    # One listing of all vms with their public ips, cached by rc.inventory
+    p = run(['az', 'vm', 'list', '--show-details', '-o', 'json'])
+    if p.returncode != 0:
+        raise RcException(p.stderr)
+    return [Machine(provider=azure_provider, name=vm['name'], location=vm['location'],
+                    ip=vm.get('publicIps', '').split(',')[0], username=None, ssh_key_path=SSH_KEY_PATH)
+            for vm in json.loads(p.stdout)]
+
+
+def _set_user(machine, username, ssh_key_path):
+    machine.username = username or os.getlogin()
+    if ssh_key_path:
+        machine.ssh_key_path = os.path.expanduser(ssh_key_path)
+    return machine
+
+
+def list(*, username=None, ssh_key_path=None, refresh=False):
+    machines = inventory.machines(
+        azure_provider, 'default', _list_vms, refresh=refresh)
+    return [_set_user(m, username, ssh_key_path) for m in machines]
+
+
 def get(name, *, username=None, ssh_key_path=None, **kwargs):
-    p = run(['az', 'vm', 'list-ip-addresses', '-n', name, '-g', name])
-    if p.returncode == 0:
-        res = json.loads(p.stdout)
-        if not res:
-            return None
-        ip_address = res[
-            0]['virtualMachine']['network']['publicIpAddresses'][0]['ipAddress']
-        if not username:
-            username = os.getlogin()
-        if not ssh_key_path:
-            ssh_key_path = SSH_KEY_PATH
-        p = run(f'az vm get-instance-view -n {name} -g {name}')
-        res = json.loads(p.stdout)
-        location = res["location"]
-        return Machine(provider=azure_provider, name=name, location=location,
-                       ip=ip_address, username=username, ssh_key_path=ssh_key_path)
-    else:
+    machine = inventory.lookup(azure_provider, 'default', name, _list_vms)
+    if machine is None:
         return None
+    return _set_user(machine, username, ssh_key_path)
+
+
+def get_many(names, *, username=None, ssh_key_path=None, **kwargs):
+    """get of every name with one listing, list of machine or None in order of names"""
+    machines = inventory.lookup_many(azure_provider, 'default', names, _list_vms)
+    return [m and _set_user(m, username, ssh_key_path) for m in machines]
 
 
 def shutdown(machine):
@@ -141,3 +183,6 @@ def get_image(group, image):
         if i['name'] == image:
             return i['id']
     return None
+
+
+trace.instrument_module(azure_provider, 'azure')
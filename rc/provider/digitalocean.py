@@ -1,20 +1,33 @@
-from rc.util import run
+from rc.util import run, limited, pmap
 from rc.exception import MachineCreationException, MachineDeletionException, \
     MachineShutdownException, MachineBootupException, SaveImageException, MachineChangeTypeException, \
-    DeleteImageException, FirewallRuleCreationException
+    DeleteImageException, FirewallRuleCreationException, RcException, HttpException
 from rc.machine import Machine
+from rc.inventory import inventory
 from rc.firewall import Firewall
+from rc import rest, trace
+import builtins
 import sys
 import re
 import os
 from functools import lru_cache
 import json
-import time
 
 digitalocean_provider = sys.modules[__name__]
 
+# At most this many digitalocean cli calls in flight, change with rc.util.set_limit('digitalocean', n)
+run = limited('digitalocean', run, default=8)
+
+# Seconds to wait for machines to reach a state, e.g. running after create, before giving up
+wait_timeout = 600
+
 SSH_KEY_PATH = os.path.expanduser('~/.ssh/id_rsa')
 
+# list, get, get_many, status and the status polls of create and delete can go through the
+# DigitalOcean API instead of doctl, set here, with RC_DIGITALOCEAN_TRANSPORT or per call
+transport = rest.default_transport('digitalocean')
+api_url = 'https://api.digitalocean.com/v2'
+
 
 @lru_cache()
 def _digitalocean_ssh_key_fingerprint(username, ssh_key_path):
@@ -27,12 +40,60 @@ def _digitalocean_ssh_key_fingerprint(username, ssh_key_path):
     return fingerprint
 
 
-def list():
+@lru_cache()
+def _api_token():
+    token = os.environ.get('DIGITALOCEAN_ACCESS_TOKEN')
+    if token:
+        return token
+    import yaml
+    try:
+        with open(os.path.expanduser('~/.config/doctl/config.yaml')) as f:
+            return yaml.safe_load(f)['access-token']
+    except (OSError, KeyError, TypeError) as e:
+        raise RcException(f'No DigitalOcean access token in DIGITALOCEAN_ACCESS_TOKEN or doctl config: {e}')
+
+
+def _api():
+    return rest.session(api_url, auth=lambda: {'Authorization': f'Bearer {_api_token()}'})
+
+
+def _api_droplets():
+    droplets = []
+    page = 1
+    while True:
+        data = _api().get('/droplets', params={'per_page': 200, 'page': page})
+        droplets += data['droplets']
+        if not data.get('links', {}).get('pages', {}).get('next'):
+            return droplets
+        page += 1
+
+
+def _droplet_ip(droplet):
+    for network in droplet['networks']['v4']:
+        if network['type'] == 'public':
+            return network['ip_address']
+    return ''
+
+
+def _list_droplets(transport=None):
+    # One listing of all droplets, cached by rc.inventory
+    if rest.check_transport(transport or digitalocean_provider.transport) == 'rest':
+        result = []
+        for d in _api_droplets():
+            m = Machine(provider=digitalocean_provider, name=d['name'],
+                        zone=d['region']['slug'], ip=_droplet_ip(d), username='root', ssh_key_path=SSH_KEY_PATH)
+            m.id = str(d['id'])
+            result.append(m)
+        return result
     p = run(['doctl', 'compute', 'droplet', 'list', '--no-header',
              '--format', 'Region,Name,PublicIPv4,ID'])
+    if p.returncode != 0:
+        raise RcException(p.stderr)
     result = []
     lines = p.stdout.strip('\n').split('\n')
     for line in lines:
+        if not line:
+            continue
         zone, name, ip, id_ = re.split(r'\s+', line)
         m = Machine(provider=digitalocean_provider, name=name,
                     zone=zone, ip=ip, username='root', ssh_key_path=SSH_KEY_PATH)
@@ -41,30 +102,61 @@ def list():
     return result
 
 
-def _exist(id_):
-    p = run(f'doctl compute droplet get {id_}')
-    return p.returncode == 0
+def _set_user(machine, username, ssh_key_path):
+    machine.username = username or 'root'
+    if ssh_key_path:
+        machine.ssh_key_path = os.path.expanduser(ssh_key_path)
+    return machine
 
 
-def get(name, username=None, ssh_key_path=None, **kwargs):
-    if username is None:
-        username = 'root'
-    if ssh_key_path is None:
-        ssh_key_path = SSH_KEY_PATH
-    p = run(
-        f'doctl compute droplet list --no-header --format Region,Name,PublicIPv4,ID')
-    lines = p.stdout.strip('\n').split('\n')
-    for line in lines:
-        zone, name_, ip, id_ = re.split(r'\s+', line)
-        if name_ == name:
-            m = Machine(provider=digitalocean_provider, name=name,
-                        zone=zone, ip=ip, username=username, ssh_key_path=ssh_key_path)
-            m.id = id_
-            return m
-    return None
+def list(*, refresh=False, transport=None):
+    return inventory.machines(digitalocean_provider, 'default', lambda: _list_droplets(transport), refresh=refresh)
+
+
+def droplets_status(*, transport=None):
+    """{id: status} of all droplets, with one doctl call or API listing"""
+    if rest.check_transport(transport or digitalocean_provider.transport) == 'rest':
+        return {str(d['id']): d['status'] for d in _api_droplets()}
+    p = run('doctl compute droplet list --no-header --format ID,Status')
+    if p.returncode != 0:
+        raise RcException(p.stderr)
+    return dict(line.split() for line in p.stdout.strip('\n').split('\n') if line)
+
+
+@lru_cache()
+def _watcher():
+    from rc.watch import StatusWatcher
+    return StatusWatcher(lambda ids: droplets_status())
+
+
+def _gone(status):
+    return status is None
+
+
+def get(name, username=None, ssh_key_path=None, transport=None, **kwargs):
+    machine = inventory.lookup(
+        digitalocean_provider, 'default', name, lambda: _list_droplets(transport))
+    if machine is None:
+        return None
+    return _set_user(machine, username, ssh_key_path)
 
 
-def status(machine):
+def get_many(names, username=None, ssh_key_path=None, transport=None, **kwargs):
+    """get of every name with one listing, list of machine or None in order of names"""
+    machines = inventory.lookup_many(
+        digitalocean_provider, 'default', names, lambda: _list_droplets(transport))
+    return [m and _set_user(m, username, ssh_key_path) for m in machines]
+
+
+def status(machine, *, transport=None):
+    if rest.check_transport(transport or digitalocean_provider.transport) == 'rest':
+        try:
+            return _api().get(f'/droplets/{machine.id}')['droplet']['status']
+        except HttpException as e:
+            # Same as doctl, which prints nothing for a missing droplet
+            if e.status == 404:
+                return ''
+            raise
     p = run(
         f'doctl compute droplet get {machine.id} --no-header --format Status')
     return p.stdout.strip()
@@ -111,10 +203,15 @@ def create(name, *, image, region, size, firewall_name=None, username=None, ssh_
         cmd += ' --tag-name ' + firewall_name
     cmd += ' --wait'
     p = run(cmd)
+    inventory.invalidate(digitalocean_provider)
     if p.returncode != 0:
         raise MachineCreationException(p.stderr)
     machine = get(name, ssh_key_path=ssh_key_path)
     machine.wait_ssh()
+    return _add_user(machine, username, ssh_key_path)
+
+
+def _add_user(machine, username, ssh_key_path):
     if username != 'root':
         with open(os.path.expanduser(f'{ssh_key_path}.pub')) as f:
             pubkey = f.read().strip()
@@ -125,6 +222,44 @@ def create(name, *, image, region, size, firewall_name=None, username=None, ssh_
     return machine
 
 
+def create_many(names, *, image, region, size, firewall_name=None, username=None, ssh_key_path=None):
+    """
+    Create droplets names with the same options as create, with one doctl call that waits
+    for all of them, then wait for ssh on all of them together. Return machines in order of
+    names.
+    """
+    names = builtins.list(names)
+    existing = [name for name, m in zip(names, get_many(names)) if m]
+    if existing:
+        raise MachineCreationException(f'Machines {", ".join(existing)} already exist')
+    if username is None:
+        username = 'root'
+    if ssh_key_path is None:
+        ssh_key_path = SSH_KEY_PATH
+    cmd = f'doctl compute droplet create {" ".join(names)} --region {region} --size {size} --image {image} --ssh-keys {_digitalocean_ssh_key_fingerprint(username, ssh_key_path)}'
+    if firewall_name:
+        cmd += ' --tag-name ' + firewall_name
+    cmd += ' --wait'
+    p = run(cmd)
+    inventory.invalidate(digitalocean_provider)
+    if p.returncode != 0:
+        raise MachineCreationException(p.stderr)
+    machines = get_many(names, ssh_key_path=ssh_key_path)
+    from rc.ready import wait_all
+    wait_all(machines)
+    return pmap(lambda m: _add_user(m, username, ssh_key_path), machines)
+
+
+def delete_many(machines):
+    """Delete droplets with one doctl call, and wait until none of them is listed"""
+    ids = [m.id for m in machines]
+    p = run(f'doctl compute droplet delete {" ".join(ids)} --force')
+    inventory.invalidate(digitalocean_provider)
+    if p.returncode != 0:
+        raise MachineDeletionException(p.stderr)
+    _watcher().wait_many(ids, _gone, timeout=wait_timeout)
+
+
 def change_type(machine, new_type):
     # new_type: a digitalocean machine size
     # doctl compute size list
@@ -156,10 +291,10 @@ def delete_image(image):
 
 def delete(machine):
     p = run(f'doctl compute droplet delete {machine.id} --force')
+    inventory.invalidate(digitalocean_provider)
     if p.returncode != 0:
         raise MachineDeletionException(p.stderr)
-    while _exist(machine):
-        time.sleep(1)
+    _watcher().wait(machine.id, _gone, timeout=wait_timeout)
 
 
 def create_firewall(name, *, direction='in', ports, ips=['0.0.0.0/0']):
@@ -197,3 +332,6 @@ def get_image(name):
         if n == name:
             return id_
     return None
+
+
+trace.instrument_module(digitalocean_provider, 'digitalocean')
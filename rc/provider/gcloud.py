@@ -1,23 +1,41 @@
+import builtins
 import re
 from functools import lru_cache
 import yaml
 import os
-from retry import retry
 import sys
 from rc.machine import Machine
-from rc.util import run
+from rc.inventory import inventory
+from rc.util import run, limited, pmap
+from rc import rest, trace
 from rc.exception import MachineCreationException, MachineNotRunningException, MachineShutdownException, \
     MachineDeletionException, MachineChangeTypeException, MachineNotReadyException, SaveImageException, \
     DeleteImageException, FirewallRuleCreationException, FirewallRuleDeleteionException, MachineBootupException, \
-    RcException, DiskCreationException, DiskDeletionException, MachineAddDiskException, MachineRemoveDiskException
+    RcException, DiskCreationException, DiskDeletionException, MachineAddDiskException, MachineRemoveDiskException, \
+    HttpException
 
 gcloud_provider = sys.modules[__name__]
 
+# At most this many gcloud cli calls in flight, change with rc.util.set_limit('gcloud', n)
+run = limited('gcloud', run, default=16)
+
+# Seconds to wait for machines to reach a state, e.g. running after create, before giving up
+wait_timeout = 600
+
+# list, get, get_many, status and the status polls of create can go through the Compute
+# Engine API instead of the gcloud cli, set here, with RC_GCLOUD_TRANSPORT or per call
+transport = rest.default_transport('gcloud')
+api_url = 'https://compute.googleapis.com/compute/v1'
+
 
 def _zone_region(zone):
     return zone[:-2]
 
 
+# Description of firewalls created by rc for its machines, delete_many only deletes those
+FIREWALL_DESCRIPTION = 'python-rc'
+
+
 def create_firewall(name, allows=None, *, project=None):
     if allows:
         allow_param = ['--allow', ','.join(allows)]
@@ -25,7 +43,7 @@ def create_firewall(name, allows=None, *, project=None):
         allow_param = ['--allow', 'tcp:22']
 
     cmd = ['gcloud', 'compute', 'firewall-rules', 'create',
-           name, '--target-tags', name, *allow_param]
+           name, '--target-tags', name, *allow_param, '--description', FIREWALL_DESCRIPTION]
     if project:
         cmd += ['--project', project]
     return run(cmd)
@@ -84,52 +102,108 @@ def _generate_gcloud_ssh_key():
              "add", "--key-file={}.pub".format(SSH_KEY_PATH)])
 
 
-def list(*, pattern=None, project=None, username=None, ssh_key_path=None):
-    _generate_gcloud_ssh_key()
+@lru_cache()
+def _api_token():
+    # Access tokens are valid for an hour, _api_get drops this one on a 401
+    token = os.environ.get('CLOUDSDK_AUTH_ACCESS_TOKEN')
+    if token:
+        return token
+    p = run(['gcloud', 'auth', 'print-access-token'])
+    if p.returncode != 0:
+        raise RcException(p.stderr)
+    return p.stdout.strip()
+
+
+def _api_get(path, **options):
+    session = rest.session(api_url, auth=lambda: {'Authorization': f'Bearer {_api_token()}'})
+    r = session.request('GET', path, **options)
+    if r.status == 401:
+        _api_token.cache_clear()
+        r = session.request('GET', path, **options)
+    return r.raise_for_status().json()
+
+
+def _api_instances(project, names=None):
+    """All instances of project, or only those named names, in one aggregated listing"""
+    params = {'maxResults': 500}
+    if names:
+        params['filter'] = ' OR '.join(f'(name = "{name}")' for name in names)
+    instances = []
+    while True:
+        data = _api_get(f'/projects/{project}/aggregated/instances', params=params)
+        for scope in data.get('items', {}).values():
+            instances += scope.get('instances', [])
+        if not data.get('nextPageToken'):
+            return instances
+        params['pageToken'] = data['nextPageToken']
+
+
+def _instance_ip(instance):
+    try:
+        return instance['networkInterfaces'][0]['accessConfigs'][0].get('natIP', '')
+    except (KeyError, IndexError):
+        return ''
+
+
+def _list_instances(project, transport=None):
+    # One listing of all instances in project, cached by rc.inventory. Username is
+    # filled in by list and get, so the snapshot does not depend on it
+    if rest.check_transport(transport or gcloud_provider.transport) == 'rest':
+        return [Machine(provider=gcloud_provider, name=i['name'], zone=i['zone'].rsplit('/', 1)[-1],
+                        ip=_instance_ip(i), username=None, ssh_key_path=SSH_KEY_PATH, project=project)
+                for i in _api_instances(project)]
     cmd = ['gcloud', 'compute', 'instances', 'list', '--format',
-           'value(zone, name, networkInterfaces[0].accessConfigs[0].natIP)']
-    if project:
-        cmd += ['--project', project]
-    else:
-        project = get_project()
+           'value(zone, name, networkInterfaces[0].accessConfigs[0].natIP)', '--project', project]
     p = run(cmd)
+    if p.returncode != 0:
+        raise RcException(p.stderr)
     result = []
-    lines = p.stdout.strip('\n').split('\n')
-    for line in lines:
-        zone, name, ip = re.split(r'\s+', line)
-        if pattern:
-            if pattern not in name:
-                continue
-        if username is None:
-            username = _get_username(project)
-        if ssh_key_path is None:
-            ssh_key_path = SSH_KEY_PATH
+    for line in p.stdout.strip('\n').split('\n'):
+        if not line:
+            continue
+        zone, name, *ip = re.split(r'\s+', line.strip())
         result.append(Machine(provider=gcloud_provider, name=name,
-                              zone=zone, ip=ip, username=username, ssh_key_path=ssh_key_path,
+                              zone=zone, ip=ip[0] if ip else '', username=None, ssh_key_path=SSH_KEY_PATH,
                               project=project))
     return result
 
 
-def get(name, *, username=None, ssh_key_path=None, project=None, **kwargs):
+def _set_user(machine, username, ssh_key_path):
+    machine.username = username or _get_username(machine.project)
+    if ssh_key_path:
+        machine.ssh_key_path = os.path.expanduser(ssh_key_path)
+    return machine
+
+
+def list(*, pattern=None, project=None, username=None, ssh_key_path=None, refresh=False, transport=None):
     _generate_gcloud_ssh_key()
-    cmd = ['gcloud', 'compute', 'instances', 'list', '--format',
-           'value(zone, name, networkInterfaces[0].accessConfigs[0].natIP)',
-           '--filter', 'name=' + name]
-    if project:
-        cmd += ['--project', project]
-    else:
+    if not project:
         project = get_project()
-    p = run(cmd)
-    if p.stdout.strip('\n') == '':
+    machines = inventory.machines(gcloud_provider, project,
+                                  lambda: _list_instances(project, transport), refresh=refresh)
+    return [_set_user(m, username, ssh_key_path) for m in machines
+            if not pattern or pattern in m.name]
+
+
+def get(name, *, username=None, ssh_key_path=None, project=None, transport=None, **kwargs):
+    _generate_gcloud_ssh_key()
+    if not project:
+        project = get_project()
+    machine = inventory.lookup(gcloud_provider, project, name,
+                               lambda: _list_instances(project, transport))
+    if machine is None:
         return None
-    zone, name, ip = re.split(r'\s+', p.stdout.strip('\n'))
-    if username is None:
-        username = _get_username(project)
-    if ssh_key_path is None:
-        ssh_key_path = SSH_KEY_PATH
-    return Machine(provider=gcloud_provider, name=name,
-                   zone=zone, ip=ip, username=username, ssh_key_path=ssh_key_path,
-                   project=project)
+    return _set_user(machine, username, ssh_key_path)
+
+
+def get_many(names, *, username=None, ssh_key_path=None, project=None, transport=None, **kwargs):
+    """get of every name with one listing of project, list of machine or None in order of names"""
+    _generate_gcloud_ssh_key()
+    if not project:
+        project = get_project()
+    machines = inventory.lookup_many(gcloud_provider, project, names,
+                                     lambda: _list_instances(project, transport))
+    return [m and _set_user(m, username, ssh_key_path) for m in machines]
 
 
 @lru_cache()
@@ -150,46 +224,28 @@ def _get_username(project):
         return os.getlogin()
 
 
-def _get_ip(name, *, project=None):
-    cmd = ['gcloud', 'compute', 'instances', 'list', '--filter', 'name='+name, '--format',
-           'get(networkInterfaces[0].accessConfigs[0].natIP)']
-    if project:
-        cmd += ['--project', project]
-    p = run(cmd)
-    return p.stdout.strip()
+@lru_cache()
+def _watcher(project):
+    from rc.watch import StatusWatcher
+    return StatusWatcher(lambda names: instances_status(names, project=project), min_interval=2)
+
+
+def _running(status):
+    return status is not None and status[0] == 'RUNNING'
 
 
-@retry(MachineNotRunningException, delay=2)
 def _wait_bootup(name, *, project=None):
-    cmd = ['gcloud', 'compute', 'instances', 'list', '--format',
-           'value(status)', '--filter', 'name=' + name]
-    if project:
-        cmd += ['--project', project]
-    p = run(cmd)
-    status = p.stdout.strip()
-    if status != 'RUNNING':
-        raise MachineNotRunningException(status)
+    """Wait until instance is running, return its (status, ip)"""
+    return _watcher(project or get_project()).wait(name, _running, timeout=wait_timeout)
 
 
 def create(name, *, project=None, machine_type, disk_size, image_project, image_family=None, image=None, zone, min_cpu_platform=None,
            preemptible=False, firewall_allows=None, reserve_ip=True, firewalls=None, disk_type=None):
     _generate_gcloud_ssh_key()
     args = [name]
-    args += ['--machine-type', machine_type]
-    args += ['--boot-disk-size', disk_size]
-    if disk_type:
-        args += ['--boot-disk-type', disk_type]
-    if image_family:
-        args += ['--image-family', image_family]
-    args += ['--image-project', image_project]
-    if image:
-        args += ['--image', image]
-    args += ['--zone', zone]
-
-    if min_cpu_platform:
-        args += ['--min-cpu-platform', min_cpu_platform]
-    if preemptible:
-        args += ['--preemptible']
+    args += _instance_args(machine_type=machine_type, disk_size=disk_size, image_project=image_project,
+                           image_family=image_family, image=image, zone=zone, min_cpu_platform=min_cpu_platform,
+                           preemptible=preemptible, disk_type=disk_type)
 
     if firewall_allows:
         if firewall_exist(name, project=project):
@@ -204,14 +260,14 @@ def create(name, *, project=None, machine_type, disk_size, image_project, image_
         args += ['--project', project]
 
     p = run(['gcloud', 'compute', 'instances', 'create', *args])
+    inventory.invalidate(gcloud_provider)
     if p.returncode != 0:
         if firewall_allows:
             delete_firewall(name, project=project)
         raise MachineCreationException(p.stderr)
 
-    _wait_bootup(name, project=project)
+    _, ip = _wait_bootup(name, project=project)
 
-    ip = _get_ip(name, project=project)
     if not preemptible and reserve_ip:
         if _address_exist(name, _zone_region(zone), project=project):
             _release_ip_address(name, _zone_region(zone), project=project)
@@ -230,9 +286,174 @@ def create(name, *, project=None, machine_type, disk_size, image_project, image_
     return machine
 
 
+def _instance_args(*, machine_type, disk_size, image_project, image_family=None, image=None, zone,
+                   min_cpu_platform=None, preemptible=False, disk_type=None):
+    args = ['--machine-type', machine_type]
+    args += ['--boot-disk-size', disk_size]
+    if disk_type:
+        args += ['--boot-disk-type', disk_type]
+    if image_family:
+        args += ['--image-family', image_family]
+    args += ['--image-project', image_project]
+    if image:
+        args += ['--image', image]
+    args += ['--zone', zone]
+    if min_cpu_platform:
+        args += ['--min-cpu-platform', min_cpu_platform]
+    if preemptible:
+        args += ['--preemptible']
+    return args
+
+
+def _name_filter(names):
+    return 'name=(' + ' '.join(names) + ')'
+
+
+def instances_status(names, *, project, transport=None):
+    """{name: (status, ip)} of instances names in project, with one gcloud call or API listing"""
+    if rest.check_transport(transport or gcloud_provider.transport) == 'rest':
+        return {i['name']: (i['status'], _instance_ip(i)) for i in _api_instances(project, names)}
+    p = run(['gcloud', 'compute', 'instances', 'list', '--filter', _name_filter(names), '--format',
+             'value(name, status, networkInterfaces[0].accessConfigs[0].natIP)', '--project', project])
+    if p.returncode != 0:
+        raise RcException(p.stderr)
+    result = {}
+    for line in p.stdout.strip('\n').split('\n'):
+        if line:
+            name, status, *ip = re.split(r'\s+', line.strip())
+            result[name] = (status, ip[0] if ip else '')
+    return result
+
+
+def _wait_running_many(names, *, project):
+    """Wait until all instances are running, return {name: ip}"""
+    return {name: status[1] for name, status in _watcher(project).wait_many(names, _running, timeout=wait_timeout).items()}
+
+
+def _existing_addresses(names, region, *, project):
+    p = run(['gcloud', 'compute', 'addresses', 'list', '--filter', f'{_name_filter(names)} AND region:{region}',
+             '--format', 'value(name)', '--project', project])
+    return p.stdout.split()
+
+
+def create_many(names, *, project=None, machine_type, disk_size, image_project, image_family=None, image=None, zone,
+                min_cpu_platform=None, preemptible=False, firewall_allows=None, firewall_name=None, reserve_ip=True,
+                firewalls=None, disk_type=None, wait_ssh=True):
+    """
+    Create machines names with the same options as create, with one bulk-create, then wait
+    for all of them together. With firewall_allows, one firewall, firewall_name (default
+    common prefix of names), is shared by all machines, delete_many deletes it with the last
+    machine using it. Return machines in order of names.
+    """
+    _generate_gcloud_ssh_key()
+    names = builtins.list(names)
+    if not project:
+        project = get_project()
+    args = _instance_args(machine_type=machine_type, disk_size=disk_size, image_project=image_project,
+                          image_family=image_family, image=image, zone=zone, min_cpu_platform=min_cpu_platform,
+                          preemptible=preemptible, disk_type=disk_type)
+    if firewall_allows:
+        firewall_name = firewall_name or os.path.commonprefix(names).rstrip('-_') or names[0]
+        if not firewall_exist(firewall_name, project=project):
+            p = create_firewall(name=firewall_name, allows=firewall_allows, project=project)
+            if p.returncode != 0:
+                raise MachineCreationException(p.stderr)
+        args += ['--tags', firewall_name]
+    elif firewalls:
+        args += ['--tags', ','.join(firewalls)]
+
+    p = run(['gcloud', 'compute', 'instances', 'bulk-create', '--predefined-names', ','.join(names),
+             '--count', str(len(names)), *args, '--project', project])
+    inventory.invalidate(gcloud_provider)
+    if p.returncode != 0:
+        raise MachineCreationException(p.stderr)
+    ips = _wait_running_many(names, project=project)
+
+    if not preemptible and reserve_ip:
+        region = _zone_region(zone)
+        existing = _existing_addresses(names, region, project=project)
+        if existing:
+            run(['gcloud', 'compute', 'addresses', 'delete', *existing, '--region', region, '--project', project],
+                input='yes\n')
+        p = run(['gcloud', 'compute', 'addresses', 'create', *names, '--addresses',
+                 ','.join(ips[name] for name in names), '--region', region, '--project', project])
+        if p.returncode != 0:
+            raise MachineCreationException(p.stderr)
+    username = _get_username(project)
+    machines = [Machine(provider=gcloud_provider, name=name, zone=zone, ip=ips[name], username=username,
+                        ssh_key_path=SSH_KEY_PATH, project=project) for name in names]
+    if wait_ssh:
+        from rc.ready import wait_all
+        wait_all(machines)
+    return machines
+
+
+def _instance_tags(project, names=None):
+    """Network tags of instances names, or of all instances, in project"""
+    p = run(['gcloud', 'compute', 'instances', 'list', *(['--filter', _name_filter(names)] if names else []),
+             '--format', 'value(tags.items)', '--project', project])
+    if p.returncode != 0:
+        raise RcException(p.stderr)
+    return {tag for line in p.stdout.split() for tag in line.split(';')}
+
+
+def _delete_unused_firewalls(project, tags):
+    """Delete firewalls created by rc for tags that no instance of project has anymore"""
+    unused = sorted(tags - _instance_tags(project))
+    if not unused:
+        return
+    p = run(['gcloud', 'compute', 'firewall-rules', 'list', '--filter',
+             f'{_name_filter(unused)} AND description={FIREWALL_DESCRIPTION}', '--format', 'value(name)',
+             '--project', project])
+    if p.stdout.split():
+        p = run(['gcloud', 'compute', 'firewall-rules', 'delete', *p.stdout.split(), '--project', project, '--quiet'])
+        if p.returncode != 0:
+            raise MachineDeletionException(p.stderr)
+
+
+def delete_many(machines):
+    """
+    Delete machines with one gcloud call per zone, and release their addresses and own
+    firewalls, including the firewalls shared by machines of create_many once no machine
+    uses them anymore
+    """
+    by_zone, by_project = {}, {}
+    for m in machines:
+        by_zone.setdefault((m.project, m.zone), []).append(m.name)
+        by_project.setdefault(m.project, []).append(m.name)
+    tags = {project: _instance_tags(project, names) for project, names in by_project.items()}
+
+    def delete_zone(item):
+        (project, zone), names = item
+        p = run(['gcloud', 'compute', 'instances', 'delete', *names, '--zone', zone, '--project', project, '--quiet'])
+        if p.returncode != 0:
+            raise MachineDeletionException(p.stderr)
+        region = _zone_region(zone)
+        addresses = _existing_addresses(names, region, project=project)
+        if addresses:
+            p = run(['gcloud', 'compute', 'addresses', 'delete', *addresses, '--region', region,
+                     '--project', project, '--quiet'])
+            if p.returncode != 0:
+                raise MachineDeletionException(p.stderr)
+        p = run(['gcloud', 'compute', 'firewall-rules', 'list', '--filter', _name_filter(names),
+                 '--format', 'value(name)', '--project', project])
+        if p.stdout.split():
+            p = run(['gcloud', 'compute', 'firewall-rules', 'delete', *p.stdout.split(), '--project', project,
+                     '--quiet'])
+            if p.returncode != 0:
+                raise MachineDeletionException(p.stderr)
+    try:
+        pmap(delete_zone, by_zone.items())
+    finally:
+        inventory.invalidate(gcloud_provider)
+    for project, project_tags in tags.items():
+        _delete_unused_firewalls(project, project_tags)
+
+
 def delete(machine):
     project = machine.project
     p = _delete_machine(machine.name, machine.zone, project=project)
+    inventory.invalidate(gcloud_provider)
     if p.returncode != 0:
         raise MachineDeletionException(p.stderr)
     if _address_exist(machine.name, _zone_region(machine.zone), project=project):
@@ -257,6 +478,8 @@ def _delete_machine(name, zone, *, project=None):
 def shutdown(machine):
     p = run(['gcloud', 'compute', 'instances', 'stop',
              machine.name, '--zone', machine.zone, '--project', machine.project])
+    # Ephemeral ip is released on stop
+    inventory.invalidate(gcloud_provider, machine.project)
     if p.returncode != 0:
         raise MachineShutdownException(p.stderr)
 
@@ -264,12 +487,21 @@ def shutdown(machine):
 def bootup(machine):
     p = run(['gcloud', 'compute', 'instances', 'start',
              machine.name, '--zone', machine.zone, '--project', machine.project])
+    inventory.invalidate(gcloud_provider, machine.project)
     if p.returncode != 0:
         raise MachineBootupException(p.stderr)
     machine.wait_ssh()
 
 
-def status(machine):
+def status(machine, *, transport=None):
+    if rest.check_transport(transport or gcloud_provider.transport) == 'rest':
+        try:
+            return _api_get(f'/projects/{machine.project}/zones/{machine.zone}/instances/{machine.name}')['status']
+        except HttpException as e:
+            # Same as the cli, which lists nothing for a missing instance
+            if e.status == 404:
+                return ''
+            raise
     p = run(['gcloud', 'compute', 'instances', 'list', '--format',
              'value(status)', '--filter', 'name=' + machine.name, '--project', machine.project])
     return p.stdout.strip()
@@ -373,12 +605,17 @@ def delete_disk(disk, zone, *, project=None):
 
 def set_project(project):
     p = run(f'gcloud config set project {project}')
+    get_project.cache_clear()
     if p.returncode != 0:
         raise RcException(p.stderr)
 
 
+@lru_cache()
 def get_project():
     p = run(f'gcloud config get-value project')
     if p.returncode != 0:
         raise RcException(p.stderr)
     return p.stdout.strip()
+
+
+trace.instrument_module(gcloud_provider, 'gcloud')
@@ -0,0 +1,96 @@
+import asyncio
+import random
+import time
+from rc.exception import MachineNotReadyException, PmapException
+
+
+async def probe_banner(ip, port=22, timeout=5):
+    """Whether an ssh server answers on ip:port with its SSH- banner, without a handshake"""
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        return line.startswith(b'SSH-')
+    except (OSError, asyncio.TimeoutError):
+        return False
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def backoff(attempt, *, initial=0.5, factor=2, max_delay=10, jitter=0.5):
+    """Delay before retry attempt: exponential, capped at max_delay, randomly shortened by up to jitter of it"""
+    delay = min(max_delay, initial * factor ** attempt)
+    return delay * (1 - random.uniform(0, jitter))
+
+
+async def await_ready(machine, *, timeout=300, port=None, banner=True, probe_timeout=5, ssh_timeout=30,
+                      **backoff_options):
+    """
+    Wait until machine accepts ssh, or raise MachineNotReadyException after timeout seconds.
+    Each attempt first reads the ssh banner of port (default the machine's port or 22), which
+    is cheap, and only does a full ssh login once the banner is there. Attempts are spaced by
+    backoff. Return seconds waited.
+    """
+    port = port or getattr(machine, 'port', None) or 22
+    start = time.monotonic()
+    deadline = start + timeout
+    attempt = 0
+    error = 'no attempt'
+    while True:
+        if not machine.ip:
+            error = 'no ip address'
+        elif banner and not await probe_banner(machine.ip, port, timeout=min(probe_timeout, timeout)):
+            error = f'no ssh banner on port {port}'
+        else:
+            try:
+                p = await machine.arun('true', timeout=min(ssh_timeout, max(deadline - time.monotonic(), 1)))
+                if p.returncode == 0:
+                    return time.monotonic() - start
+                error = p.stderr.strip()
+            except Exception as e:
+                error = str(e)
+        delay = backoff(attempt, **backoff_options)
+        if time.monotonic() + delay > deadline:
+            raise MachineNotReadyException(f'{machine} not ready after {timeout} seconds: {error}')
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+def _run(coro):
+    # asyncio.run can't be called with an event loop running in this thread, e.g. in a
+    # notebook or when called by a coroutine, run it in its own thread then
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+def wait_ready(machine, **options):
+    """Blocking await_ready, also when an event loop is running, which it then blocks"""
+    return _run(await_ready(machine, **options))
+
+
+async def await_all(machines, *, concurrency=None, on_exception='raise', **options):
+    from rc.aio import agather
+    machines = list(machines)
+    results = await agather(lambda m: await_ready(m, **options), machines,
+                            concurrency=concurrency, on_exception='return')
+    failed = [str(r.args[0]) for r in results if isinstance(r, PmapException)]
+    if failed and on_exception == 'raise':
+        raise MachineNotReadyException('\n'.join(failed))
+    return results
+
+
+def wait_all(machines, *, timeout=300, concurrency=None, on_exception='raise', **options):
+    """
+    Wait for every machine in one event loop, e.g. a batch of just created machines. Return
+    seconds waited per machine. If some are not ready before timeout, raise one
+    MachineNotReadyException naming all of them, or with on_exception='return' put a
+    PmapException in place of their results.
+    """
+    return _run(await_all(machines, timeout=timeout, concurrency=concurrency,
+                          on_exception=on_exception, **options))
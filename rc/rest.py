@@ -0,0 +1,132 @@
+import http.client
+import json
+import os
+import urllib.parse
+from threading import Lock
+from rc.exception import HttpException, RcException
+
+transports = ('cli', 'rest')
+
+
+def default_transport(provider):
+    """Transport of provider from RC_<PROVIDER>_TRANSPORT or RC_TRANSPORT, cli if neither is set"""
+    transport = os.environ.get(f'RC_{provider.upper()}_TRANSPORT') or os.environ.get('RC_TRANSPORT') or 'cli'
+    return check_transport(transport)
+
+
+def check_transport(transport):
+    if transport not in transports:
+        raise RcException(f'Unknown transport {transport}, must be one of {", ".join(transports)}')
+    return transport
+
+
+class Response:
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body) if self.body else None
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise HttpException(self.status, self.body.decode(errors='replace'))
+        return self
+
+
+class Session:
+    """
+    Keep-alive HTTP(S) connections to the server of base_url, reused by every request so a
+    call costs one round trip instead of a process start, a TCP and a TLS handshake. Up to
+    max_idle connections are kept for concurrent callers. auth() returns extra headers and
+    is called on every request, so tokens can be refreshed. A request on a reused connection
+    that the server closed meanwhile is retried once on a new connection.
+    """
+
+    def __init__(self, base_url, *, auth=None, timeout=30, max_idle=8):
+        url = urllib.parse.urlsplit(base_url)
+        self.https = url.scheme == 'https'
+        self.host = url.hostname
+        self.port = url.port
+        self.prefix = url.path.rstrip('/')
+        self.auth = auth
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.connections_opened = 0
+        self._idle = []
+        self._lock = Lock()
+
+    def _connection(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+            self.connections_opened += 1
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout), False
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, path, *, params=None, data=None, headers=None):
+        """Send a request, data is sent as JSON, return the Response whatever its status"""
+        url = self.prefix + path
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        headers = {'Accept': 'application/json', **(self.auth() if self.auth else {}), **(headers or {})}
+        body = None
+        if data is not None:
+            body = json.dumps(data).encode()
+            headers['Content-Type'] = 'application/json'
+        while True:
+            conn, reused = self._connection()
+            try:
+                conn.request(method, url, body=body, headers=headers)
+                r = conn.getresponse()
+                content = r.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            if r.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            return Response(r.status, dict(r.getheaders()), content)
+
+    def get(self, path, **options):
+        return self.request('GET', path, **options).raise_for_status().json()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+_sessions = {}
+_sessions_lock = Lock()
+
+
+def session(base_url, **options):
+    """The shared Session of base_url, created with options on first use"""
+    with _sessions_lock:
+        if base_url not in _sessions:
+            _sessions[base_url] = Session(base_url, **options)
+        return _sessions[base_url]
+
+
+def close_sessions():
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for s in sessions:
+        s.close()
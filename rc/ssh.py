@@ -0,0 +1,145 @@
+import atexit
+import hashlib
+import os
+import subprocess
+import time
+from threading import Lock
+from rc import trace
+
+# Unix socket paths are limited to ~104 bytes, keep the control dir short
+control_dir = os.path.join(os.environ.get(
+    'TMPDIR', '/tmp'), f'python-rc-{os.getuid()}')
+
+
+class ControlMasterPool:
+    """
+    Keep one persistent ssh ControlMaster connection per (username, ip, ssh_key_path)
+    and let every ssh command of a Machine multiplex over it.
+
+    Masters are started lazily on first use and exit by themselves after idle_timeout
+    seconds without any session. Closing a master only stops it from accepting new
+    sessions, those already running over it, e.g. of another rc process, go on. If a master dies, ssh commands fall back to a fresh
+    connection (ControlMaster=no never fails on a missing or stale socket) and the next
+    command starts a new master. After a master fails to start, e.g. machine is still
+    booting, commands connect directly for retry_after seconds before trying again.
+    Starting a master gives up after connect_timeout seconds and never prompts.
+    """
+
+    def __init__(self, *, idle_timeout=600, retry_after=10, connect_timeout=10, enabled=True, close_at_exit=True):
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.retry_after = retry_after
+        self.enabled = enabled
+        self.close_at_exit = close_at_exit
+        self._lock = Lock()
+        self._key_locks = {}
+        self._masters = {}
+        self._failed = {}
+
+    @staticmethod
+    def _key(machine):
+        return (machine.username, machine.ip, machine.ssh_key_path, getattr(machine, 'port', None))
+
+    def control_path(self, machine):
+        digest = hashlib.sha1(
+            repr(self._key(machine)).encode()).hexdigest()[:16]
+        return os.path.join(control_dir, digest)
+
+    def _base_options(self, machine):
+        return ['-o', 'StrictHostKeyChecking=no',
+                *(['-i', machine.ssh_key_path] if machine.ssh_key_path else []),
+                *(['-p', str(machine.port)] if getattr(machine, 'port', None) else [])]
+
+    def _key_lock(self, key):
+        with self._lock:
+            if key not in self._key_locks:
+                self._key_locks[key] = Lock()
+            return self._key_locks[key]
+
+    def options(self, machine):
+        """
+        ssh options that make a command go through the master of machine, starting
+        the master if there is none alive. Empty if multiplexing is disabled.
+        """
+        if not self.enabled or not getattr(machine, 'multiplex', True) or not machine.ip:
+            return []
+        path = self.control_path(machine)
+        key = self._key(machine)
+        with self._key_lock(key):
+            if not os.path.exists(path):
+                if time.time() - self._failed.get(key, 0) < self.retry_after:
+                    return []
+                if not self._start_master(machine, path):
+                    self._failed[key] = time.time()
+                    return []
+        return ['-o', 'ControlMaster=no', '-o', f'ControlPath={path}']
+
+    def _start_master(self, machine, path):
+        os.makedirs(control_dir, mode=0o700, exist_ok=True)
+        # The only place an ssh handshake is paid once for many commands, time it on its own
+        with trace.span('ssh.connect', machine=machine.name, ip=machine.ip):
+            p = subprocess.run(['ssh', *self._base_options(machine),
+                                '-o', 'ControlMaster=yes', '-o', f'ControlPath={path}',
+                                '-o', f'ControlPersist={self.idle_timeout}',
+                                '-o', f'ConnectTimeout={self.connect_timeout}', '-o', 'BatchMode=yes',
+                                '-f', '-N', machine.username + '@' + machine.ip],
+                               stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if p.returncode == 0:
+            with self._lock:
+                self._masters[self._key(machine)] = path
+                self._failed.pop(self._key(machine), None)
+        return p.returncode == 0
+
+    def _control(self, machine, path, command):
+        return subprocess.run(['ssh', *self._base_options(machine),
+                               '-o', f'ControlPath={path}', '-O', command,
+                               machine.username + '@' + machine.ip],
+                              stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+    def check(self, machine):
+        path = self.control_path(machine)
+        if not os.path.exists(path):
+            return False
+        if self._control(machine, path, 'check'):
+            return True
+        self.discard(machine)
+        return False
+
+    def discard(self, machine):
+        """Forget a master that is no longer alive so the next command starts a new one"""
+        path = self.control_path(machine)
+        with self._lock:
+            self._masters.pop(self._key(machine), None)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def close(self, machine):
+        # Masters are shared by every rc process of the user, stop lets sessions of others finish
+        path = self.control_path(machine)
+        if os.path.exists(path):
+            self._control(machine, path, 'stop')
+        self.discard(machine)
+
+    def close_all(self):
+        with self._lock:
+            masters = dict(self._masters)
+        for (username, ip, ssh_key_path, port), path in masters.items():
+            subprocess.run(['ssh', '-o', f'ControlPath={path}', '-O', 'stop', username + '@' + ip],
+                           stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._masters.clear()
+
+
+pool = ControlMasterPool()
+
+
+@atexit.register
+def _close_pool():
+    if pool.close_at_exit:
+        pool.close_all()
@@ -0,0 +1,281 @@
+import hashlib
+import os
+import re
+import time
+from collections import namedtuple
+from rc.util import run, convert_list_command_to_str, pmap, run_stream, handle_stream, RunResult
+from rc.exception import UploadException
+from rc import trace
+
+FileTransfer = namedtuple('FileTransfer', ['path', 'change', 'size', 'bytes'])
+
+# %i itemized change, %l file length, %b bytes actually transferred, %n file name
+OUT_FORMAT = '%i %l %b %n'
+_item_re = re.compile(r'^([<>ch.][fdLDS].{9}) (\d+) (\d+) (.*)$')
+_deleting_re = re.compile(r'^\*deleting +(?:\d+ \d+ )?(.*)$')
+_stat_re = re.compile(r'^Total bytes (sent|received): ([\d,.]+)')
+# --info=progress2 line: bytes so far, percent, rate, eta
+_progress_re = re.compile(r'^\s*([\d,]+)\s+(\d+)%\s+(\S+/s)\s+(\S+)')
+
+
+class SyncReport:
+    """
+    Structured result of one rsync run: files transferred (FileTransfer), files that were
+    already up to date, files deleted, total bytes on the wire, elapsed seconds and raw
+    RunResult of rsync
+    """
+
+    def __init__(self, *, files, skipped, deleted, bytes_sent, bytes_received, elapsed, result):
+        self.files = files
+        self.skipped = skipped
+        self.deleted = deleted
+        self.bytes_sent = bytes_sent
+        self.bytes_received = bytes_received
+        self.elapsed = elapsed
+        self.result = result
+
+    @property
+    def returncode(self):
+        return self.result.returncode
+
+    @property
+    def transferred(self):
+        """Bytes of file data transferred, after delta encoding"""
+        return sum(f.bytes for f in self.files)
+
+    @property
+    def size(self):
+        """Total size of transferred files"""
+        return sum(f.size for f in self.files)
+
+    def __repr__(self):
+        return f'SyncReport(files={len(self.files)}, skipped={self.skipped}, deleted={len(self.deleted)}, ' \
+            f'bytes_sent={self.bytes_sent}, bytes_received={self.bytes_received}, elapsed={self.elapsed:.2f})'
+
+
+def parse_output(stdout):
+    """Parse rsync output produced with --out-format=OUT_FORMAT -ii --stats"""
+    files, deleted, stats = [], [], {}
+    skipped = 0
+    for line in stdout.split('\n'):
+        m = _item_re.match(line)
+        if m:
+            change, size, transferred, path = m.groups()
+            if change[1] == 'd':
+                continue
+            if change[0] == '.' and not change[2:].strip('. '):
+                skipped += 1
+            else:
+                files.append(FileTransfer(path, change, int(size), int(transferred)))
+            continue
+        m = _deleting_re.match(line)
+        if m:
+            deleted.append(m.group(1))
+            continue
+        m = _stat_re.match(line)
+        if m:
+            stats[m.group(1)] = int(float(m.group(2).replace(',', '')))
+    return files, skipped, deleted, stats.get('sent', 0), stats.get('received', 0)
+
+
+def rsync_command(src, dst, *, ssh, recursive=True, archive=False, compress=False, checksum=False, delete=False,
+                  partial=False, include=None, exclude=None, bwlimit=None, rsync_path=None, files_from=None,
+                  progress=False):
+    cmd = ['rsync', '-e', ssh, '-ii', '--out-format=' + OUT_FORMAT, '--stats']
+    if progress:
+        cmd.append('--info=progress2')
+    if archive:
+        cmd.append('-a')
+    elif recursive:
+        cmd.append('-r')
+    if compress:
+        cmd.append('-z')
+    if checksum:
+        cmd.append('--checksum')
+    if delete:
+        cmd.append('--delete')
+    if partial:
+        cmd.append('--partial')
+    if bwlimit:
+        cmd.append(f'--bwlimit={bwlimit}')
+    if rsync_path:
+        cmd.append(f'--rsync-path={rsync_path}')
+    if files_from:
+        cmd.append(f'--files-from={files_from}')
+    for pattern in include or []:
+        cmd.append(f'--include={pattern}')
+    for pattern in exclude or []:
+        cmd.append(f'--exclude={pattern}')
+    return [*cmd, src, dst]
+
+
+def _machine_rsync_command(machine, src, dst, direction, user, **options):
+    remote = f'{machine.username}@{machine.ip}:'
+    if direction == 'up':
+        src, dst = os.path.expanduser(src), remote + dst
+    else:
+        src, dst = remote + src, os.path.expanduser(dst)
+    if user:
+        options['rsync_path'] = 'sudo rsync' if user == 'root' else f'sudo -u {user} rsync'
+    cmd = rsync_command(src, dst, ssh=machine._ssh_command_str(), **options)
+    # src and dst go to the shell unquoted, as on a command line, so globs and several
+    # space separated paths work
+    return convert_list_command_to_str(cmd[:-2]) + f'{src} {dst}'
+
+
+def _span_labels(machine, src, dst, *, direction='up', **kwargs):
+    return {'machine': machine.name, 'direction': direction}
+
+
+@trace.traced('sync', _span_labels)
+def sync(machine, src, dst, *, direction='up', user=None, timeout=None, input=None, **options):
+    """
+    rsync src on local to dst on machine (direction='up') or src on machine to dst on
+    local (direction='down'), return SyncReport. src and dst are not quoted, so they can be
+    globs or several space separated paths. user runs the remote rsync with sudo -u user.
+    options are those of rsync_command: recursive, archive, compress, checksum, delete,
+    partial, include, exclude, bwlimit, files_from
+    """
+    cmd = _machine_rsync_command(
+        machine, src, dst, direction, user, **options)
+    start = time.time()
+    p = run(cmd, timeout=timeout, input=input)
+    elapsed = time.time() - start
+    files, skipped, deleted, sent, received = parse_output(p.stdout)
+    return SyncReport(files=files, skipped=skipped, deleted=deleted, bytes_sent=sent, bytes_received=received,
+                      elapsed=elapsed, result=p)
+
+
+@trace.traced('sync', _span_labels)
+def sync_progress(machine, src, dst, *, on_progress, direction='up', user=None, **options):
+    """
+    Same as sync, and call on_progress(bytes, percent, rate, eta) whenever rsync reports
+    overall progress of the transfer
+    """
+    cmd = _machine_rsync_command(machine, src, dst, direction, user,
+                                 progress=True, **options)
+    start = time.time()
+    q, _ = run_stream(cmd)
+    stdout, stderr, exitcode = [], [], []
+
+    def on_stdout(line):
+        m = _progress_re.match(line)
+        if m:
+            size, percent, rate, eta = m.groups()
+            on_progress(int(size.replace(',', '')), int(percent), rate, eta)
+        else:
+            stdout.append(line)
+    handle_stream(q, stdout_handler=on_stdout, stderr_handler=stderr.append,
+                  exit_handler=exitcode.append)
+    result = RunResult(stdout=''.join(stdout), stderr=''.join(
+        stderr), returncode=exitcode[0])
+    files, skipped, deleted, sent, received = parse_output(result.stdout)
+    return SyncReport(files=files, skipped=skipped, deleted=deleted, bytes_sent=sent, bytes_received=received,
+                      elapsed=time.time() - start, result=result)
+
+
+class Manifest:
+    """
+    Files of a local tree with size, mtime and optional sha256, scanned once and reused
+    to sync the same tree to many machines
+    """
+
+    def __init__(self, root, files):
+        self.root = root
+        self.files = files
+
+    @classmethod
+    def scan(cls, root, *, checksum=False):
+        root = os.path.expanduser(root)
+        files = {}
+        for dirpath, _, names in os.walk(root):
+            for name in names:
+                full = os.path.join(dirpath, name)
+                if os.path.islink(full) or not os.path.isfile(full):
+                    continue
+                st = os.stat(full)
+                digest = None
+                if checksum:
+                    h = hashlib.sha256()
+                    with open(full, 'rb') as f:
+                        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                            h.update(chunk)
+                    digest = h.hexdigest()
+                files[os.path.relpath(full, root)] = (
+                    st.st_size, int(st.st_mtime), digest)
+        return cls(root, files)
+
+    @staticmethod
+    def remote_cmd(path, checksum=False):
+        """Command printing the manifest of path on a machine, as parsed by parse_remote"""
+        if checksum:
+            return f"cd {path} 2>/dev/null && find . -type f -print0 | xargs -0 -r sha256sum"
+        return f"cd {path} 2>/dev/null && find . -type f -printf '%P\\t%s\\t%T@\\n'"
+
+    @staticmethod
+    def parse_remote(stdout, checksum=False):
+        files = {}
+        for line in stdout.split('\n'):
+            if not line:
+                continue
+            if checksum:
+                digest, path = line.split('  ', 1)
+                files[path[2:]] = (None, None, digest)
+            else:
+                path, size, mtime = line.rsplit('\t', 2)
+                files[path] = (int(size), int(float(mtime)), None)
+        return files
+
+    def changed(self, remote_files, checksum=False):
+        """Relative paths that differ from remote_files"""
+        result = []
+        for path, (size, mtime, digest) in self.files.items():
+            remote = remote_files.get(path)
+            if remote is None:
+                result.append(path)
+            elif checksum:
+                if remote[2] != digest:
+                    result.append(path)
+            elif remote[:2] != (size, mtime):
+                result.append(path)
+        return sorted(result)
+
+
+def sync_many(local_path, remote_path, machines, *, checksum=False, concurrency=None, user=None, **options):
+    """
+    Sync local directory local_path to remote_path on every machine. The local tree is
+    scanned once, then each machine reports its own file list in one command and rsync
+    only sends the files that differ (--files-from), instead of rsync rescanning the
+    local tree for every machine. Files are compared by size and mtime, or by sha256 if
+    checksum. Return list of SyncReport in order of machines, or PmapException for
+    machines that failed.
+    """
+    # mtime must be preserved to compare by mtime in later syncs
+    options.setdefault('archive', True)
+    src, dst = local_path.rstrip('/') + '/', remote_path.rstrip('/') + '/'
+    if options.get('delete'):
+        # --files-from cannot delete extraneous files, let rsync compare whole trees
+        def sync_full(machine):
+            report = sync(machine, src, dst, user=user,
+                          checksum=checksum, **options)
+            if report.returncode != 0:
+                raise UploadException(report.result.stderr)
+            return report
+        return pmap(sync_full, machines, on_exception='return', concurrency=concurrency)
+
+    manifest = Manifest.scan(local_path, checksum=checksum)
+
+    def sync_one(machine):
+        p = machine.run(Manifest.remote_cmd(remote_path, checksum))
+        changed = manifest.changed(Manifest.parse_remote(p.stdout, checksum) if p.returncode == 0 else {},
+                                   checksum)
+        if not changed:
+            return SyncReport(files=[], skipped=len(manifest.files), deleted=[], bytes_sent=0, bytes_received=0,
+                              elapsed=0, result=p)
+        report = sync(machine, src, dst, user=user, files_from='-',
+                      input=''.join(path + '\n' for path in changed), **options)
+        report.skipped += len(manifest.files) - len(changed)
+        if report.returncode != 0:
+            raise UploadException(report.result.stderr)
+        return report
+    return pmap(sync_one, machines, on_exception='return', concurrency=concurrency)
@@ -0,0 +1,58 @@
+from rc import RunResult, RunException, STDOUT, STDERR, EXIT
+from rc.aio import arun, arun_stream, agather
+from rc.exception import PmapException
+import asyncio
+import pytest
+
+
+def test_arun():
+    p = asyncio.run(arun('cat', input='hello world\naaa'))
+    assert isinstance(p, RunResult)
+    assert p == RunResult(stdout='hello world\naaa', stderr='', returncode=0)
+    assert asyncio.run(arun(['cat', '"~"'])) == asyncio.run(arun('cat "~"'))
+
+
+def test_arun_timeout():
+    with pytest.raises(RunException):
+        asyncio.run(arun('sleep 10', timeout=0.5))
+
+
+def test_arun_stream():
+    async def collect():
+        return [e async for e in arun_stream('sh', input='''
+        echo to stdout
+        sleep 0.5
+        echo 1>&2 to stderr
+        sleep 0.5
+        echo hello world
+        exit 1
+        ''')]
+    assert asyncio.run(collect()) == [(STDOUT, 'to stdout\n'), (STDERR, 'to stderr\n'),
+                                      (STDOUT, 'hello world\n'), (EXIT, 1)]
+
+
+
+def test_arun_stream_long_line(monkeypatch):
+    from rc import aio
+    monkeypatch.setattr(aio, 'STREAM_LIMIT', 1024)
+
+    async def collect():
+        events = []
+        with pytest.raises(RunException):
+            async for e in arun_stream('echo short; head -c 4096 /dev/zero | tr "\\0" x; echo'):
+                events.append(e)
+        return events
+    assert asyncio.run(asyncio.wait_for(collect(), 10)) == [(STDOUT, 'short\n')]
+
+
+def test_agather():
+    async def echo(i):
+        return (await arun(f'sleep 0.5; echo {i}')).stdout
+
+    async def fail(i):
+        raise ValueError(i)
+
+    results = asyncio.run(agather(echo, range(20), concurrency=10))
+    assert results == [f'{i}\n' for i in range(20)]
+    results = asyncio.run(agather(fail, range(2), on_exception='ignore'))
+    assert all(isinstance(r, PmapException) for r in results)
@@ -1 +1,87 @@
 from rc import aws
+import json
+from rc.inventory import Inventory
+from rc.util import RunResult, pmap
+from rc.watch import StatusWatcher
+
+
+def fake_aws(calls, instances):
+    # describe-regions and describe-instances with tag:Name and instance-id filters
+    def run(cmd, **kwargs):
+        calls.append(cmd)
+        if cmd[2] == 'describe-regions':
+            regions = [{'RegionName': f'region-{i}'} for i in range(17)]
+            return RunResult(stdout=json.dumps({'Regions': regions}), stderr='', returncode=0)
+        region = cmd[cmd.index('--region') + 1]
+        found = [i for i in instances if i['Placement']['AvailabilityZone'][:-1] == region]
+        for f in cmd[cmd.index('--filters') + 1:] if '--filters' in cmd else []:
+            key, _, values = f.partition(',Values=')
+            if key == 'Name=tag:Name':
+                found = [i for i in found if i['Tags'][0]['Value'] in values.split(',')]
+            elif key == 'Name=instance-id':
+                found = [i for i in found if i['InstanceId'] in values.split(',')]
+        return RunResult(stdout=json.dumps({'Reservations': [{'Instances': found}]}), stderr='', returncode=0)
+    return run
+
+
+def instance(name, id_, region):
+    return {'Tags': [{'Key': 'Name', 'Value': name}], 'InstanceId': id_, 'State': {'Name': 'running'},
+            'Placement': {'AvailabilityZone': region + 'a'}, 'PublicIpAddress': '10.0.0.1'}
+
+
+def test_aws_region_index(tmp_path, monkeypatch):
+    calls = []
+    instances = [instance('node0', 'i-0', 'region-3'), instance('node1', 'i-1', 'region-5')]
+    monkeypatch.setattr(aws, 'run', fake_aws(calls, instances))
+    monkeypatch.setattr(aws, 'inventory', Inventory(directory=str(tmp_path / 'inventory')))
+    monkeypatch.setattr(aws, 'region_index', aws.RegionIndex(str(tmp_path / 'aws-regions.json')))
+    aws._get_regions.cache_clear()
+
+    # A miss sweeps every region once and builds the index
+    assert aws.get('node0').id == 'i-0'
+    assert len(calls) == 18
+    assert aws.region_index.regions() == ['region-3', 'region-5']
+
+    # Then a lookup is one call in the right region, filtered on the server side
+    calls.clear()
+    aws.inventory.invalidate()
+    assert aws.get('node1').region == 'region-5'
+    assert aws.get('i-0').name == 'node0'
+    assert len(calls) == 2 and '--filters' in calls[0]
+    calls.clear()
+    assert [m.name for m in aws.get_many(['node0', 'node1', 'i-1'])] == ['node0', 'node1', 'node1']
+    assert len(calls) == 3
+    calls.clear()
+    assert aws.get('nope') is None
+    assert len(calls) == 17
+
+    # The index is persisted, and list only sweeps the regions holding instances
+    calls.clear()
+    aws.inventory.invalidate()
+    aws.region_index = aws.RegionIndex(str(tmp_path / 'aws-regions.json'))
+    assert sorted(m.name for m in aws.list()) == ['node0', 'node1']
+    assert len(calls) == 2
+
+    # While that listing is fresh, lookups need no call at all
+    calls.clear()
+    assert aws.get('node1').id == 'i-1'
+    assert calls == []
+
+    # A moved instance is found again by a full sweep, and so is a region given explicitly
+    instances[0]['Placement']['AvailabilityZone'] = 'region-7a'
+    aws.inventory.invalidate()
+    assert aws.get('node0').region == 'region-7'
+    assert aws.region_index.region_of('node0') == 'region-7'
+    assert aws.get('node0', region='region-3') is None
+
+
+def test_aws_watch_unknown_ids(monkeypatch):
+    calls = []
+    monkeypatch.setattr(aws, 'run', fake_aws(calls, [instance('node0', 'i-0', 'region-3')]))
+    # An unknown id is left out instead of failing the whole call
+    assert list(aws.describe_instances(['i-0', 'i-purged'], 'region-3')) == ['i-0']
+    assert aws._terminated(None)
+    watcher = StatusWatcher(lambda ids: aws.describe_instances(ids, 'region-3'), min_interval=0.01)
+    running, purged = pmap(lambda id_, predicate: watcher.wait(id_, predicate, timeout=5),
+                           ['i-0', 'i-purged'], [aws._has_ip, aws._terminated])
+    assert running['InstanceId'] == 'i-0' and purged is None
@@ -0,0 +1,31 @@
+import json
+import pytest
+from rc.inventory import inventory
+from rc.bench.suite import run_suite, compare, format_results, bench_execute
+from rc.bench.sshd import LocalSshd, find_sshd
+
+
+def test_bench_fake_clouds():
+    directory = inventory.directory
+    report = run_suite(ns=[1, 3], latency=0, stream_lines=[10], benches=('resolve', 'pmap', 'stream'),
+                       log=lambda line: None)
+    assert inventory.directory == directory
+    results = {(r['bench'], r['case'], r['n']): r for r in report['results']}
+    assert results[('resolve', 'gcloud cold', 3)]['cli_calls'] == 1
+    assert results[('resolve', 'gcloud warm', 3)]['cli_calls'] == 0
+    assert results[('resolve', 'aws cold', 3)]['cli_calls'] == 18
+    assert results[('resolve', 'aws indexed', 3)]['cli_calls'] == 2
+    assert results[('stream', 'local', 10)]['lines_per_s'] > 0
+    assert ('pmap', 'process', 3) in results
+
+    report = json.loads(json.dumps(report))
+    assert all(row[-1] == 1 for row in compare(report, report))
+    assert 'aws indexed' in format_results(report)
+
+
+@pytest.mark.skipif(find_sshd() is None, reason='sshd is not installed')
+def test_bench_local_sshd():
+    with LocalSshd(2, port=22022) as sshd:
+        assert sshd.machines[0].ip != sshd.machines[1].ip
+        results = bench_execute(sshd.machines, [2])
+    assert [r['failed'] for r in results] == [0, 0]
@@ -1,6 +1,12 @@
 from rc.test.util import Timer
-from rc import gcloud
-from rc.util import go, pmap, as_completed
+from rc import Machine, gcloud
+from rc.util import go, pmap, pimap, as_completed, set_limit, limited, RunResult
+from rc.exception import PmapException
+from rc.inventory import Inventory
+import pytest
+from threading import Lock
+import re
+import time
 
 
 def create_or_get(*, name, **kwargs):
@@ -29,3 +35,137 @@ def test_create_delete_5_instance():
 
     for m in machines:
         assert gcloud.get(m.name) is None
+
+
+def test_create_delete_many_5_instance():
+    names = ["test-rc-many-" + str(i) for i in range(5)]
+    with Timer('create 5 instances in bulk'):
+        machines = gcloud.create_many(names, machine_type="n1-standard-1", disk_size="20G",
+                                      image_project='ubuntu-os-cloud', image_family='ubuntu-1804-lts',
+                                      zone='us-west2-a', firewall_allows=['tcp:8080'])
+    assert [m.name for m in machines] == names
+    assert all(m.run('echo a').stdout == 'a\n' for m in machines)
+    with Timer('delete 5 instances in bulk'):
+        gcloud.delete_many(machines)
+    assert gcloud.get_many(names) == [None] * 5
+    assert not gcloud.firewall_exist('test-rc-many')
+
+
+def fake_gcloud(instances, firewalls):
+    """run of gcloud commands used by create_many and delete_many, on instances {name: tags} and firewalls"""
+    def names_of(filter):
+        return re.match(r'name=\((.*?)\)', filter).group(1).split()
+
+    def run(cmd, **kwargs):
+        args = dict(zip(cmd, cmd[1:]))
+        stdout = ''
+        if cmd[2:4] == ['firewall-rules', 'describe']:
+            return RunResult('', '', 0 if cmd[4] in firewalls else 1)
+        if cmd[2:4] == ['firewall-rules', 'create']:
+            firewalls[cmd[4]] = args.get('--description')
+        elif cmd[2:4] == ['firewall-rules', 'list']:
+            stdout = '\n'.join(n for n in names_of(args['--filter']) if n in firewalls and
+                               (' AND description' not in args['--filter'] or firewalls[n] == 'python-rc'))
+        elif cmd[2:4] == ['firewall-rules', 'delete']:
+            for name in cmd[4:cmd.index('--project')]:
+                del firewalls[name]
+        elif cmd[2:4] == ['instances', 'bulk-create']:
+            for name in args['--predefined-names'].split(','):
+                instances[name] = args.get('--tags', '').split(',')
+        elif cmd[2:4] == ['instances', 'delete']:
+            for name in cmd[4:cmd.index('--zone')]:
+                del instances[name]
+        elif cmd[2:4] == ['instances', 'list']:
+            names = names_of(args['--filter']) if '--filter' in args else instances
+            stdout = '\n'.join(';'.join(instances[n]) for n in names if n in instances)
+        return RunResult(stdout, '', 0)
+    return run
+
+
+def test_delete_many_firewalls(monkeypatch):
+    instances, firewalls = {'other': ['web']}, {'web': None}
+    monkeypatch.setattr(gcloud, 'run', fake_gcloud(instances, firewalls))
+    monkeypatch.setattr(gcloud, 'inventory', Inventory(persist=False))
+    monkeypatch.setattr(gcloud, '_generate_gcloud_ssh_key', lambda: None)
+    monkeypatch.setattr(gcloud, '_get_username', lambda project: 'u')
+    monkeypatch.setattr(gcloud, '_wait_running_many', lambda names, project: {n: '10.0.0.1' for n in names})
+    options = dict(project='p', machine_type='n1-standard-1', disk_size='20G', image_project='ubuntu-os-cloud',
+                   zone='us-west2-a', reserve_ip=False, wait_ssh=False)
+    first = gcloud.create_many(['test-rc-many-0', 'test-rc-many-1'], firewall_allows=['tcp:8080'], **options)
+    second = gcloud.create_many(['test-rc-many-2'], firewall_allows=['tcp:8080'], firewall_name='test-rc-many',
+                                **options)
+    assert firewalls == {'web': None, 'test-rc-many': 'python-rc'}
+    # A firewall is kept while a machine still uses it, and firewalls not created by rc are kept
+    gcloud.delete_many(first)
+    assert 'test-rc-many' in firewalls
+    gcloud.delete_many(second + [Machine(provider=gcloud, name='other', zone='us-west2-a', ip='', username='u',
+                                         ssh_key_path='k', project='p')])
+    assert instances == {} and firewalls == {'web': None}
+
+
+def test_pmap_nested():
+    # Nested pmap must not deadlock even when every level is saturated
+    assert pmap(lambda i: sum(pmap(lambda j: i * j, range(8), concurrency=2)),
+                range(8), concurrency=2) == [i * 28 for i in range(8)]
+
+
+def test_pmap_concurrency_and_limit():
+    running = []
+    peak = []
+    lock = Lock()
+
+    def task(i):
+        with lock:
+            running.append(i)
+            peak.append(len(running))
+        time.sleep(0.1)
+        with lock:
+            running.remove(i)
+        return i
+    assert pmap(task, range(20), concurrency=5) == list(range(20))
+    assert max(peak) == 5
+
+    peak.clear()
+    set_limit('test-provider', 3)
+    pmap(limited('test-provider', task), range(20), concurrency=20)
+    assert max(peak) == 3
+
+
+def test_pimap_as_completed():
+    start = time.time()
+    results = pimap(lambda i: time.sleep(i) or i, [0.6, 0.2, 0.4])
+    assert next(results) == 0.2
+    assert time.time() - start < 0.5
+    assert list(results) == [0.4, 0.6]
+    assert list(pmap(lambda i: time.sleep(i) or i,
+                     [0.4, 0.1], ordered=False)) == [0.1, 0.4]
+    assert list(pimap(lambda i: time.sleep(i) or i,
+                      [0.4, 0.1], ordered=True)) == [0.4, 0.1]
+
+
+def test_pimap_item_timeout_and_fail_fast():
+    results = list(pimap(lambda i: time.sleep(i) or i, [0.1, 5],
+                         item_timeout=0.5, on_exception='return'))
+    assert results[0] == 0.1
+    assert isinstance(results[1], PmapException)
+
+    with pytest.raises(ValueError):
+        list(pimap(lambda i: int(i), ['1', 'x', '3']))
+
+    def task(i):
+        time.sleep(i)
+        if i == 0.1:
+            raise ValueError(i)
+        return i
+    start = time.time()
+    results = list(pimap(task, [0.1, 3, 3], on_exception='return',
+                         fail_fast=True, concurrency=1))
+    assert len(results) == 1 and isinstance(results[0], PmapException)
+    assert time.time() - start < 1
+
+    # Ordered, nothing is yielded past the task still running when another one failed
+    results = []
+    with pytest.raises(PmapException):
+        for r in pimap(task, [0.01, 1, 0.1, 0.01], on_exception='return', fail_fast=True, ordered=True):
+            results.append(r)
+    assert results == [0.01]
@@ -0,0 +1,83 @@
+from rc import Machine, gcloud
+from rc.cli import config
+from rc.inventory import inventory
+from rc.exception import RcException
+import pytest
+import os
+
+
+def fake_get_many(calls):
+    def get_many(names, *, project=None, username=None, **kwargs):
+        calls.append((names, project))
+        return [Machine(provider=gcloud, name=n, zone='us-west2-a', ip='10.0.0.1', username=username,
+                        ssh_key_path='~/.ssh/id_rsa', project=project) if n.startswith('node') else None
+                for n in names]
+    return get_many
+
+
+def test_resolve_specs_batches_by_provider_args(monkeypatch):
+    calls = []
+    monkeypatch.setattr(gcloud, 'get_many', fake_get_many(calls))
+    machines = config.resolve_specs(['node1', 'node2', {'name': 'node3', 'project': 'other'}, 'node4'],
+                                    {'provider': 'gcloud', 'project': 'main', 'username': 'u'})
+    assert [m.name for m in machines] == ['node1', 'node2', 'node3', 'node4']
+    assert sorted(calls) == [(['node1', 'node2', 'node4'], 'main'), (['node3'], 'other')]
+    assert machines[2].project == 'other' and machines[0].username == 'u'
+
+
+def test_resolve_specs_reports_all_missing(monkeypatch):
+    monkeypatch.setattr(gcloud, 'get_many', fake_get_many([]))
+    with pytest.raises(RcException) as e:
+        config.resolve_specs(['node1', 'x1', 'x2'], {'provider': 'gcloud'})
+    assert 'gcloud.x1, gcloud.x2' in str(e.value)
+
+
+def test_group_cache(monkeypatch, tmp_path):
+    calls = []
+    monkeypatch.setattr(gcloud, 'get_many', fake_get_many(calls))
+    group = tmp_path / 'group'
+    group.write_text('default:\n  provider: gcloud\n  project: main\nmachines:\n- node1\n- node2\n')
+    machines = config.resolve_group(str(group))
+    assert config.resolve_group(str(group)) == machines
+    assert len(calls) == 1
+    assert (tmp_path / '.group.json').exists()
+
+    config.resolve_group(str(group), refresh=True)
+    assert len(calls) == 2
+
+    group.write_text('default:\n  provider: gcloud\n  project: main\nmachines:\n- node1\n')
+    os.utime(str(group), (0, 0))
+    assert [m.name for m in config.resolve_group(str(group))] == ['node1']
+    assert len(calls) == 3
+
+
+def test_group_refresh_skips_cached_listing(monkeypatch, tmp_path):
+    ips = ['10.0.0.1']
+    monkeypatch.setattr(inventory, 'directory', str(tmp_path / 'inventory'))
+    monkeypatch.setattr(gcloud, '_generate_gcloud_ssh_key', lambda: None)
+    monkeypatch.setattr(gcloud, '_list_instances', lambda project, transport=None: [
+        Machine(provider=gcloud, name='node1', zone='us-west2-a', ip=ips[0], username=None,
+                ssh_key_path='~/.ssh/id_rsa', project=project)])
+    inventory.invalidate()
+    group = tmp_path / 'group'
+    group.write_text('default:\n  provider: gcloud\n  project: main\n  username: u\nmachines:\n- node1\n')
+    try:
+        assert config.resolve_group(str(group))[0].ip == '10.0.0.1'
+        # ip changed, e.g. after a restart, while the listing is still cached
+        ips[0] = '10.0.0.2'
+        assert config.resolve_group(str(group))[0].ip == '10.0.0.1'
+        assert config.resolve_group(str(group), refresh=True)[0].ip == '10.0.0.2'
+        assert config.resolve_group(str(group))[0].ip == '10.0.0.2'
+    finally:
+        inventory.invalidate()
+
+
+def test_group_cache_unserializable(monkeypatch, tmp_path):
+    def get_many(names, **kwargs):
+        return [Machine(provider=gcloud, name=n, ip='10.0.0.1', username='u', ssh_key_path='k', labels={1, 2})
+                for n in names]
+    monkeypatch.setattr(gcloud, 'get_many', get_many)
+    group = tmp_path / 'group'
+    group.write_text('default:\n  provider: gcloud\nmachines:\n- node1\n')
+    assert config.resolve_group(str(group))[0].labels == {1, 2}
+    assert os.listdir(str(tmp_path)) == ['group']
@@ -0,0 +1,45 @@
+from rc.util import run
+import sys
+
+# Modules that only some subcommands or providers need, they must not be imported eagerly
+HEAVY_MODULES = ['rc.provider.gcloud', 'rc.provider.aws', 'rc.provider.azure', 'rc.provider.digitalocean',
+                 'libtmux', 'term', 'pytimeparse', 'yaml', 'asyncio', 'retry']
+# Generous bound, a regression that imports a provider or libtmux again is several times slower
+IMPORT_TIME_BUDGET = 0.5
+
+
+def imported_modules(statement):
+    p = run([sys.executable, '-c', f"'{statement}; import sys; print(chr(10).join(sys.modules))'"])
+    assert p.returncode == 0, p.stderr
+    return set(p.stdout.split())
+
+
+def import_time(statement, repeat=5):
+    script = f'''
+import subprocess, sys, time
+best = None
+for _ in range({repeat}):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', '{statement}'], check=True)
+    t = time.perf_counter() - start
+    best = t if best is None else min(best, t)
+start = time.perf_counter()
+for _ in range({repeat}):
+    subprocess.run([sys.executable, '-c', 'pass'], check=True)
+print(best - (time.perf_counter() - start) / {repeat})
+'''
+    return float(run([sys.executable], input=script).stdout)
+
+
+def test_lazy_import():
+    for statement in ['import rc', 'import rc.cli']:
+        modules = imported_modules(statement)
+        assert not modules & set(HEAVY_MODULES), statement
+    assert 'rc.provider.gcloud' in imported_modules('from rc import gcloud')
+
+
+def test_import_time():
+    for statement in ['import rc', 'import rc.cli']:
+        t = import_time(statement)
+        print(f'{statement}: {t * 1000:.1f}ms')
+        assert t < IMPORT_TIME_BUDGET
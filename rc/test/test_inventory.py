@@ -0,0 +1,77 @@
+import os
+from rc import Machine, gcloud
+from rc.inventory import Inventory
+
+
+def fake_list(calls):
+    def fetch():
+        calls.append(1)
+        return [Machine(provider=gcloud, name=f'node{i}', zone='us-west2-a', ip=f'10.0.0.{i}',
+                        username=None, ssh_key_path='~/.ssh/id_rsa', project='p') for i in range(3)]
+    return fetch
+
+
+def test_inventory_lookup(tmp_path):
+    calls = []
+    inventory = Inventory(directory=str(tmp_path))
+    fetch = fake_list(calls)
+    assert inventory.lookup(gcloud, 'p', 'node1', fetch).ip == '10.0.0.1'
+    assert inventory.lookup(gcloud, 'p', '10.0.0.2', fetch).name == 'node2'
+    assert len(inventory.machines(gcloud, 'p', fetch)) == 3
+    assert len(calls) == 1
+
+    # Returned machines are copies
+    inventory.lookup(gcloud, 'p', 'node1', fetch).ip = '1.1.1.1'
+    assert inventory.lookup(gcloud, 'p', 'node1', fetch).ip == '10.0.0.1'
+
+    # A miss refreshes only when the snapshot is old enough
+    assert inventory.lookup(gcloud, 'p', 'node9', fetch) is None
+    assert len(calls) == 1
+    inventory.miss_refresh = 0
+    assert inventory.lookup(gcloud, 'p', 'node9', fetch) is None
+    assert len(calls) == 2
+
+
+def test_inventory_persist_and_invalidate(tmp_path):
+    calls = []
+    fetch = fake_list(calls)
+    Inventory(directory=str(tmp_path)).machines(gcloud, 'p', fetch)
+    inventory = Inventory(directory=str(tmp_path))
+    m = inventory.lookup(gcloud, 'p', 'node0', fetch)
+    assert m.provider is gcloud and m.project == 'p'
+    assert len(calls) == 1
+
+    inventory.invalidate(gcloud)
+    inventory.lookup(gcloud, 'p', 'node0', fetch)
+    assert len(calls) == 2
+
+    inventory.ttl = 0
+    inventory.machines(gcloud, 'p', fetch)
+    assert len(calls) == 3
+
+
+def test_inventory_invalidate_during_fetch(tmp_path):
+    inventory = Inventory(directory=str(tmp_path))
+    calls = []
+    fetch = fake_list(calls)
+
+    def racing_fetch():
+        # A machine is created while the listing is in flight, the listing does not have it
+        machines = fetch()
+        inventory.invalidate(gcloud)
+        return machines
+    assert len(inventory.machines(gcloud, 'p', racing_fetch)) == 3
+    # The stale listing was not kept, the next call lists again
+    inventory.machines(gcloud, 'p', fetch)
+    assert len(calls) == 2
+    inventory.machines(gcloud, 'p', fetch)
+    assert len(calls) == 2
+
+
+def test_inventory_unserializable(tmp_path):
+    def fetch():
+        return [Machine(provider=gcloud, name='node0', ip='10.0.0.0', username=None, ssh_key_path='k',
+                        labels={1, 2})]
+    inventory = Inventory(directory=str(tmp_path))
+    assert inventory.lookup(gcloud, 'p', 'node0', fetch).labels == {1, 2}
+    assert os.listdir(str(tmp_path)) == []
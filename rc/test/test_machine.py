@@ -0,0 +1,195 @@
+from rc import Machine, gcloud
+import os
+import sys
+import time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from rc import agent, agent_server, job, pmap
+from rc.agent import AgentClient, AGENT_DIGEST, connect
+from rc.exception import AgentException, RunException
+from rc.ssh import pool
+
+
+class LocalMachine(Machine):
+    """Machine whose commands run in a local shell instead of over ssh"""
+
+    def _ssh_shell(self):
+        return ['/bin/sh', '-c']
+
+
+def local_machine():
+    return LocalMachine(provider=gcloud, name='local', ip='127.0.0.1', username='u', ssh_key_path='k')
+
+
+def test_write_and_read(tmp_path):
+    m = local_machine()
+    path = str(tmp_path / 'f')
+    data = bytes(range(256)) * 100
+    assert m.write_file(path, data, compress=True).returncode == 0
+    assert m.read(path, binary=True) == data
+    m.edit(path, 'line')
+    assert m.read(path) == 'line\n'
+    # edit writes through a symlink instead of replacing it
+    link = tmp_path / 'link'
+    link.symlink_to(path)
+    m.edit(str(link), 'other')
+    assert link.is_symlink() and open(path).read() == 'other\n'
+
+
+def test_ensure_file(tmp_path):
+    m = local_machine()
+    path = str(tmp_path / 'conf')
+    assert m.ensure_file(path, 'a=1\n', mode='600')
+    assert open(path).read() == 'a=1\n'
+    assert not m.ensure_file(path, 'a=1\n')
+    # Cached version still matches, only a stat is run
+    runs = []
+    run = m.run
+    m.run = lambda cmd, **kwargs: runs.append(cmd) or run(cmd, **kwargs)
+    assert not m.ensure_file(path, 'a=1\n')
+    assert len(runs) == 1 and runs[0].startswith('stat')
+    # Changed behind our back, cache is not trusted
+    with open(path, 'w') as f:
+        f.write('a=2\n')
+    assert m.ensure_file(path, b'a=1\n')
+    assert open(path).read() == 'a=1\n'
+
+
+def test_ensure_lines(tmp_path):
+    m = local_machine()
+    path = tmp_path / 'hosts'
+    path.write_text("127.0.0.1 localhost")
+    assert m.ensure_lines(str(path), ["10.0.0.1 a", "10.0.0.2 'b' $c"])
+    assert path.read_text() == "127.0.0.1 localhost\n10.0.0.1 a\n10.0.0.2 'b' $c\n"
+    assert not m.ensure_lines(str(path), "10.0.0.1 a\n127.0.0.1 localhost")
+    assert not m.ensure_lines(str(path), ["10.0.0.1 a", "10.0.0.2 'b' $c"])
+    path.write_text('')
+    assert m.ensure_lines(str(path), ["10.0.0.1 a", "10.0.0.2 'b' $c"])
+    assert path.read_text() == "10.0.0.1 a\n10.0.0.2 'b' $c\n"
+    # A trailing newline does not add a blank line
+    assert m.ensure_lines(str(path), "10.0.0.3 d\n")
+    assert path.read_text() == "10.0.0.1 a\n10.0.0.2 'b' $c\n10.0.0.3 d\n"
+
+
+def test_batch(tmp_path):
+    m = local_machine()
+    runs = []
+    shell = m._ssh_shell
+    m._ssh_shell = lambda: runs.append(1) or shell()
+    sentinel_like = 'python-rc-0000 0 0 5 5\n'
+    with m.batch() as b:
+        d = b.ensure_dir(str(tmp_path / 'app'))
+        w = b.write_file(str(tmp_path / 'app' / 'bin'), b'\x00\xffdata', mode='755')
+        r = b.run(f'cat; printf {sentinel_like!r}; echo err >&2; exit 3', input='in\n')
+        s = b.bash('echo $0; false; echo not reached')
+    assert len(runs) == 1
+    assert d.result().returncode == 0 and w.result().returncode == 0
+    assert (tmp_path / 'app' / 'bin').read_bytes() == b'\x00\xffdata'
+    assert r.result() == ('in\n' + sentinel_like, 'err\n', 3)
+    assert s.result().stdout == 'bash\n' and s.result().returncode == 1
+
+    with m.batch(stop_on_error=True) as b:
+        first = b.run('exit 2')
+        second = b.run(f'touch {tmp_path}/second')
+    assert first.result().returncode == 2 and second.result().returncode == 2
+    assert not (tmp_path / 'second').exists()
+
+
+def test_agent_client(tmp_path):
+    client = AgentClient([sys.executable, agent_server.__file__])
+    assert client.start() is None
+    p = client.run('cat; echo err >&2; exit 3', input=b'in')
+    assert p == ('in', 'err\n', 3)
+    assert client.python('import sys\nprint(1 + 1)\nsys.exit(4)') == ('2\n', '', 4)
+    path = str(tmp_path / 'f')
+    client.write(path, b'\x00data', mode='600')
+    assert client.read(path) == b'\x00data'
+    assert client.stat(path)['mode'] == 0o600
+    with pytest.raises(AgentException):
+        client.read(str(tmp_path / 'missing'))
+    with pytest.raises(RunException):
+        client.run('sleep 5', timeout=0.1)
+    # Concurrent requests don't wait for each other
+    start = time.time()
+    slow = ThreadPoolExecutor(2).submit(client.run, 'sleep 1; echo slow')
+    time.sleep(0.1)
+    assert client.read(path) == b'\x00data' and time.time() - start < 0.5
+    assert client.run('echo fast').stdout == 'fast\n' and time.time() - start < 0.5
+    assert slow.result().stdout == 'slow\n'
+    # A request the agent doesn't answer in time gives up on the agent
+    with pytest.raises(AgentException, match='did not respond'):
+        client.request('run', wait=0.2, cmd='sleep 5', timeout=None, input=None)
+    assert not client.alive
+    with pytest.raises(AgentException, match='agent is not running'):
+        client.run('true')
+
+
+def test_machine_agent(monkeypatch, tmp_path):
+    m = local_machine()
+    m.use_agent(python_path=sys.executable, directory=str(tmp_path))
+    assert m.run('echo $PPID').stdout == m.run('echo $PPID').stdout
+    assert m._agent_failed == 0
+    assert (tmp_path / f'agent-{AGENT_DIGEST}.py').exists()
+    m.write_file(str(tmp_path / 'f'), 'x')
+    assert m.read(str(tmp_path / 'f')) == 'x'
+    # Only scripts for the agent's interpreter run in it
+    pid = 'import os\nprint(os.getpid())'
+    assert m.python(pid, python_path=sys.executable).stdout == m.python(pid, python_path=sys.executable).stdout
+    assert m.python(pid).stdout != m.python(pid).stdout
+    m.close()
+    # Concurrent first calls start one agent
+    m = local_machine()
+    m.use_agent(python_path=sys.executable, directory=str(tmp_path))
+    connects = []
+    monkeypatch.setattr(agent, 'connect', lambda *args, **kwargs: connects.append(1) or time.sleep(0.2) or
+                        connect(*args, **kwargs))
+    assert [p.stdout for p in pmap(lambda _: m.run('echo ok'), range(8))] == ['ok\n'] * 8
+    assert len(connects) == 1
+    m.close()
+    # Falls back to plain ssh when agent cannot start
+    m = local_machine()
+    m.use_agent(python_path='/nonexistent/python3', directory=str(tmp_path))
+    assert m.run('echo ok').stdout == 'ok\n'
+    assert m._agent_client is None and m._agent_failed > 0
+
+
+def test_jobs(monkeypatch, tmp_path):
+    monkeypatch.setattr(job, 'jobs_dir', str(tmp_path / 'jobs'))
+    monkeypatch.setattr(job, 'latest_pid', str(tmp_path / 'latest.pid'))
+    m = local_machine()
+    quick = m.run_bg('echo out; echo err >&2; exit 7')
+    slow = m.run_bg('sleep 30')
+    assert quick.id != slow.id
+    assert quick.wait() == 7
+    assert quick.tail() == 'out\n' and quick.tail(stderr=True) == 'err\n'
+    with pytest.raises(RunException):
+        slow.wait(timeout=0.2)
+    states = {j.id: s.state for j, s in m.jobs().items()}
+    assert states == {quick.id: 'exited', slow.id: 'running'}
+    assert job.statuses([quick, slow])[slow].state == 'running'
+    assert m.kill_bg(slow) == 143
+    assert slow.status() == (slow.id, 'exited', slow.status().pid, 143)
+
+    # Jobs started at the same time keep their own exit codes
+    started = pmap(lambda code: m.run_bg(f'sleep 0.5; exit {code}'), [3, 5])
+    assert [j.wait() for j in started] == [3, 5]
+    # The default pid file of kill_bg points to the latest job
+    latest = m.run_bg('sleep 30')
+    assert os.path.realpath(job.latest_pid) == latest.pid_file
+    assert latest.kill() == 143
+
+    # Output, pid and exit code files given like before jobs had their own directory
+    log, pid, exitcode = (str(tmp_path / name) for name in ['log', 'pid', 'exitcode'])
+    first = m.run_bg('echo first', stdout=log, stderr=log, pid=pid, exitcode=exitcode)
+    assert first.wait() == 0
+    second = m.run_bg('echo second; sleep 30', stdout=log, stderr=log, pid=pid, exitcode=exitcode)
+    assert second.status().state == 'running'
+    assert open(pid).read().strip() == str(second.status().pid)
+    assert second.kill() == 143
+    assert open(log).read() == 'first\nsecond\n'
+
+
+def test_port():
+    m = Machine(provider=gcloud, name='n', ip='127.0.0.1', username='u', ssh_key_path='k', port=2222, multiplex=False)
+    assert m._ssh_command()[-2:] == ['-p', '2222']
+    assert pool._key(m) != pool._key(m.copy(port=None))
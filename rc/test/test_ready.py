@@ -0,0 +1,71 @@
+import asyncio
+import socket
+import time
+from threading import Thread
+import pytest
+from rc.exception import MachineNotReadyException, PmapException
+from rc.ready import wait_ready, wait_all, backoff
+from rc.test.test_machine import LocalMachine
+from rc import gcloud
+
+
+def ssh_banner_server(delay=0):
+    """Port of a local server that answers like sshd after delay seconds"""
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    port = server.getsockname()[1]
+
+    def serve():
+        time.sleep(delay)
+        server.listen()
+        while True:
+            conn, _ = server.accept()
+            conn.sendall(b'SSH-2.0-OpenSSH_test\r\n')
+            conn.close()
+    Thread(target=serve, daemon=True).start()
+    return port
+
+
+def closed_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def machine(name='local'):
+    return LocalMachine(provider=gcloud, name=name, ip='127.0.0.1', username='u', ssh_key_path='k')
+
+
+def test_backoff():
+    assert backoff(0, initial=1, jitter=0) == 1
+    assert backoff(3, initial=1, jitter=0) == 8
+    assert backoff(30, initial=1, max_delay=10, jitter=0) == 10
+    assert 5 <= backoff(30, initial=1, max_delay=10, jitter=0.5) <= 10
+
+
+def test_wait_ready():
+    port = ssh_banner_server(delay=0.3)
+    elapsed = wait_ready(machine(), port=port, timeout=10, initial=0.05)
+    assert 0.3 <= elapsed < 5
+    start = time.time()
+    with pytest.raises(MachineNotReadyException, match='no ssh banner'):
+        wait_ready(machine(), port=closed_port(), timeout=0.5, initial=0.05)
+    assert time.time() - start < 2
+
+    # Also from a coroutine, whose event loop is running
+    async def in_loop():
+        return wait_ready(machine(), port=port, timeout=10, initial=0.05)
+    assert asyncio.run(in_loop()) < 5
+
+
+def test_wait_all():
+    good, bad = machine('good'), machine('bad')
+    port = ssh_banner_server()
+    bad.ip = None
+    results = wait_all([good, bad], port=port, timeout=0.5, initial=0.05, on_exception='return')
+    assert results[0] < 0.5
+    assert isinstance(results[1], PmapException)
+    with pytest.raises(MachineNotReadyException, match='gcloud.bad'):
+        wait_all([good, bad], port=port, timeout=0.5, initial=0.05)
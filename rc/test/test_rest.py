@@ -0,0 +1,137 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import pytest
+from rc import digitalocean, gcloud, rest
+from rc.exception import HttpException, RcException
+from rc.inventory import Inventory
+from rc.util import RunResult
+
+DROPLETS = [{'id': 100 + i, 'name': f'node{i}', 'status': 'active', 'region': {'slug': 'sfo2'},
+             'networks': {'v4': [{'type': 'private', 'ip_address': f'10.0.0.{i}'},
+                                 {'type': 'public', 'ip_address': f'1.1.1.{i}'}]}} for i in range(3)]
+
+INSTANCES = [{'name': f'node{i}', 'status': 'RUNNING',
+              'zone': 'https://www.googleapis.com/compute/v1/projects/p/zones/us-west2-a',
+              'networkInterfaces': [{'accessConfigs': [{'natIP': f'2.2.2.{i}'}]}]} for i in range(3)]
+
+
+class FakeApi(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    clients = set()
+    token = 'secret'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        FakeApi.clients.add(self.client_address)
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if self.headers['Authorization'] != f'Bearer {FakeApi.token}':
+            return self.reply(401, {'message': 'unauthorized'})
+        if url.path == '/v2/droplets':
+            # Two droplets per page
+            page = int(query['page'][0])
+            pages = {'next': 'more'} if page * 2 < len(DROPLETS) else {}
+            return self.reply(200, {'droplets': DROPLETS[page * 2 - 2:page * 2], 'links': {'pages': pages}})
+        if url.path.startswith('/v2/droplets/') and 0 <= int(url.path.split('/')[-1]) - 100 < len(DROPLETS):
+            return self.reply(200, {'droplet': DROPLETS[int(url.path.split('/')[-1]) - 100]})
+        if url.path == '/compute/v1/projects/p/aggregated/instances':
+            instances = INSTANCES
+            if 'filter' in query:
+                instances = [i for i in INSTANCES if f'"{i["name"]}"' in query['filter'][0]]
+            return self.reply(200, {'items': {'zones/us-west2-a': {'instances': instances},
+                                              'zones/us-east1-b': {'warning': {}}}})
+        if url.path == '/compute/v1/projects/p/zones/us-west2-a/instances/node1':
+            return self.reply(200, INSTANCES[1])
+        self.reply(404, {'message': 'not found'})
+
+
+@pytest.fixture
+def api(monkeypatch, tmp_path):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeApi)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}'
+    FakeApi.clients = set()
+    monkeypatch.setattr(digitalocean, 'api_url', url + '/v2')
+    monkeypatch.setattr(gcloud, 'api_url', url + '/compute/v1')
+    monkeypatch.setattr(digitalocean, 'inventory', Inventory(persist=False))
+    monkeypatch.setattr(gcloud, 'inventory', Inventory(persist=False))
+    monkeypatch.setattr(gcloud, '_generate_gcloud_ssh_key', lambda: None)
+    monkeypatch.setenv('DIGITALOCEAN_ACCESS_TOKEN', 'secret')
+    monkeypatch.setenv('CLOUDSDK_AUTH_ACCESS_TOKEN', 'secret')
+    digitalocean._api_token.cache_clear()
+    gcloud._api_token.cache_clear()
+    yield url
+    rest.close_sessions()
+    server.shutdown()
+    server.server_close()
+
+
+def test_session_keep_alive(api):
+    session = rest.Session(api + '/v2', auth=lambda: {'Authorization': 'Bearer secret'})
+    for _ in range(5):
+        assert session.get('/droplets/101')['droplet']['name'] == 'node1'
+    assert session.connections_opened == 1 and len(FakeApi.clients) == 1
+    with pytest.raises(HttpException) as e:
+        session.get('/nothing')
+    assert e.value.status == 404
+
+    # A connection the server closed while idle is replaced
+    FakeApi.timeout = 0.1
+    session.close()
+    try:
+        session.get('/droplets/101')
+        time.sleep(0.3)
+        assert session.get('/droplets/102')['droplet']['name'] == 'node2'
+    finally:
+        FakeApi.timeout = None
+    assert session.connections_opened == 3
+
+
+def test_digitalocean_rest(api, monkeypatch):
+    doctl = '\n'.join(f'sfo2 node{i} 1.1.1.{i} {100 + i}' for i in range(3))
+    monkeypatch.setattr(digitalocean, 'run', lambda cmd, **kwargs: RunResult(stdout=doctl, stderr='', returncode=0))
+    machines = digitalocean.list(transport='rest')
+    assert machines == digitalocean._list_droplets('cli')
+    assert [m.id for m in machines] == ['100', '101', '102']
+    assert digitalocean.get('node2', transport='rest', ssh_key_path='~/.ssh/k').id == '102'
+    assert digitalocean.status(machines[1], transport='rest') == 'active'
+    # A deleted droplet has an empty status, like from doctl
+    assert digitalocean.status(machines[1].copy(id='999'), transport='rest') == ''
+    assert digitalocean.droplets_status(transport='rest') == {'100': 'active', '101': 'active', '102': 'active'}
+    with pytest.raises(RcException):
+        digitalocean.list(transport='grpc', refresh=True)
+
+
+def test_gcloud_rest(api, monkeypatch):
+    cli = '\n'.join(f'us-west2-a node{i} 2.2.2.{i}' for i in range(3))
+    monkeypatch.setattr(gcloud, 'run', lambda cmd, **kwargs: RunResult(stdout=cli, stderr='', returncode=0))
+    monkeypatch.setattr(gcloud, 'transport', 'rest')
+    machines = gcloud.list(project='p', username='u')
+    assert machines == [gcloud._set_user(m, 'u', None) for m in gcloud._list_instances('p', 'cli')]
+    assert gcloud.get('node1', project='p', username='u').ip == '2.2.2.1'
+    assert gcloud.status(machines[1]) == 'RUNNING'
+    assert gcloud.status(machines[1].copy(name='deleted')) == ''
+    assert gcloud.instances_status(['node0', 'node2'], project='p') == {
+        'node0': ('RUNNING', '2.2.2.0'), 'node2': ('RUNNING', '2.2.2.2')}
+
+    # An expired token is fetched again once
+    FakeApi.token = 'renewed'
+    monkeypatch.setenv('CLOUDSDK_AUTH_ACCESS_TOKEN', 'renewed')
+    try:
+        assert gcloud.status(machines[1]) == 'RUNNING'
+    finally:
+        FakeApi.token = 'secret'
+    assert len(FakeApi.clients) == 1
@@ -1,4 +1,6 @@
 from rc import run, running, run_stream, handle_stream, STDERR, STDOUT, EXIT, print_stream, save_stream_to_file, gcloud
+from rc.util import run_chunks
+from rc.machine import write_file_cmd, iter_chunks, gzip_chunks
 import contextlib
 from io import StringIO
 import time
@@ -118,3 +120,24 @@ def test_tmux():
     machine.kill_detach_tmux()
     assert machine.run('cat /tmp/python-rc.log').stdout == 'aaaaaa\n'
     machine.delete()
+
+
+def test_run_chunks():
+    data = bytes(range(256)) * 1000
+    p = run_chunks('wc -c', [data[:1000], data[1000:]])
+    assert p.returncode == 0
+    assert p.stdout.strip() == str(len(data))
+
+
+def test_write_file_cmd(tmp_path):
+    path = tmp_path / 'f'
+    data = bytes(range(256)) * 1000 + b"c7a88caeb23f4ac0f377c59b703fb7f1091d0708\n'$x"
+    p = run_chunks(write_file_cmd(str(path), compressed=True, mode='600'),
+                   gzip_chunks(iter_chunks(data, 4096)))
+    assert p.returncode == 0, p.stderr
+    assert path.read_bytes() == data
+    assert path.stat().st_mode & 0o777 == 0o600
+    assert list(tmp_path.iterdir()) == [path]
+    p = run_chunks(write_file_cmd(str(path), append=True), iter_chunks('abc'))
+    assert p.returncode == 0
+    assert path.read_bytes() == data + b'abc'
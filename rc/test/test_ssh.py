@@ -0,0 +1,62 @@
+import subprocess
+from rc import Machine, gcloud, ssh
+from rc.ssh import ControlMasterPool
+
+
+def machine(**kwargs):
+    return Machine(provider=gcloud, name='n', **{'ip': '10.0.0.1', 'username': 'u', 'ssh_key_path': 'k', **kwargs})
+
+
+def test_key():
+    pool = ControlMasterPool(close_at_exit=False)
+    m = machine()
+    assert pool.control_path(m) == pool.control_path(machine())
+    for other in [machine(ip='10.0.0.2'), machine(username='v'), machine(ssh_key_path='k2'), machine(port=2222)]:
+        assert pool._key(other) != pool._key(m)
+        assert pool.control_path(other) != pool.control_path(m)
+
+
+def test_fallback(monkeypatch, tmp_path):
+    monkeypatch.setattr(ssh, 'control_dir', str(tmp_path))
+    pool = ControlMasterPool(retry_after=60, close_at_exit=False)
+    commands = []
+
+    def failed_run(cmd, **kwargs):
+        commands.append(cmd)
+        return subprocess.CompletedProcess(cmd, 255)
+    monkeypatch.setattr(subprocess, 'run', failed_run)
+    m = machine()
+    # Master cannot start, connect directly without waiting for it again for a while
+    assert pool.options(m) == []
+    assert pool.options(m) == []
+    assert len(commands) == 1
+    assert 'BatchMode=yes' in commands[0] and 'ConnectTimeout=10' in commands[0]
+    # Another machine is not affected
+    pool.options(machine(ip='10.0.0.2'))
+    assert len(commands) == 2
+    # Once a master is up, commands go through its socket
+    pool._failed.clear()
+    monkeypatch.setattr(subprocess, 'run', lambda cmd, **kwargs: open(pool.control_path(m), 'w').close()
+                        or subprocess.CompletedProcess(cmd, 0))
+    path = pool.control_path(m)
+    assert pool.options(m) == ['-o', 'ControlMaster=no', '-o', f'ControlPath={path}']
+    assert pool._masters == {pool._key(m): path}
+    # A dead master is discarded when checked
+    monkeypatch.setattr(subprocess, 'run', lambda cmd, **kwargs: subprocess.CompletedProcess(cmd, 255))
+    assert not pool.check(m)
+    assert pool._masters == {}
+    assert pool.options(machine(multiplex=False)) == []
+
+
+def test_close_keeps_sessions(monkeypatch, tmp_path):
+    monkeypatch.setattr(ssh, 'control_dir', str(tmp_path))
+    pool = ControlMasterPool(close_at_exit=False)
+    m = machine()
+    pool._masters[pool._key(m)] = pool.control_path(m)
+    commands = []
+    monkeypatch.setattr(subprocess, 'run', lambda cmd, **kwargs: commands.append(cmd)
+                        or subprocess.CompletedProcess(cmd, 0))
+    pool.close_all()
+    assert commands[0][3:5] == ['-O', 'stop'] and pool._masters == {}
+    # A shell command given out to outlive this process doesn't go through its master
+    assert 'ControlPath' not in machine().ssh_shell_str()
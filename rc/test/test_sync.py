@@ -0,0 +1,65 @@
+from rc.sync import parse_output, rsync_command, _machine_rsync_command, Manifest, _progress_re
+from rc import Machine, gcloud
+from rc.util import run
+import os
+
+RSYNC_OUTPUT = '''cd+++++++++ 4096 0 dir/
+>f+++++++++ 1000 1000 dir/new.txt
+>f.st...... 2000 120 dir/changed.txt
+.f          300 0 dir/same.txt
+*deleting   dir/old.txt
+*deleting   0 0 dir/old2.txt
+
+Number of files: 4 (reg: 3, dir: 1)
+Total bytes sent: 1,302
+Total bytes received: 95
+'''
+
+
+def test_parse_output():
+    files, skipped, deleted, sent, received = parse_output(RSYNC_OUTPUT)
+    assert [(f.path, f.size, f.bytes) for f in files] == [
+        ('dir/new.txt', 1000, 1000), ('dir/changed.txt', 2000, 120)]
+    assert skipped == 1
+    assert deleted == ['dir/old.txt', 'dir/old2.txt']
+    assert (sent, received) == (1302, 95)
+
+
+def test_rsync_command():
+    cmd = rsync_command('a/', 'u@1.2.3.4:b/', ssh='ssh', compress=True, delete=True, partial=True,
+                        include=['*.py'], exclude=['*'], bwlimit='10m', rsync_path='sudo rsync')
+    assert cmd[-2:] == ['a/', 'u@1.2.3.4:b/']
+    for option in ['-r', '-z', '--delete', '--partial', '--bwlimit=10m', '--rsync-path=sudo rsync']:
+        assert option in cmd
+    assert cmd.index('--include=*.py') < cmd.index('--exclude=*')
+
+
+def test_manifest_changed(tmp_path):
+    local, remote = tmp_path / 'local', tmp_path / 'remote'
+    for d in [local, remote]:
+        (d / 'sub').mkdir(parents=True)
+        (d / 'same.txt').write_text('same')
+        (d / 'sub' / 'changed.txt').write_text('local' if d == local else 'remote!')
+        os.utime(str(d / 'same.txt'), (1000, 1000))
+    (local / 'new.txt').write_text('new')
+
+    for checksum in [False, True]:
+        manifest = Manifest.scan(str(local), checksum=checksum)
+        # Remote side of the manifest runs on machines, check it locally
+        p = run(Manifest.remote_cmd(str(remote), checksum))
+        remote_files = Manifest.parse_remote(p.stdout, checksum)
+        assert manifest.changed(remote_files, checksum) == [
+            'new.txt', 'sub/changed.txt']
+
+
+def test_progress_line():
+    m = _progress_re.match('     32,768  45%   31.25MB/s    0:00:01 (xfr#1, to-chk=0/2)')
+    assert m.groups() == ('32,768', '45', '31.25MB/s', '0:00:01')
+    assert rsync_command('a', 'b', ssh='ssh', progress=True).count('--info=progress2') == 1
+
+
+def test_machine_rsync_command_paths():
+    m = Machine(provider=gcloud, name='n', ip='1.2.3.4', username='u', ssh_key_path='k', multiplex=False)
+    cmd = _machine_rsync_command(m, 'dir/* other', 'b/', 'up', 'root', exclude=['*.pyc'])
+    assert cmd.endswith('"--exclude=*.pyc" dir/* other u@1.2.3.4:b/')
+    assert '"--rsync-path=sudo rsync"' in cmd
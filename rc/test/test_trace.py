@@ -0,0 +1,88 @@
+import asyncio
+from rc import trace, run
+from rc.aio import arun
+from rc.cli import format_stats
+from rc.test.test_machine import local_machine
+
+
+def test_span_and_histogram(monkeypatch):
+    trace.reset()
+    spans = []
+    hook = trace.add_hook(spans.append)
+    try:
+        with trace.span('op', provider='p'):
+            pass
+        try:
+            with trace.span('op', provider='p'):
+                raise ValueError()
+        except ValueError:
+            pass
+    finally:
+        trace.remove_hook(hook)
+    assert [s.error for s in spans] == [None, 'ValueError']
+    h = trace.histograms()['op']
+    assert h.count == 2 and h.errors == 1 and h.max >= h.min >= 0
+    assert h.percentile(50) <= h.percentile(100) == h.max
+
+    # Disabled, spans are not recorded nor passed to hooks
+    trace.reset()
+    hook = trace.add_hook(spans.append)
+    monkeypatch.setattr(trace, 'enabled', False)
+    try:
+        with trace.span('op', provider='p'):
+            pass
+        run('true')
+    finally:
+        trace.remove_hook(hook)
+    assert len(spans) == 2 and trace.histograms() == {}
+    monkeypatch.setattr(trace, 'enabled', True)
+
+    h = trace.Histogram()
+    for d in [0.01] * 90 + [1.0] * 10:
+        h.add(d)
+    assert 0.01 <= h.percentile(50) < 0.02 and h.percentile(99) == 1.0
+
+
+def test_instrumented_calls(monkeypatch):
+    spans = []
+    hook = trace.add_hook(spans.append)
+    try:
+        run('true')
+        asyncio.run(arun(['true']))
+        local_machine().run('true')
+    finally:
+        trace.remove_hook(hook)
+    names = [(s.name, s.labels) for s in spans]
+    assert ('run', {'command': 'true'}) in names
+    assert ('arun', {'command': 'true'}) in names
+    assert ('Machine.run', {'provider': 'gcloud', 'machine': 'local'}) in names
+    assert trace.histograms()['run true'].count >= 1
+
+    # Disabled, nothing is recorded
+    spans.clear()
+    trace.add_hook(spans.append)
+    monkeypatch.setattr(trace, 'enabled', False)
+    try:
+        run('true')
+    finally:
+        trace.remove_hook(spans.append)
+    assert spans == []
+
+
+def test_export_and_stats(tmp_path):
+    path = str(tmp_path / 'trace.jsonl')
+    exporter = trace.add_hook(trace.JsonLinesExporter(path))
+    try:
+        with trace.span('gcloud.list', provider='gcloud'):
+            pass
+        run('sleep 0.05')
+    finally:
+        trace.remove_hook(exporter)
+        exporter.close()
+    with open(path, 'a') as f:
+        f.write('{"name": "cut')
+    spans = trace.read(path)
+    assert [s.key for s in spans] == ['gcloud.list', 'running sleep', 'run sleep']
+    output = format_stats(spans, top=2)
+    assert output.split('\n')[1].startswith('run sleep')
+    assert 'slowest:' in output and 'command=sleep' in output
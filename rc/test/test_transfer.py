@@ -0,0 +1,108 @@
+from rc import Machine, RunResult, gcloud
+from rc.sync import SyncReport
+from rc import transfer
+from rc.transfer import local_digest, remote_digest_cmd, gather, distribute, LOCAL, _schedule
+from rc.util import run
+
+
+def test_local_digest_matches_remote_digest(tmp_path):
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'a' / 'x.txt').write_text('hello\n')
+    (tmp_path / 'a' / 'B.bin').write_bytes(bytes(range(256)))
+    (tmp_path / 'top').write_text('top')
+    # Shell side of the digest runs on remote machines, check it locally
+    p = run(remote_digest_cmd(str(tmp_path), True))
+    assert p.stdout.strip() == local_digest(str(tmp_path))
+    p = run(remote_digest_cmd(str(tmp_path / 'top'), False))
+    assert p.stdout.strip() == local_digest(str(tmp_path / 'top'))
+    assert local_digest(str(tmp_path)) != local_digest(str(tmp_path / 'a'))
+
+
+def test_schedule():
+    a, b = object(), object()
+    assert _schedule([0, 1, 2, 3, 4], [LOCAL], 3) == [(LOCAL, 0), (LOCAL, 1), (LOCAL, 2)]
+    # Sources take turns, each sends to at most fanout targets
+    assert _schedule(list(range(10)), [LOCAL, a, b], 2) == [
+        (LOCAL, 0), (a, 1), (b, 2), (LOCAL, 3), (a, 4), (b, 5)]
+    # Direct targets go first and only from local
+    assert _schedule([0, 1, 2, 3], [LOCAL, a], 2, direct={3}) == [(LOCAL, 3), (a, 0), (LOCAL, 1), (a, 2)]
+
+
+class DistributeMachine(Machine):
+    """Machine whose digest command prints the expected digest"""
+
+    def run(self, cmd, **kwargs):
+        return RunResult(stdout=self.digest + '\n' if 'sha256sum' in cmd else '', stderr='', returncode=0)
+
+
+def test_distribute_tree(monkeypatch, tmp_path):
+    path = tmp_path / 'f'
+    path.write_text('data')
+    digest = local_digest(str(path))
+    machines = [DistributeMachine(provider=gcloud, name=f'm{i}', zone='z', ip=f'10.0.0.{i}', username='u',
+                                  ssh_key_path='k', multiplex=False, digest=digest) for i in range(13)]
+    relayed = []
+
+    def fake_run(cmd, shell=None, **kwargs):
+        if shell is not None:
+            relayed.append(shell[-2])
+        return RunResult(stdout='', stderr='', returncode=0)
+    monkeypatch.setattr(transfer, 'run', fake_run)
+    hops = distribute(str(path), '/tmp/f', machines, fanout=3, relay=True)
+    assert sorted(h.target for h in hops) == sorted(str(m) for m in machines)
+    # Local seeds 3, then local and the 3 seeded machines send to the other 10 in turns
+    assert [h.source for h in hops[:3]] == ['local'] * 3
+    assert sum(h.source == 'local' for h in hops) == 6
+    assert sorted(relayed) == sorted(['u@10.0.0.0', 'u@10.0.0.1', 'u@10.0.0.2'] * 2 + ['u@10.0.0.0'])
+    # Relays connect on their own, with the local agent forwarded
+    assert transfer._relay_shell(machines[0])[-4:] == ['ControlPath=none', '-A', 'u@10.0.0.0', '--']
+
+    # Hops between machines fail, every machine is uploaded to directly instead
+    def failing_relay(cmd, shell=None, **kwargs):
+        return RunResult(stdout='', stderr='Permission denied', returncode=255 if shell else 0)
+    monkeypatch.setattr(transfer, 'run', failing_relay)
+    hops = distribute(str(path), '/tmp/f', machines, fanout=3, relay=True)
+    assert len(hops) == 13 and all(h.source == 'local' for h in hops)
+    # Without relaying, the controller uploads to every machine
+    monkeypatch.setattr(transfer, 'run', fake_run)
+    relayed.clear()
+    assert len(distribute(str(path), '/tmp/f', machines, fanout=3, relay=False)) == 13
+    assert relayed == []
+
+
+class FakeMachine(Machine):
+    def sync(self, src, dst, *, direction='up', user=None, **options):
+        self.calls.append((src, dst, direction, options))
+        if self.name == 'bad':
+            return SyncReport(files=[], skipped=0, deleted=[], bytes_sent=0, bytes_received=0, elapsed=0,
+                              result=RunResult(stdout='', stderr='connection refused', returncode=255))
+        return SyncReport(files=[], skipped=0, deleted=[], bytes_sent=10, bytes_received=100, elapsed=1,
+                          result=RunResult(stdout='', stderr='', returncode=0))
+
+
+def test_gather_resume(tmp_path):
+    machines = [FakeMachine(provider=gcloud, name=name, ip='1.1.1.1', username='u', ssh_key_path='k', calls=[])
+                for name in ['good', 'bad']]
+    report = gather(machines, '/var/log/app', str(tmp_path), compress=True)
+    assert report.bytes == 100
+    assert list(report.failed) == ['gcloud.bad']
+    assert 'from 1/2 machines' in report.summary()
+    assert machines[0].calls[0][:3] == (
+        '/var/log/app', str(tmp_path / 'gcloud.good') + '/', 'down')
+    assert machines[0].calls[0][3]['partial'] and machines[0].calls[0][3]['compress']
+
+    # Completed machines are skipped when run again, not when gathering another path
+    report = gather(machines, '/var/log/app', str(tmp_path))
+    assert len(machines[0].calls) == 1 and len(machines[1].calls) == 2
+    gather(machines, '/var/log/other', str(tmp_path))
+    assert len(machines[0].calls) == 2 and len(machines[1].calls) == 3
+
+    # Once all machines succeeded, markers are removed and a new gather transfers everything
+    machines[1].name = 'fixed'
+    machines[0].calls.clear()
+    report = gather(machines, '/var/log/app', str(tmp_path))
+    assert not report.failed and machines[0].calls == []
+    # Only the marker of the failed gather of /var/log/other is left
+    assert len([p for p in tmp_path.iterdir() if p.name.endswith('.done')]) == 1
+    gather(machines, '/var/log/app', str(tmp_path))
+    assert len(machines[0].calls) == 1
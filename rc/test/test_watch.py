@@ -0,0 +1,49 @@
+import time
+import pytest
+from rc.util import pmap
+from rc.watch import StatusWatcher
+from rc.exception import RcException
+
+
+class FakeCloud:
+    """Machine i becomes RUNNING after ready[i] seconds, counts describe calls"""
+
+    def __init__(self, ready):
+        self.start = time.monotonic()
+        self.ready = ready
+        self.calls = []
+
+    def describe(self, keys):
+        self.calls.append(sorted(keys))
+        elapsed = time.monotonic() - self.start
+        return {k: 'RUNNING' if elapsed >= self.ready[k] else 'PROVISIONING' for k in keys if k in self.ready}
+
+
+def test_one_poll_for_many_waiters():
+    cloud = FakeCloud({i: 0.1 + i * 0.01 for i in range(50)})
+    watcher = StatusWatcher(cloud.describe, min_interval=0.05, max_interval=0.2)
+    statuses = pmap(lambda i: watcher.wait(i, lambda s: s == 'RUNNING', timeout=5), range(50), concurrency=50)
+    assert statuses == ['RUNNING'] * 50
+    # ~1s of polling at most every 0.05s, instead of one poll per machine per interval
+    assert len(cloud.calls) < 30
+    assert max(len(keys) for keys in cloud.calls) > 1
+
+
+def test_wait_many_and_timeout():
+    cloud = FakeCloud({'a': 0, 'b': 0.2})
+    watcher = StatusWatcher(cloud.describe, min_interval=0.05)
+    assert watcher.wait_many(['a', 'b'], lambda s: s == 'RUNNING', timeout=5) == {'a': 'RUNNING', 'b': 'RUNNING'}
+    # Missing keys have status None, e.g. deleted machines
+    assert watcher.wait('gone', lambda s: s is None, timeout=5) is None
+    with pytest.raises(RcException, match='never'):
+        watcher.wait('never', lambda s: s is not None, timeout=0.2)
+    time.sleep(0.3)
+    assert watcher._thread is None
+
+
+def test_adaptive_interval():
+    cloud = FakeCloud({'slow': 1})
+    watcher = StatusWatcher(cloud.describe, min_interval=0.02, max_interval=0.3, factor=2)
+    watcher.wait('slow', lambda s: s == 'RUNNING', timeout=5)
+    # Unchanged status backs off from 0.02s to 0.3s
+    assert len(cloud.calls) < 12
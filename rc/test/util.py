@@ -1,13 +1,17 @@
 from timeit import default_timer as timer
 from humanfriendly import format_timespan
+from rc import trace
 
 
 class Timer():
     def __init__(self, action):
         self.action = action
+        self.span = trace.span(action)
 
     def __enter__(self):
         self.start = timer()
+        self.span.__enter__()
 
     def __exit__(self, type, value, traceback):
+        self.span.__exit__(type, value, traceback)
         print("Time to", self.action+":", format_timespan(timer()-self.start))
@@ -0,0 +1,252 @@
+import atexit
+import bisect
+import inspect
+import json
+import os
+import time
+from contextlib import nullcontext
+from functools import wraps
+from threading import Lock
+
+# Set RC_TRACE=0, or enabled = False, to skip spans entirely
+enabled = os.environ.get('RC_TRACE') != '0'
+trace_path = os.path.expanduser('~/.python-rc/trace.jsonl')
+
+# Bucket upper bounds in seconds, from 100us doubling up to ~14 minutes
+BUCKETS = [1e-4 * 2 ** i for i in range(24)]
+
+_hooks = []
+_histograms = {}
+_lock = Lock()
+
+
+class Span:
+    """
+    Timing of one operation, e.g. a run of a command, a provider call or a Machine method.
+    name is the operation, labels say what it ran on, e.g. provider, machine or command.
+    Used as a context manager, it is reported to every hook when it exits.
+    """
+    __slots__ = ('name', 'labels', 'start', 'duration', 'error', '_t0')
+
+    def __init__(self, name, labels=None):
+        self.name = name
+        self.labels = labels or {}
+        self.start = None
+        self.duration = None
+        self.error = None
+
+    @property
+    def key(self):
+        """What spans are grouped by in histograms, name and the command of runs"""
+        command = self.labels.get('command')
+        return f'{self.name} {command}' if command else self.name
+
+    def __enter__(self):
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.duration = time.perf_counter() - self._t0
+        if type is not None:
+            self.error = type.__name__
+        _finish(self)
+
+    def to_dict(self):
+        return {'name': self.name, 'labels': self.labels, 'start': self.start,
+                'duration': self.duration, 'error': self.error}
+
+    @classmethod
+    def from_dict(cls, d):
+        span = cls(d['name'], d.get('labels'))
+        span.start, span.duration, span.error = d['start'], d['duration'], d.get('error')
+        return span
+
+    def __repr__(self):
+        labels = ', '.join(f'{k}={v}' for k, v in self.labels.items())
+        return f'Span({self.name}, {labels}, {self.duration})'
+
+
+class Histogram:
+    """Count, total, min, max and log scale buckets of durations"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.errors = 0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, duration, error=False):
+        self.count += 1
+        self.total += duration
+        self.min = duration if self.min is None else min(self.min, duration)
+        self.max = duration if self.max is None else max(self.max, duration)
+        self.errors += bool(error)
+        self.buckets[bisect.bisect_left(BUCKETS, duration)] += 1
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th percentile, capped by max"""
+        if not self.count:
+            return None
+        rank = q / 100 * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS + [self.max], self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+def add_hook(hook):
+    """Call hook(span) whenever a span ends"""
+    with _lock:
+        _hooks.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    with _lock:
+        if hook in _hooks:
+            _hooks.remove(hook)
+
+
+def _finish(span):
+    with _lock:
+        histogram = _histograms.get(span.key)
+        if histogram is None:
+            histogram = _histograms[span.key] = Histogram()
+        histogram.add(span.duration, span.error)
+        hooks = list(_hooks)
+    for hook in hooks:
+        hook(span)
+
+
+def span(name, **labels):
+    """Context manager timing the operation name, one doing nothing if tracing is not enabled"""
+    if not enabled:
+        return nullcontext()
+    return Span(name, labels)
+
+
+def histograms():
+    """{span key: Histogram} of all spans ended in this process"""
+    with _lock:
+        return dict(_histograms)
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+
+
+def traced(name, labels=None):
+    """
+    Decorator timing every call of a function as span name. labels is a dict, or a function
+    of the call's arguments returning one. Coroutine functions are timed until they return.
+    Generators are returned as they are, their time is spent after the call.
+    """
+    def decorator(func):
+        if inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func):
+            return func
+
+        def make_span(args, kwargs):
+            return Span(name, labels(*args, **kwargs) if callable(labels) else dict(labels or {}))
+
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not enabled:
+                    return await func(*args, **kwargs)
+                with make_span(args, kwargs):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with make_span(args, kwargs):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_module(module, provider):
+    """Trace every public function defined in a provider module, as span provider.function"""
+    labels = {'provider': provider}
+    for attr, value in list(vars(module).items()):
+        if not attr.startswith('_') and inspect.isfunction(value) and value.__module__ == module.__name__:
+            setattr(module, attr, traced(f'{provider}.{attr}', labels)(value))
+
+
+def instrument_class(cls, labels, *, exclude=()):
+    """
+    Trace every public method defined in cls but exclude, as span Class.method, labelled
+    with labels(self, *args, **kwargs)
+    """
+    for attr, value in list(vars(cls).items()):
+        if not attr.startswith('_') and attr not in exclude and inspect.isfunction(value):
+            setattr(cls, attr, traced(f'{cls.__name__}.{attr}', labels)(value))
+
+
+class JsonLinesExporter:
+    """Hook appending every span as a line of json to path"""
+
+    def __init__(self, path=trace_path, *, max_bytes=64 * 1024 * 1024):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Keep one previous file when it grows too big
+        if os.path.exists(path) and os.path.getsize(path) > max_bytes:
+            os.replace(path, path + '.1')
+        self._file = open(path, 'a', buffering=1)
+        self._lock = Lock()
+
+    def __call__(self, span):
+        line = json.dumps(span.to_dict(), default=str) + '\n'
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def export(path=trace_path):
+    """Append every span ended from now on to path as json lines, return the exporter hook"""
+    exporter = add_hook(JsonLinesExporter(path))
+    atexit.register(exporter.close)
+    return exporter
+
+
+def read(path=trace_path):
+    """Spans saved by export to path, both the current and the previous file"""
+    spans = []
+    for p in [path + '.1', path]:
+        try:
+            with open(p) as f:
+                for line in f:
+                    try:
+                        spans.append(Span.from_dict(json.loads(line)))
+                    except (ValueError, KeyError):
+                        # A line cut by a crashed process
+                        pass
+        except FileNotFoundError:
+            pass
+    return spans
+
+
+def summarize(spans):
+    """{span key: Histogram} of spans"""
+    result = {}
+    for s in spans:
+        result.setdefault(s.key, Histogram()).add(s.duration, s.error)
+    return result
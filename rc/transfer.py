@@ -0,0 +1,241 @@
+import hashlib
+import os
+import time
+from collections import namedtuple
+from rc.util import run, pmap
+from rc.exception import UploadException, DownloadException, PmapException
+
+Hop = namedtuple('Hop', ['source', 'target', 'elapsed'])
+
+LOCAL = 'local'
+
+
+def _sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def local_digest(path):
+    """
+    sha256 of a file, or of a directory tree computed exactly like remote_digest_cmd:
+    sha256 of sha256sum output lines of every file sorted by path
+    """
+    path = os.path.expanduser(path)
+    if not os.path.isdir(path):
+        return _sha256_file(path)
+    files = []
+    for root, _, names in os.walk(path):
+        for name in names:
+            full = os.path.join(root, name)
+            if os.path.isfile(full) and not os.path.islink(full):
+                files.append(
+                    ('./' + os.path.relpath(full, path)).encode())
+    h = hashlib.sha256()
+    for rel in sorted(files):
+        h.update(_sha256_file(os.path.join(path, rel.decode())).encode() +
+                 b'  ' + rel + b'\n')
+    return h.hexdigest()
+
+
+def remote_digest_cmd(path, is_dir):
+    if is_dir:
+        return f"cd {path} && find . -type f -print0 | LC_ALL=C sort -z | xargs -0 -r sha256sum | sha256sum | cut -d' ' -f1"
+    return f"sha256sum < {path} | cut -d' ' -f1"
+
+
+def _relay_shell(machine):
+    # Forward the local ssh agent, so source machine can authenticate to target machine. A
+    # multiplexed session can't forward the agent when its master did not, connect on its own
+    from rc.ssh import pool
+    return ['ssh', *pool._base_options(machine), '-o', 'ControlPath=none', '-A',
+            machine.username + '@' + machine.ip, '--']
+
+
+def _schedule(pending, sources, fanout, direct=()):
+    """
+    (source, target index) of one round: every source sends to at most fanout pending
+    targets, sources taking turns. Targets in direct are only sent from LOCAL, first.
+    """
+    direct_targets = [i for i in pending if i in direct][:fanout]
+    skip = len(direct_targets)
+    slots = []
+    for _ in range(fanout):
+        for s in sources:
+            if s is LOCAL and skip:
+                skip -= 1
+                continue
+            slots.append(s)
+    return [(LOCAL, i) for i in direct_targets] + list(zip(slots, [i for i in pending if i not in direct]))
+
+
+def distribute(local_path, remote_path, machines, *, fanout=3, verify=True, retries=2, address=None, relay=None):
+    """
+    Copy local_path to remote_path on every machine. The controller seeds fanout machines,
+    then every machine that has a verified copy relays to fanout more machines with
+    rsync over ssh between machines (using forwarded local ssh agent), so total time
+    grows with log(N) instead of N. If local_path is a directory, remote_path is the
+    resulting directory.
+
+    Relaying needs a local ssh agent holding the key of machines, it is on by default
+    when SSH_AUTH_SOCK is set, else every machine is uploaded to directly. When a relay
+    hop fails, its source stops relaying and the target is uploaded to directly instead.
+
+    address(machine) gives the address other machines use to reach machine, default
+    machine.ip, e.g. use a private ip within a VPC. Each hop is verified by comparing a
+    sha256 digest with local_path, a failed direct hop is retried in a later round up to
+    retries times. Return the list of Hop(source, target, elapsed). Raise
+    UploadException naming machines that failed every attempt.
+    """
+    if address is None:
+        def address(m): return m.ip
+    if relay is None:
+        relay = bool(os.environ.get('SSH_AUTH_SOCK'))
+    is_dir = os.path.isdir(os.path.expanduser(local_path))
+    src = local_path.rstrip('/') + '/' if is_dir else local_path
+    dst = remote_path.rstrip('/') + '/' if is_dir else remote_path
+    mkdir = remote_path if is_dir else os.path.dirname(remote_path)
+    digest = local_digest(local_path) if verify else None
+
+    def hop(source, target):
+        start = time.time()
+        if mkdir:
+            p = target.run(f'mkdir -p {mkdir}')
+            if p.returncode != 0:
+                raise UploadException(p.stderr)
+        if source is LOCAL:
+            p = run(
+                f"rsync -a -e '{target._ssh_command_str()}' {src} {target.username}@{target.ip}:{dst}")
+        else:
+            p = run(f"rsync -a -e 'ssh -o StrictHostKeyChecking=no -o BatchMode=yes -o ConnectTimeout=10' "
+                    f"{dst} {target.username}@{address(target)}:{dst}",
+                    shell=_relay_shell(source))
+        if p.returncode != 0:
+            raise UploadException(p.stderr)
+        if verify:
+            p = target.run(remote_digest_cmd(remote_path, is_dir))
+            if p.returncode != 0 or p.stdout.strip() != digest:
+                raise UploadException(
+                    f'checksum mismatch on {target}: {p.stdout.strip() or p.stderr}')
+        return Hop(str(source), str(target), time.time() - start)
+
+    machines = list(machines)
+    pending = list(range(len(machines)))
+    relays = []
+    direct = set()
+    attempts = {}
+    failed = {}
+    hops = []
+    while pending:
+        assignments = _schedule(pending, [LOCAL, *relays], fanout, direct)
+        results = pmap(lambda a: hop(a[0], machines[a[1]]), assignments,
+                       on_exception='return', concurrency=len(assignments))
+        for (source, i), r in zip(assignments, results):
+            if isinstance(r, PmapException) and source is not LOCAL:
+                # Relays may not reach or authenticate to target, fall back to a direct upload
+                direct.add(i)
+                relays = [m for m in relays if m is not source]
+            elif isinstance(r, PmapException):
+                attempts[i] = attempts.get(i, 0) + 1
+                if attempts[i] > retries:
+                    pending.remove(i)
+                    failed[str(machines[i])] = r.args[0]
+            else:
+                pending.remove(i)
+                if relay:
+                    relays.append(machines[i])
+                hops.append(r)
+    if failed:
+        raise UploadException('distribute failed on ' + ', '.join(
+            f'{name}: {e}' for name, e in failed.items()))
+    return hops
+
+
+class GatherReport:
+    """Result of gather: SyncReport or PmapException per machine name, and total elapsed seconds"""
+
+    def __init__(self, reports, elapsed):
+        self.reports = reports
+        self.elapsed = elapsed
+
+    @property
+    def failed(self):
+        return {name: r for name, r in self.reports.items() if isinstance(r, PmapException)}
+
+    @property
+    def bytes(self):
+        return sum(r.bytes_received for r in self.reports.values()
+                   if not isinstance(r, PmapException) and r is not None)
+
+    def summary(self):
+        from humanfriendly import format_size, format_timespan
+        done = len(self.reports) - len(self.failed)
+        rate = self.bytes / self.elapsed if self.elapsed else 0
+        lines = [f'Gathered from {done}/{len(self.reports)} machines, {format_size(self.bytes)} in '
+                 f'{format_timespan(self.elapsed)} ({format_size(rate)}/s)']
+        for name, e in self.failed.items():
+            lines.append(f'FAIL on {name}: {e.args[0]}')
+        return '\n'.join(lines)
+
+
+def gather(machines, remote_path, local_dir, *, concurrency=16, compress=False, sudo=False, resume=True, **options):
+    """
+    Download remote_path from every machine into local_dir/<machine> in parallel, at most
+    concurrency transfers at a time. With resume, partially transferred files are kept and
+    machines that completed a previous failed gather of the same remote_path into the same
+    local_dir are skipped, so a failed gather can simply be run again. Once every machine
+    completed, the next gather transfers from all machines again. Return a GatherReport.
+    """
+    local_dir = os.path.expanduser(local_dir)
+    os.makedirs(local_dir, exist_ok=True)
+    path_digest = hashlib.sha256(remote_path.encode()).hexdigest()[:16]
+
+    def done_marker(machine):
+        return os.path.join(local_dir, f'.{machine}.{path_digest}.done')
+
+    def gather_one(machine):
+        if resume and os.path.exists(done_marker(machine)):
+            return None
+        target = os.path.join(local_dir, str(machine))
+        os.makedirs(target, exist_ok=True)
+        report = machine.sync(remote_path, target + '/', direction='down', user='root' if sudo else None,
+                              compress=compress, partial=resume, **options)
+        if report.returncode != 0:
+            raise DownloadException(report.result.stderr)
+        if resume:
+            open(done_marker(machine), 'w').close()
+        return report
+
+    machines = list(machines)
+    start = time.time()
+    reports = pmap(gather_one, machines, on_exception='return',
+                   concurrency=concurrency)
+    if resume and not any(isinstance(r, PmapException) for r in reports):
+        for m in machines:
+            try:
+                os.remove(done_marker(m))
+            except FileNotFoundError:
+                pass
+    return GatherReport({str(m): r for m, r in zip(machines, reports)}, time.time() - start)
+
+
+def write_files(machines, path, data, *, compress=False, concurrency=None, **options):
+    """
+    Write the same data to path on every machine, see Machine.write_file for options.
+    data is read, and compressed if compress, only once for all machines. Return list of
+    RunResult in order of machines, or PmapException for machines that failed.
+    """
+    from rc.machine import iter_chunks, gzip_chunks
+    chunks = iter_chunks(data)
+    if compress:
+        chunks = gzip_chunks(chunks)
+    payload = b''.join(chunks)
+
+    def write_one(machine):
+        p = machine.write_file(path, payload, compressed=compress, **options)
+        if p.returncode != 0:
+            raise UploadException(p.stderr)
+        return p
+    return pmap(write_one, machines, on_exception='return', concurrency=concurrency)
@@ -5,10 +5,17 @@ from collections import namedtuple
 import os
 from typing import Union, List
 import io
-from threading import Thread, Lock
+import codecs
+import locale
+import selectors
+from threading import Thread, Lock, Semaphore
+from contextlib import contextmanager
+from functools import wraps
 from queue import Queue
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED, TimeoutError
+import time
 import signal
+from rc import trace
 
 _RunResult = namedtuple('_RunResult', ['stdout', 'stderr', 'returncode'])
 
@@ -19,6 +26,14 @@ class RunResult(_RunResult):
         return self.returncode
 
 
+def _command_label(cmd, *args, **kwargs):
+    # First word of a command, e.g. ssh, rsync or gcloud, not the whole command which can hold secrets
+    if isinstance(cmd, str):
+        words = cmd.split(None, 1)
+        return {'command': os.path.basename(words[0]) if words else ''}
+    return {'command': os.path.basename(str(cmd[0])) if cmd else ''}
+
+
 def convert_list_command_to_str(cmd: List[str]) -> str:
     cmd_str = io.StringIO('')
     for c in cmd:
@@ -32,6 +47,7 @@ def convert_list_command_to_str(cmd: List[str]) -> str:
     return cmd_str.getvalue()
 
 
+@trace.traced('run', _command_label)
 def run(cmd: Union[str, List[str]], *, shell=['/bin/sh', '-c'], input=None, timeout=None, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE):
     p = running(cmd, shell=shell, input=input,
                 text=text, stdout=stdout, stderr=stderr)
@@ -42,7 +58,8 @@ def run(cmd: Union[str, List[str]], *, shell=['/bin/sh', '-c'], input=None, time
     return RunResult(returncode=p.returncode, stdout=stdout, stderr=stderr)
 
 
-def bash(script, *, timeout=None, flag='set -euo pipefail', login=False, interactive=False, run_shell=['/bin/sh', '-c'], stdout=subprocess.PIPE, stderr=subprocess.PIPE):
+def bash_cmd(script, *, flag='set -euo pipefail', login=False, interactive=False):
+    """Command and its input that run script with bash"""
     cmd = 'bash '
     if login:
         cmd += '-l '
@@ -50,11 +67,17 @@ def bash(script, *, timeout=None, flag='set -euo pipefail', login=False, interac
         cmd += '-i '
     if flag:
         script = flag + '\n' + script
+    return cmd, script
 
-    return run(cmd, input=script, timeout=timeout, shell=run_shell, stdout=stdout, stderr=stderr)
 
+def bash(script, *, timeout=None, flag='set -euo pipefail', login=False, interactive=False, run_shell=['/bin/sh', '-c'], stdout=subprocess.PIPE, stderr=subprocess.PIPE):
+    cmd, input = bash_cmd(script, flag=flag, login=login,
+                          interactive=interactive)
+    return run(cmd, input=input, timeout=timeout, shell=run_shell, stdout=stdout, stderr=stderr)
 
-def sudo(script, *, shell=None, user='root', timeout=None, flag='set -euo pipefail', run_shell=['/bin/sh', '-c'], stdout=subprocess.PIPE, stderr=subprocess.PIPE):
+
+def sudo_cmd(script, *, shell=None, user='root', flag='set -euo pipefail'):
+    """Command and its input that run script with sudo as user"""
     cmd = 'sudo '
     if user != 'root':
         cmd += '-u ' + user + ' '
@@ -64,14 +87,24 @@ def sudo(script, *, shell=None, user='root', timeout=None, flag='set -euo pipefa
         cmd += '-s ' + shell + ' '
     if flag:
         script = flag + '\n' + script
-    return run(cmd, input=script, timeout=timeout, shell=run_shell, stdout=stdout, stderr=stderr)
+    return cmd, script
 
 
-def python(script, *, timeout=None, python_path='python', user=None, run_shell=['/bin/sh', '-c'], stdout=subprocess.PIPE, stderr=subprocess.PIPE):
+def sudo(script, *, shell=None, user='root', timeout=None, flag='set -euo pipefail', run_shell=['/bin/sh', '-c'], stdout=subprocess.PIPE, stderr=subprocess.PIPE):
+    cmd, input = sudo_cmd(script, shell=shell, user=user, flag=flag)
+    return run(cmd, input=input, timeout=timeout, shell=run_shell, stdout=stdout, stderr=stderr)
+
+
+def python_cmd(script, *, python_path='python', user=None):
+    """Command and its input that run python script"""
     if user:
-        return sudo(script, user=user, flag='', shell=python_path, timeout=timeout, run_shell=run_shell, stdout=stdout, stderr=stderr)
-    else:
-        return run(python_path, input=script, timeout=timeout, shell=run_shell, stdout=stdout, stderr=stderr)
+        return sudo_cmd(script, user=user, flag='', shell=python_path)
+    return python_path, script
+
+
+def python(script, *, timeout=None, python_path='python', user=None, run_shell=['/bin/sh', '-c'], stdout=subprocess.PIPE, stderr=subprocess.PIPE):
+    cmd, input = python_cmd(script, python_path=python_path, user=user)
+    return run(cmd, input=input, timeout=timeout, shell=run_shell, stdout=stdout, stderr=stderr)
 
 
 def python2(script, **kwargs):
@@ -82,6 +115,7 @@ def python3(script, **kwargs):
     return python(script, **kwargs)
 
 
+@trace.traced('running', _command_label)
 def running(cmd: Union[str, List[str]], *, shell=['/bin/sh', '-c'], input=None, text=True,
             stdout=subprocess.PIPE, stderr=subprocess.PIPE):
     if type(cmd) is list:
@@ -106,39 +140,166 @@ def running(cmd: Union[str, List[str]], *, shell=['/bin/sh', '-c'], input=None,
         raise RunException(e[1]) from None
 
 
-STDOUT = 1
-STDERR = 2
-EXIT = 3
-
-
-def run_stream(cmd: Union[str, List[str]], *, shell=['/bin/sh', '-c'], input=None, text=True):
-    p = running(cmd, shell=shell, input=input, text=text)
-    q = Queue()
+@trace.traced('run_chunks', _command_label)
+def run_chunks(cmd: Union[str, List[str]], chunks, *, shell=['/bin/sh', '-c'], timeout=None, text=True):
+    """
+    Like run, but stream the bytes of iterable chunks to stdin of cmd from a writer thread,
+    so input is never held in memory at once and output is read while input is written.
+    Output is bytes unless text
+    """
+    if type(cmd) is list:
+        cmd = convert_list_command_to_str(cmd)
+    try:
+        p = subprocess.Popen([*(shell or []), cmd], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, preexec_fn=os.setsid)
+    except Exception as e:
+        raise RunException(e) from None
+    stdin, p.stdin = p.stdin, None
 
-    def queue_stdout():
-        for line in p.stdout:
-            q.put((STDOUT, line))
+    def write():
+        try:
+            for chunk in chunks:
+                stdin.write(chunk)
+        except BrokenPipeError:
+            # cmd exited early, its exit code and stderr tell why
+            pass
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+    writer = Thread(target=write, daemon=True)
+    writer.start()
+    try:
+        stdout, stderr = p.communicate(timeout=timeout)
+    except Exception as e:
+        raise RunException(e) from None
+    writer.join()
+    if text:
+        stdout, stderr = stdout.decode(errors='replace'), stderr.decode(errors='replace')
+    return RunResult(returncode=p.returncode, stdout=stdout, stderr=stderr)
 
-    def queue_stderr():
-        for line in p.stderr:
-            q.put((STDERR, line))
 
-    queue_stdout_thread = Thread(target=queue_stdout)
-    queue_stderr_thread = Thread(target=queue_stderr)
+STDOUT = 1
+STDERR = 2
+EXIT = 3
 
-    queue_stdout_thread.start()
-    queue_stderr_thread.start()
 
-    def queue_exit():
-        queue_stdout_thread.join()
-        queue_stderr_thread.join()
+class _StreamLoop:
+    """
+    One thread multiplexing stdout and stderr of every run_stream process with a selector.
+    Lines are put to each process's queue as (STDOUT|STDERR, line), then (EXIT, returncode)
+    once both pipes are closed and the process is reaped.
+    """
+    # Reap interval when pidfd is not available
+    REAP_INTERVAL = 0.05
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._lock = Lock()
+        self._new = []
+        self._reaping = []
+        self._thread = None
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+
+    def add(self, p, q, text):
+        with self._lock:
+            self._new.append((p, q, text))
+            if self._thread is None:
+                self._thread = Thread(target=self._loop, name='rc-stream-loop', daemon=True)
+                self._thread.start()
+        os.write(self._wakeup_w, b'\0')
+
+    def _register(self, p, q, text):
+        stream = {'p': p, 'q': q, 'open': 0}
+        for f, event in ((p.stdout, STDOUT), (p.stderr, STDERR)):
+            if text:
+                decoder = io.IncrementalNewlineDecoder(
+                    codecs.getincrementaldecoder(locale.getpreferredencoding(False))(), translate=True)
+            else:
+                decoder = None
+            os.set_blocking(f.fileno(), False)
+            self._selector.register(f.fileno(), selectors.EVENT_READ,
+                                    (stream, f, event, decoder, ['' if text else b'']))
+            stream['open'] += 1
+
+    def _emit(self, q, event, buf, data, final):
+        buf[0] += data
+        newline = '\n' if isinstance(buf[0], str) else b'\n'
+        lines = buf[0].split(newline)
+        buf[0] = lines.pop()
+        for line in lines:
+            q.put((event, line + newline))
+        if final and buf[0]:
+            q.put((event, buf[0]))
+            buf[0] = buf[0][:0]
+
+    def _exited(self, stream):
+        p = stream['p']
+        pidfd_open = getattr(os, 'pidfd_open', None)
+        if pidfd_open:
+            try:
+                fd = pidfd_open(p.pid)
+            except OSError:
+                fd = None
+            if fd is not None:
+                self._selector.register(fd, selectors.EVENT_READ, ('exit', stream, fd))
+                return
+        self._reaping.append(stream)
+
+    def _reap(self):
+        for stream in self._reaping[:]:
+            if stream['p'].poll() is not None:
+                self._reaping.remove(stream)
+                stream['q'].put((EXIT, stream['p'].returncode))
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                new, self._new = self._new, []
+            for args in new:
+                self._register(*args)
+            for key, _ in self._selector.select(self.REAP_INTERVAL if self._reaping else None):
+                if key.data is None:
+                    try:
+                        os.read(self._wakeup_r, 4096)
+                    except BlockingIOError:
+                        pass
+                elif key.data[0] == 'exit':
+                    _, stream, fd = key.data
+                    self._selector.unregister(fd)
+                    os.close(fd)
+                    stream['q'].put((EXIT, stream['p'].wait()))
+                else:
+                    stream, f, event, decoder, buf = key.data
+                    try:
+                        data = os.read(key.fd, 65536)
+                    except BlockingIOError:
+                        continue
+                    eof = not data
+                    if decoder:
+                        data = decoder.decode(data, final=eof)
+                    self._emit(stream['q'], event, buf, data, eof)
+                    if eof:
+                        self._selector.unregister(key.fd)
+                        f.close()
+                        stream['open'] -= 1
+                        if stream['open'] == 0:
+                            self._exited(stream)
+            self._reap()
+
+
+_stream_loop = _StreamLoop()
 
-        while p.poll() is None:
-            pass
-        q.put((EXIT, p.returncode))
 
-    queue_exit_thread = Thread(target=queue_exit)
-    queue_exit_thread.start()
+def run_stream(cmd: Union[str, List[str]], *, shell=['/bin/sh', '-c'], input=None, text=True):
+    if text and isinstance(input, str):
+        input = input.encode()
+    p = running(cmd, shell=shell, input=input, text=False)
+    q = Queue()
+    _stream_loop.add(p, q, text)
     return q, p
 
 
@@ -158,23 +319,185 @@ def handle_stream(q, *, stdout_handler=None, stderr_handler=None, exit_handler=N
         q.task_done()
 
 
-executor = ThreadPoolExecutor()
+# Workers of the shared executor behind go(). pmap uses its own workers per call, so nested
+# pmap (e.g. parse_config -> provider.get -> pmap over regions) can never starve each other
+max_workers = 512
+# Default number of concurrent tasks of one pmap call
+pmap_concurrency = 128
+
+executor = ThreadPoolExecutor(max_workers=max_workers)
+
+
+def configure(*, workers=None, concurrency=None):
+    """Change the size of the go() executor and the default concurrency of pmap"""
+    global executor, max_workers, pmap_concurrency
+    if workers is not None:
+        old, executor, max_workers = executor, ThreadPoolExecutor(
+            max_workers=workers), workers
+        old.shutdown(wait=False)
+    if concurrency is not None:
+        pmap_concurrency = concurrency
 
 
 def go(func, *args, **kwargs):
     return executor.submit(func, *args, **kwargs)
 
 
-def pmap(func, *iterables, timeout=None, on_exception='raise'):
+def pmap(func, *iterables, timeout=None, on_exception='raise', concurrency=None, ordered=True):
+    """
+    Run func over iterables in parallel and return the list of results in order. With
+    ordered=False, return a generator yielding results as they finish instead, see pimap.
+    """
+    if not ordered:
+        return pimap(func, *iterables, timeout=timeout, on_exception=on_exception, concurrency=concurrency)
+    args = list(zip(*iterables))
+    if not args:
+        return []
     if on_exception == 'raise':
-        return list(executor.map(func, *iterables, timeout=timeout))
+        task = func
+    else:
+        def task(*arg):
+            try:
+                return func(*arg)
+            except Exception as e:
+                return PmapException(e, *arg)
+    pool = ThreadPoolExecutor(max_workers=min(
+        concurrency or pmap_concurrency, len(args)))
+    try:
+        return list(pool.map(task, *zip(*args), timeout=timeout))
+    finally:
+        pool.shutdown(wait=False)
+
+
+def pimap(func, *iterables, ordered=False, timeout=None, item_timeout=None, on_exception='raise',
+          fail_fast=False, concurrency=None):
+    """
+    Generator version of pmap, yield results as soon as each task finishes (or in input order
+    if ordered). A task raising, or running longer than item_timeout seconds, yields
+    PmapException(e, *args) unless on_exception is 'raise', in which case the exception is raised.
+    With fail_fast, remaining tasks are cancelled after the first failure; if ordered and an earlier
+    task is still running, only the results before it are yielded, then the failure is raised.
+    Raise TimeoutError if everything did not finish within timeout seconds.
+    """
+    args = list(zip(*iterables))
+    if not args:
+        return
+    started = {}
+
+    def task(i):
+        started[i] = time.monotonic()
+        return func(*args[i])
+
+    pool = ThreadPoolExecutor(max_workers=min(
+        concurrency or pmap_concurrency, len(args)))
+    futures = {pool.submit(task, i): i for i in range(len(args))}
+    pending = set(futures)
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    buffered = {}
+    next_index = 0
+    try:
+        while pending:
+            now = time.monotonic()
+            wait_until = deadline
+            if item_timeout is not None:
+                for f in pending:
+                    if futures[f] in started:
+                        item_deadline = started[futures[f]] + item_timeout
+                        if wait_until is None or item_deadline < wait_until:
+                            wait_until = item_deadline
+                if wait_until is None or len(started) < len(args):
+                    # Tasks not yet started have no deadline, recheck a while later
+                    wait_until = min(wait_until or now + item_timeout, now + item_timeout)
+            done, _ = wait(pending, timeout=None if wait_until is None else max(0, wait_until - now),
+                           return_when=FIRST_COMPLETED)
+            now = time.monotonic()
+            finished = []
+            for f in done:
+                pending.remove(f)
+                i = futures[f]
+                try:
+                    finished.append((i, f.result()))
+                except Exception as e:
+                    if on_exception == 'raise':
+                        raise
+                    finished.append((i, PmapException(e, *args[i])))
+            if item_timeout is not None:
+                for f in list(pending):
+                    i = futures[f]
+                    if i in started and now - started[i] >= item_timeout:
+                        pending.remove(f)
+                        f.cancel()
+                        e = TimeoutError(
+                            f'task did not finish in {item_timeout} seconds')
+                        if on_exception == 'raise':
+                            raise e
+                        finished.append((i, PmapException(e, *args[i])))
+            if deadline is not None and pending and now >= deadline:
+                raise TimeoutError()
+            failed = None
+            for i, result in sorted(finished, key=lambda r: r[0]):
+                if failed is None and isinstance(result, PmapException):
+                    failed = result
+                if ordered:
+                    buffered[i] = result
+                else:
+                    yield result
+            if ordered:
+                while next_index in buffered:
+                    yield buffered.pop(next_index)
+                    next_index += 1
+            if failed is not None and fail_fast:
+                if ordered and any(result is failed for result in buffered.values()):
+                    # Results past a gap can't be yielded in order, raise the failure after the prefix
+                    raise failed
+                return
+    finally:
+        for f in pending:
+            f.cancel()
+        pool.shutdown(wait=False)
+
+
+_limits = {}
+_limits_lock = Lock()
+
+
+class _Limit:
+    def __init__(self, n):
+        self.n = n
+        self.semaphore = Semaphore(n)
+
+
+def set_limit(name, n):
+    """Allow at most n concurrent calls limited by name, e.g. CLI calls of one cloud provider"""
+    with _limits_lock:
+        _limits[name] = _Limit(n)
+
+
+def get_limit(name):
+    limit = _limits.get(name)
+    return limit.n if limit else None
+
+
+@contextmanager
+def limit(name, default=None):
+    with _limits_lock:
+        if name not in _limits and default:
+            _limits[name] = _Limit(default)
+        l = _limits.get(name)
+    if l is None:
+        yield
+    else:
+        with l.semaphore:
+            yield
 
-    def func_wrapper(arg):
-        try:
-            return func(arg)
-        except Exception as e:
-            return PmapException(e, arg)
-    return list(executor.map(func_wrapper, *iterables, timeout=timeout))
+
+def limited(name, func, default=None):
+    """Wrap func so that its calls share the concurrency limit of name"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with limit(name, default):
+            return func(*args, **kwargs)
+    return wrapper
 
 
 def print_stream(q, *, prefix):
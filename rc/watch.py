@@ -0,0 +1,109 @@
+import time
+from threading import Thread, Lock, Event
+from rc.exception import RcException
+
+
+class _Waiter:
+    def __init__(self, key, predicate):
+        self.key = key
+        self.predicate = predicate
+        self.event = Event()
+        self.status = None
+
+
+class StatusWatcher:
+    """
+    Poll status of many machines of one provider with one call per interval, however many
+    threads are waiting. fetch(keys) returns {key: status} for the keys it knows about in
+    one provider call (e.g. one describe or list covering N ids), keys it does not return
+    have status None. Waiters block until their predicate on the status is true.
+
+    The interval starts at min_interval, grows by factor up to max_interval while no status
+    changes, and goes back to min_interval when one does. The polling thread only runs while
+    something is waited for. A failed fetch is retried on the next interval.
+    """
+
+    def __init__(self, fetch, *, min_interval=1, max_interval=10, factor=1.5):
+        self.fetch = fetch
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.last_error = None
+        self._lock = Lock()
+        self._waiters = []
+        self._statuses = {}
+        self._thread = None
+        self._wakeup = Event()
+
+    def _poll(self):
+        interval = self.min_interval
+        while True:
+            with self._lock:
+                if not self._waiters:
+                    self._thread = None
+                    return
+                keys = {w.key for w in self._waiters}
+            changed = False
+            last = time.monotonic()
+            try:
+                statuses = self.fetch(keys)
+                self.last_error = None
+            except Exception as e:
+                statuses = None
+                self.last_error = e
+            if statuses is not None:
+                with self._lock:
+                    for key in keys:
+                        status = statuses.get(key)
+                        if self._statuses.get(key) != status:
+                            changed = True
+                        self._statuses[key] = status
+                    for w in [w for w in self._waiters if w.key in keys and w.predicate(self._statuses[w.key])]:
+                        w.status = self._statuses[w.key]
+                        w.event.set()
+                        self._waiters.remove(w)
+            interval = self.min_interval if changed else min(
+                self.max_interval, interval * self.factor)
+            # A new waiter shortens the wait to min_interval after the last poll, so it does not
+            # wait out a long interval, and many new waiters still cost one poll per min_interval
+            deadline = last + interval
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if self._wakeup.wait(remaining):
+                    self._wakeup.clear()
+                    deadline = min(deadline, last + self.min_interval)
+
+    def _add(self, key, predicate):
+        waiter = _Waiter(key, predicate)
+        with self._lock:
+            self._waiters.append(waiter)
+            if self._thread is None:
+                self._thread = Thread(target=self._poll, daemon=True)
+                self._thread.start()
+            else:
+                self._wakeup.set()
+        return waiter
+
+    def _cancel(self, waiter):
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def wait(self, key, predicate, timeout=None):
+        """Block until predicate(status of key) is true and return the status"""
+        return self.wait_many([key], predicate, timeout=timeout)[key]
+
+    def wait_many(self, keys, predicate, timeout=None):
+        """Block until predicate(status) is true for every key, return {key: status}"""
+        waiters = [self._add(key, predicate) for key in keys]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for w in waiters:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            if not w.event.wait(remaining):
+                for other in waiters:
+                    self._cancel(other)
+                error = f', last error: {self.last_error}' if self.last_error else ''
+                raise RcException(f'Timed out after {timeout} seconds waiting for {w.key}{error}')
+        return {w.key: w.status for w in waiters}
@@ -27,13 +27,12 @@ setuptools.setup(
         "Topic :: System :: Systems Administration"
     ],
     install_requires=[
-        'retry',
         'PyYAML',
         'humanfriendly',
         'libtmux',
         'py-term',
         'pytimeparse',
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     scripts=['bin/rc']
 )